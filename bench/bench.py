@@ -0,0 +1,302 @@
+"""
+API 壓測 / 基準比較工具
+
+  python bench/bench.py seed --fixtures 5000 --models 200 --usage-logs 2000000
+  python bench/bench.py run --url http://localhost:8000 --duration 20 --concurrency 16 --out bench/results.json
+  python bench/bench.py compare bench/results.json --baseline bench/baseline.json
+
+seed 以固定亂數種子產生一座合成工廠（治具、治具資料、機種、需求、使用記錄），
+寫入 main.py 設定的資料庫（DB_HOST / DB_NAME ...），run 與 seed 使用相同的命名規則與種子，
+同樣參數兩次執行打到的資料相同，結果可以互相比較。
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import socket
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlencode, urlsplit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+SEED_TABLES = ("fixtures", "fixture_models", "machine_models", "fixture_requirements", "usage_logs",
+               "usage_rollup_hourly", "usage_rollup_daily")
+
+
+# ---------- Synthetic plant ----------
+def fixture_name(i: int) -> str:
+    return f"BX-{i:06d}"
+
+def model_code(i: int) -> str:
+    return f"BM-{i:04d}"
+
+def station_name(i: int) -> str:
+    return f"ST{i:02d}"
+
+
+def seed(args):
+    import main  # 使用與 API 相同的連線設定與 schema
+
+    rng = random.Random(args.seed)
+    main.wait_for_db()
+    main.run_migrations()
+    conn = main.get_db(); c = conn.cursor()
+    try:
+        if args.reset:
+            for t in SEED_TABLES:
+                c.execute(f"TRUNCATE TABLE {t}")
+            print(f"已清空：{', '.join(SEED_TABLES)}")
+
+        t0 = time.time()
+        c.executemany("INSERT INTO fixtures (name, status, life_type, used, life_value) VALUES (%s,%s,%s,%s,%s)",
+                      [(fixture_name(i), "active" if rng.random() < 0.9 else "scrap",
+                        "count" if rng.random() < 0.8 else "time", 0, rng.choice([50, 100, 200, 500]) * 100)
+                       for i in range(args.fixtures)])
+        c.executemany("INSERT INTO fixture_models (code, name, spec, note) VALUES (%s,%s,%s,%s)",
+                      [(fixture_name(i), f"治具 {i}", f"SPEC-{rng.randint(1, 50)}", None) for i in range(args.fixtures)])
+        c.executemany("INSERT INTO machine_models (code, name, note) VALUES (%s,%s,%s)",
+                      [(model_code(i), f"機種 {i}", None) for i in range(args.models)])
+        reqs = []
+        for m in range(args.models):
+            for s in range(args.stations):
+                for f in rng.sample(range(args.fixtures), rng.randint(1, 3)):
+                    reqs.append((model_code(m), station_name(s), fixture_name(f), rng.randint(1, 4)))
+        c.executemany("INSERT INTO fixture_requirements (model_code, station, fixture_code, required_qty) VALUES (%s,%s,%s,%s)",
+                      reqs)
+        print(f"主檔：{args.fixtures} 治具、{args.models} 機種、{len(reqs)} 筆需求（{time.time() - t0:.1f}s）")
+
+        t0 = time.time()
+        start = datetime.now().replace(microsecond=0) - timedelta(days=args.days)
+        span = args.days * 86400
+        done = 0
+        while done < args.usage_logs:
+            n = min(args.batch, args.usage_logs - done)
+            c.executemany("""INSERT INTO usage_logs (fixture_id, serial_number, station_id, use_count, abnormal_status, operator, used_at)
+                             VALUES (%s,%s,%s,%s,%s,%s,%s)""",
+                          [(fixture_name(rng.randrange(args.fixtures)), None, rng.randint(1, args.stations),
+                            rng.randint(1, 5), "NG" if rng.random() < 0.01 else None, "bench",
+                            start + timedelta(seconds=rng.randrange(span))) for _ in range(n)])
+            done += n
+            print(f"\r使用記錄：{done}/{args.usage_logs}", end="", flush=True)
+        print(f"（{time.time() - t0:.1f}s）")
+
+        c.execute("""UPDATE fixtures f JOIN (SELECT fixture_id, SUM(use_count) AS n FROM usage_logs GROUP BY fixture_id) u
+                     ON u.fixture_id = f.name SET f.used = u.n""")
+        main.touch_tables(c, "fixtures", "fixture_models", "machine_models")
+        conn.commit()
+    finally:
+        conn.close()
+    t0 = time.time()
+    print(f"使用趨勢彙總：{main.rebuild_usage_rollups()}（{time.time() - t0:.1f}s）")
+
+
+# ---------- Scenarios ----------
+# 每個情境由 (rng, args) 產生一個請求 (method, path, body)
+Scenario = Callable[[random.Random, argparse.Namespace], tuple]
+
+def _usage_row(rng, args) -> Dict[str, Any]:
+    return {"fixture_id": fixture_name(rng.randrange(args.fixtures)), "station_id": rng.randint(1, args.stations),
+            "use_count": 1, "operator": "bench"}
+
+SCENARIOS: Dict[str, Scenario] = {
+    "usage_logs": lambda rng, a: ("POST", "/usage_logs", _usage_row(rng, a)),
+    "usage_logs_batch": lambda rng, a: ("POST", "/usage_logs/batch", [_usage_row(rng, a) for _ in range(100)]),
+    "max_stations": lambda rng, a: ("GET", "/models/max_stations?" + urlencode({"model_code": model_code(rng.randrange(a.models))}), None),
+    "max_stations_batch": lambda rng, a: ("POST", "/models/max_stations/batch",
+                                          {"model_codes": [model_code(rng.randrange(a.models)) for _ in range(20)]}),
+    "fixtures_page": lambda rng, a: ("GET", "/fixtures?limit=100", None),
+    "search_suggest": lambda rng, a: ("GET", "/search/suggest?" + urlencode({"q": f"BX-{rng.randrange(a.fixtures):06d}"[:rng.randint(3, 9)]}), None),
+    "usage_trends": lambda rng, a: ("GET", "/usage/trends?" + urlencode(
+        {"fixture_ids": ",".join(fixture_name(rng.randrange(a.fixtures)) for _ in range(5)), "granularity": "day"}), None),
+    "dashboard": lambda rng, a: ("GET", "/dashboard", None),
+    "stats_summary": lambda rng, a: ("GET", "/stats/summary", None),
+}
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """nearest-rank 百分位數"""
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+def drive(name: str, scenario: Scenario, args) -> Dict[str, Any]:
+    """concurrency 個執行緒各自保持一條 keep-alive 連線，持續送出請求 duration 秒"""
+    target = urlsplit(args.url)
+    conn_cls = http.client.HTTPSConnection if target.scheme == "https" else http.client.HTTPConnection
+    latencies: List[List[float]] = [[] for _ in range(args.concurrency)]
+    errors = [0] * args.concurrency
+    stop_at = [0.0]
+    measuring = threading.Event()
+
+    def connect():
+        conn = conn_cls(target.hostname, target.port, timeout=args.timeout)
+        try:
+            conn.connect()
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # 避免 Nagle + delayed ACK 造成 40ms 延遲
+        except OSError:
+            conn.close()  # 下次 request 時 http.client 會自動重連，失敗計入錯誤
+        return conn
+
+    def worker(idx: int):
+        rng = random.Random(f"{args.seed}:{name}:{idx}")
+        conn = connect()
+        while time.perf_counter() < stop_at[0]:
+            method, path, body = scenario(rng, args)
+            payload = json.dumps(body).encode() if body is not None else None
+            headers = {"Content-Type": "application/json"} if payload else {}
+            t0 = time.perf_counter()
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                ok = resp.status < 400
+            except (OSError, http.client.HTTPException):
+                ok = False
+                conn.close()
+                conn = connect()
+                time.sleep(0.01)
+            elapsed = time.perf_counter() - t0
+            if measuring.is_set():
+                latencies[idx].append(elapsed)
+                if not ok:
+                    errors[idx] += 1
+        conn.close()
+
+    # 先暖機（不計入結果），再量測 duration 秒
+    stop_at[0] = time.perf_counter() + args.warmup + args.duration
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    time.sleep(args.warmup)
+    measuring.set()
+    t_start = time.perf_counter()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t_start
+
+    values = sorted(v for per in latencies for v in per)
+    ms = lambda v: round(v * 1000, 2)
+    return {"requests": len(values), "errors": sum(errors), "rps": round(len(values) / wall, 1) if wall else 0.0,
+            "p50_ms": ms(percentile(values, 50)), "p95_ms": ms(percentile(values, 95)),
+            "p99_ms": ms(percentile(values, 99)), "max_ms": ms(values[-1]) if values else 0.0}
+
+
+def print_report(results: Dict[str, Dict[str, Any]], diffs: Optional[Dict[str, Dict[str, Any]]] = None):
+    print(f"{'endpoint':<20}{'req':>8}{'err':>6}{'rps':>10}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for name, r in results.items():
+        line = (f"{name:<20}{r['requests']:>8}{r['errors']:>6}{r['rps']:>10}"
+                f"{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}{r['max_ms']:>9}")
+        d = (diffs or {}).get(name)
+        if d:
+            line += f"   p95 {d['p95_change']:+.0%} rps {d['rps_change']:+.0%}" + ("  ❌ REGRESSION" if d["regression"] else "")
+        print(line)
+
+
+def compare_results(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], tolerance: float):
+    """p95 變慢或 rps 下降超過 tolerance（比例）、或出現錯誤即視為退步"""
+    diffs = {}
+    for name, r in results.items():
+        b = baseline.get(name)
+        if not b:
+            continue
+        p95 = (r["p95_ms"] - b["p95_ms"]) / b["p95_ms"] if b["p95_ms"] else 0.0
+        rps = (r["rps"] - b["rps"]) / b["rps"] if b["rps"] else 0.0
+        diffs[name] = {"p95_change": p95, "rps_change": rps,
+                       "regression": p95 > tolerance or rps < -tolerance or (r["errors"] > 0 and not b["errors"])}
+    return diffs
+
+
+def run(args):
+    names = args.endpoint or list(SCENARIOS)
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        sys.exit(f"未知的情境：{', '.join(unknown)}（可用：{', '.join(SCENARIOS)}）")
+    results = {}
+    for name in names:
+        print(f"→ {name}：{args.concurrency} 連線 × {args.duration}s", flush=True)
+        results[name] = drive(name, SCENARIOS[name], args)
+    doc = {"meta": {"url": args.url, "concurrency": args.concurrency, "duration": args.duration, "seed": args.seed,
+                    "fixtures": args.fixtures, "models": args.models, "started_at": datetime.now().isoformat(timespec="seconds"),
+                    "python": platform.python_version(), "host": platform.node()},
+           "results": results}
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(doc, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(doc, f, ensure_ascii=False, indent=2)
+        print(f"已存為基準：{args.baseline}")
+    return finish(results, args)
+
+
+def finish(results, args) -> int:
+    diffs = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            diffs = compare_results(results, json.load(f)["results"], args.tolerance)
+    print_report(results, diffs)
+    if diffs and any(d["regression"] for d in diffs.values()):
+        print(f"❌ 與基準相比退步超過 {args.tolerance:.0%}")
+        return 1
+    return 0
+
+
+def compare(args):
+    with open(args.results, encoding="utf-8") as f:
+        return finish(json.load(f)["results"], args)
+
+
+def main_cli(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Fixture Management API 壓測")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    plant = argparse.ArgumentParser(add_help=False)
+    plant.add_argument("--fixtures", type=int, default=5000)
+    plant.add_argument("--models", type=int, default=200)
+    plant.add_argument("--stations", type=int, default=10, help="每個機種的站別數")
+    plant.add_argument("--seed", type=int, default=42)
+
+    baseline = argparse.ArgumentParser(add_help=False)
+    baseline.add_argument("--baseline", default=DEFAULT_BASELINE)
+    baseline.add_argument("--tolerance", type=float, default=0.15, help="允許的退步比例（預設 0.15）")
+
+    p_seed = sub.add_parser("seed", parents=[plant], help="產生合成資料")
+    p_seed.add_argument("--usage-logs", type=int, default=1_000_000)
+    p_seed.add_argument("--days", type=int, default=90, help="使用記錄分散在最近幾天")
+    p_seed.add_argument("--batch", type=int, default=10000)
+    p_seed.add_argument("--reset", action="store_true", help="先清空相關資料表（會刪除資料！）")
+
+    p_run = sub.add_parser("run", parents=[plant, baseline], help="對 API 施壓並統計延遲")
+    p_run.add_argument("--url", default="http://localhost:8000")
+    p_run.add_argument("--endpoint", action="append", help=f"只跑指定情境，可重複：{', '.join(SCENARIOS)}")
+    p_run.add_argument("--concurrency", type=int, default=16)
+    p_run.add_argument("--duration", type=float, default=20)
+    p_run.add_argument("--warmup", type=float, default=3)
+    p_run.add_argument("--timeout", type=float, default=30)
+    p_run.add_argument("--out", default=None, help="結果 JSON 輸出路徑")
+    p_run.add_argument("--save-baseline", action="store_true", help="把這次結果存成基準")
+
+    p_cmp = sub.add_parser("compare", parents=[baseline], help="比較結果與基準")
+    p_cmp.add_argument("results")
+    p_cmp.set_defaults(save_baseline=False)
+
+    args = parser.parse_args(argv)
+    if args.cmd == "seed":
+        seed(args)
+        return 0
+    return run(args) if args.cmd == "run" else compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,18 +1,57 @@
 import os
 import io
 import csv
+import asyncio
+import gzip
+import bisect
 import hashlib
-from typing import Optional, List, Any, Dict
+import heapq
+import re
+import tempfile
+import base64
+import json
+import smtplib
+import threading
+import itertools
+import contextlib
+import contextvars
+import collections
+import concurrent.futures
+import multiprocessing
+import shutil
+import socket
+import subprocess
+import uuid
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from email.message import EmailMessage
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, List, Any, Dict, Union, TYPE_CHECKING
 
-import pandas as pd
 import pymysql
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from pymysql.constants import SERVER_STATUS
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse, StreamingResponse, JSONResponse
+from fastapi.responses import RedirectResponse, StreamingResponse, JSONResponse, FileResponse
 from pydantic import BaseModel, Field
 import time
 
+if TYPE_CHECKING:  # pandas / numpy / openpyxl 在用到的函式內才載入（import 約需 0.5 秒）
+    import pandas as pd
+
+try:
+    import brotli  # 選用：有安裝才提供 br 壓縮
+except ImportError:
+    brotli = None
+
+try:
+    import orjson  # 選用：有安裝才走原生 JSON 編碼
+except ImportError:
+    orjson = None
+
 
 # ---------- Config ----------
 DB_HOST = os.getenv("DB_HOST", "db")
@@ -27,19 +66,63 @@ UPLOAD_DIR = os.path.join(APP_DIR, "uploads")
 os.makedirs(WEB_ROOT, exist_ok=True)
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-# 🧩 啟動時印出環境變數（除密碼外）
-print("====== [DB CONFIG LOADED] ======")
-print(f"DB_HOST = {DB_HOST}")
-print(f"DB_PORT = {DB_PORT}")
-print(f"DB_NAME = {DB_NAME}")
-print(f"DB_USER = {DB_USER}")
-print(f"DB_PASS (masked) = {'*' * len(DB_PASS)}")
-print("================================")
 
+# ---------- App ----------
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "1") == "1"
 
+# 啟動狀態：DB 連線與 schema 升級在背景執行緒進行，worker 不必等 DB 就能開始接受連線（/readyz 回報是否就緒）
+startup_state: Dict[str, Any] = {"db_ready": False, "schema_version": None, "error": None, "attempts": 0}
 
-# ---------- App ----------
-app = FastAPI(title="Fixture Management API", version="5.0.0")
+def prepare_database(stop: threading.Event):
+    """等待 DB 就緒並升級資料表，失敗以指數退避重試（最長間隔 10 秒），直到成功或程序關閉"""
+    delay = 0.5
+    while not stop.is_set():
+        startup_state["attempts"] += 1
+        try:
+            if DB_AUTO_MIGRATE:
+                applied = run_migrations()
+                print(f"✅ 資料表初始化完成（schema 版本 {latest_schema_version()}，本次套用 {applied or '無'}）")
+            else:
+                get_db().close()
+            startup_state.update(db_ready=True, error=None)
+            return
+        except Exception as e:
+            startup_state["error"] = str(e)
+            print(f"⚠️ 資料庫尚未就緒，{delay:.1f}s 後重試：{e}")
+            stop.wait(delay)
+            delay = min(delay * 2, 10.0)
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 不在 import 時連 DB，也不在這裡等 DB：CLI/測試 import main 不會連線，worker 啟動後立即可接受請求
+    print(f"🔌 DB {DB_USER}@{DB_HOST}:{DB_PORT}/{DB_NAME}")
+    stopping = threading.Event()
+    threading.Thread(target=prepare_database, args=(stopping,), name="db-startup", daemon=True).start()
+    usage_buffer.start()
+    if FORECAST_ENABLED:
+        forecast_task.start()
+    if RETENTION_ENABLED:
+        retention_task.start()
+    if CHANGES_ENABLED:
+        change_feed.start()
+    read_router.start()
+    job_runner.start()
+    search_refresh_task.start()
+    if BACKUP_INTERVAL_HOURS > 0:
+        backup_task.start()
+    yield
+    stopping.set()
+    backup_task.stop()
+    job_runner.shutdown()  # 取消進行中的 job，標記為 cancelled
+    search_refresh_task.stop()
+    change_feed.stop()
+    retention_task.stop()
+    forecast_task.stop()
+    usage_buffer.stop()  # 關閉前把緩衝中的使用記錄寫完
+    read_router.stop()
+    db_pool.dispose()
+
+app = FastAPI(title="Fixture Management API", version="5.0.0", lifespan=lifespan)
 @app.get("/")
 def root():
     return JSONResponse({"message": "API is running", "db_host": DB_HOST})
@@ -62,35 +145,575 @@ def root():
 
 
 # ---------- DB ----------
-def get_db():
-    """連線到 MySQL（若未啟動則重試 10 次，每次間隔 2 秒）"""
-    import time
-    for i in range(10):
-        try:
-            conn = pymysql.connect(
-                host=DB_HOST,
-                port=DB_PORT,
-                user=DB_USER,
-                password=DB_PASS,
+# 連線池設定（每個 uvicorn worker 各自一個池）
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))                # 常駐連線數
+DB_POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "10"))  # 尖峰時可額外開的連線數
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "3"))        # 取得連線最多等待秒數
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))       # 連線存活超過此秒數即重建
+DB_POOL_PING_INTERVAL = int(os.getenv("DB_POOL_PING_INTERVAL", "30"))  # 閒置超過此秒數，借出前先 ping
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "3"))
+# 讀寫分離：設定 DB_READ_HOST 後，報表與列表等唯讀查詢改連這台 replica（見 get_read_db）
+DB_READ_HOST = os.getenv("DB_READ_HOST", "")
+DB_READ_PORT = int(os.getenv("DB_READ_PORT", str(DB_PORT)))
+DB_READ_USER = os.getenv("DB_READ_USER", DB_USER)
+DB_READ_PASS = os.getenv("DB_READ_PASS", DB_PASS)
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", str(DB_POOL_SIZE)))
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "5"))             # 複寫延遲超過此秒數改讀 primary
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "5"))
+
+
+class DBUnavailable(Exception):
+    """資料庫無法連線，或連線池在逾時內借不到連線"""
+
+
+class PooledConnection:
+    """
+    連線池借出的連線。用法與 pymysql 連線相同，
+    差別在於 close() 是把連線歸還給池，而不是真的斷線。
+    也可以用 `with get_db() as conn:` 自動歸還。
+    """
+
+    def __init__(self, pool: "ConnectionPool", raw, created_at: float):
+        self._pool = pool
+        self._raw = raw
+        self._created_at = created_at
+
+    def __getattr__(self, name):
+        raw = self.__dict__.get("_raw")
+        if raw is None:
+            raise pymysql.err.InterfaceError("connection already returned to pool")
+        return getattr(raw, name)
+
+    def cursor(self, cursor=None):
+        raw = self.__dict__.get("_raw")
+        if raw is None:
+            raise pymysql.err.InterfaceError("connection already returned to pool")
+        return InstrumentedCursor(raw.cursor(cursor))
+
+    def commit(self):
+        raw = self.__dict__.get("_raw")
+        if raw is None:
+            raise pymysql.err.InterfaceError("connection already returned to pool")
+        raw.commit()
+        # 交易內有 touch_tables()：提交後才讓程序內的版本號快取失效
+        touched = raw.__dict__.pop("_touched_tables", None)
+        if touched:
+            invalidate_table_versions(touched)
+        # 交易內有 publish_change()：提交後立即通知本程序的 change feed，不等下一次輪詢
+        if raw.__dict__.pop("_changes_published", False):
+            change_feed.poke()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self._raw is not None:
+            try:
+                self._raw.rollback()
+            except Exception:
+                self._pool._release(self._raw, self._created_at, discard=True)
+                self._raw = None
+                return False
+        self.close()
+        return False
+
+    def close(self):
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._pool._release(raw, self._created_at)
+
+    def invalidate(self):
+        """直接關閉底層連線不放回池（例如串流中斷、SSCursor 尚有未讀完的結果）"""
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._pool._release(raw, self._created_at, discard=True)
+
+    def __del__(self):
+        # handler 在例外時沒呼叫 close()，在這裡補歸還，避免池被漏光
+        if self.__dict__.get("_raw") is not None:
+            with self._pool._lock:
+                self._pool._leaked += 1
+            self.close()
+
+
+class InstrumentedCursor:
+    """包裝 pymysql cursor，記錄每個 SQL 的耗時與讀出的列數（見 Metrics）"""
+
+    def __init__(self, cur):
+        self._cur = cur
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def execute(self, query, args=None):
+        t0 = time.perf_counter()
+        try:
+            return self._cur.execute(query, args)
+        finally:
+            observe_query(query, args, time.perf_counter() - t0)
+
+    def executemany(self, query, args):
+        args = args if isinstance(args, (list, tuple)) else list(args)
+        t0 = time.perf_counter()
+        try:
+            return self._cur.executemany(query, args)
+        finally:
+            observe_query(query, args, time.perf_counter() - t0, many=True)
+
+    def fetchone(self):
+        row = self._cur.fetchone()
+        if row is not None:
+            count_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._cur.fetchmany(size) if size is not None else self._cur.fetchmany()
+        count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cur.fetchall()
+        count_rows(len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cur.close()
+
+
+class ConnectionPool:
+    """
+    有上限、會做健康檢查的 MySQL 連線池。
+    - 常駐 size 條，尖峰時最多再多開 max_overflow 條，多出來的歸還時直接關閉
+    - 連線超過 recycle 秒重建；閒置超過 ping_interval 秒，借出前先 ping
+    - 借不到連線時最多等 timeout 秒，逾時丟 DBUnavailable（不再 sleep 重試）
+    """
+
+    def __init__(self, size: int, max_overflow: int, timeout: float, recycle: int, ping_interval: int,
+                 host: str = DB_HOST, port: int = DB_PORT, user: str = DB_USER, password: str = DB_PASS):
+        self.host, self.port, self.user, self.password = host, port, user, password
+        self.size = max(1, size)
+        self.max_overflow = max(0, max_overflow)
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+        self._idle = collections.deque()  # (raw, created_at, last_used)
+        self._slots = threading.BoundedSemaphore(self.size + self.max_overflow)
+        # 可重入：GC 可能在持有鎖的執行緒裡觸發 PooledConnection.__del__，它也要取這把鎖
+        self._lock = threading.RLock()
+        self._checked_out = 0
+        self._created = 0
+        self._recycled = 0
+        self._discarded = 0
+        self._timeouts = 0
+        self._connect_errors = 0
+        self._leaked = 0
+        self._acquires = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _connect(self):
+        try:
+            raw = pymysql.connect(
+                host=self.host,
+                port=self.port,
+                user=self.user,
+                password=self.password,
                 database=DB_NAME,
                 cursorclass=pymysql.cursors.DictCursor,
                 autocommit=True,
+                connect_timeout=DB_CONNECT_TIMEOUT,
             )
+        except Exception as e:
+            with self._lock:
+                self._connect_errors += 1
+            raise DBUnavailable(f"無法連線到 MySQL {self.host}:{self.port}：{e}") from e
+        with self._lock:
+            self._created += 1
+        return raw, time.monotonic()
+
+    def _close_raw(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def _checkout_idle(self):
+        """從閒置佇列取出一條健康的連線；沒有則回傳 None"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                raw, created_at, last_used = self._idle.pop()  # LIFO：優先用最熱的連線
+            now = time.monotonic()
+            if self.recycle and now - created_at > self.recycle:
+                self._close_raw(raw)
+                with self._lock:
+                    self._recycled += 1
+                continue
+            if now - last_used > self.ping_interval:
+                try:
+                    raw.ping(reconnect=False)
+                except Exception:
+                    self._close_raw(raw)
+                    with self._lock:
+                        self._discarded += 1
+                    continue
+            return raw, created_at
+
+    def acquire(self, timeout: Optional[float] = None) -> PooledConnection:
+        t0 = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout if timeout is None else timeout):
+            with self._lock:
+                self._timeouts += 1
+            raise DBUnavailable("資料庫連線池已滿，請稍後再試")
+        try:
+            got = self._checkout_idle() or self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+        waited = time.monotonic() - t0
+        observe_acquire(waited)
+        with self._lock:
+            self._checked_out += 1
+            self._acquires += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return PooledConnection(self, *got)
+
+    @contextlib.contextmanager
+    def connection(self, timeout: Optional[float] = None):
+        conn = self.acquire(timeout)
+        with conn:
+            yield conn
+
+    def _release(self, raw, created_at: float, discard: bool = False):
+        # 沒有提交（rollback）的交易留下的標記不帶給下一個借用者
+        raw.__dict__.pop("_touched_tables", None)
+        raw.__dict__.pop("_changes_published", None)
+        try:
+            if not discard and raw.open:
+                # 還在交易中（例如 handler 自己 begin 卻沒 commit）就回滾，並恢復 autocommit
+                if raw.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+                    raw.rollback()
+                if not raw.get_autocommit():
+                    raw.autocommit(True)
+            else:
+                discard = True
+        except Exception:
+            discard = True
+        with self._lock:
+            self._checked_out -= 1
+            keep = not discard and len(self._idle) < self.size
+            if keep:
+                self._idle.append((raw, created_at, time.monotonic()))
+            elif discard:
+                self._discarded += 1
+        if not keep:
+            self._close_raw(raw)
+        self._slots.release()
+
+    def dispose(self):
+        """關閉所有閒置連線（借出中的連線歸還時會照常處理）"""
+        with self._lock:
+            idle, self._idle = list(self._idle), collections.deque()
+        for raw, _, _ in idle:
+            self._close_raw(raw)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": self.size,
+                "max_overflow": self.max_overflow,
+                "timeout": self.timeout,
+                "recycle": self.recycle,
+                "checked_out": self._checked_out,
+                "idle": len(self._idle),
+                "created": self._created,
+                "recycled": self._recycled,
+                "discarded": self._discarded,
+                "timeouts": self._timeouts,
+                "connect_errors": self._connect_errors,
+                "leaked": self._leaked,
+                "acquires": self._acquires,
+                "wait_avg_ms": round(self._wait_total / self._acquires * 1000, 3) if self._acquires else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+            }
+
+
+db_pool = ConnectionPool(
+    size=DB_POOL_SIZE,
+    max_overflow=DB_POOL_MAX_OVERFLOW,
+    timeout=DB_POOL_TIMEOUT,
+    recycle=DB_POOL_RECYCLE,
+    ping_interval=DB_POOL_PING_INTERVAL,
+)
+
+
+def get_db() -> PooledConnection:
+    """從連線池借一條 MySQL 連線（用完 close() 或 with 區塊結束即歸還）"""
+    return db_pool.acquire()
+
+
+# ---- 讀寫分離 ----
+# 寫入與一般查詢走 get_db()（primary）；報表、匯出、大量列表等唯讀查詢走 get_read_db()：
+#   - 每 DB_REPLICA_CHECK_INTERVAL 秒檢查 replica 的複寫狀態；複寫停止、延遲超過 DB_REPLICA_MAX_LAG 秒
+#     或連不上時，唯讀查詢自動改走 primary，恢復後再切回
+#   - read-your-writes：寫入成功的回應帶上 cookie，同一個用戶端在複寫追上之前（DB_REPLICA_MAX_LAG + 檢查間隔秒）
+#     的讀取都走 primary，看得到自己剛寫入的資料
+#   - ETag 依 table_versions 產生的列表（conditional_json）維持讀 primary：版本號與內容必須來自同一台
+_read_primary: contextvars.ContextVar[bool] = contextvars.ContextVar("read_primary", default=False)
+READ_YOUR_WRITES_COOKIE = "fs_rw"
+
+class ReplicaRouter:
+    def __init__(self, pool: Optional[ConnectionPool]):
+        self.pool = pool
+        self.healthy = False  # 第一次檢查通過前都讀 primary
+        self.lag: Optional[float] = None
+        self.reason = "尚未檢查" if pool else "未設定 DB_READ_HOST"
+        self.checked_at: Optional[float] = None
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.fallbacks = 0
+        self._task = None
+
+    def start(self):
+        if self.pool is not None:
+            self._task = PeriodicTask("replica-lag", DB_REPLICA_CHECK_INTERVAL, self.check)
+            self._task.start()
+
+    def stop(self):
+        if self._task:
+            self._task.stop()
+        if self.pool is not None:
+            self.pool.dispose()
+
+    def _set(self, healthy: bool, lag: Optional[float], reason: str):
+        if healthy != self.healthy:
+            print(f"{'✅' if healthy else '⚠️'} replica {'恢復使用' if healthy else '暫停使用'}：{reason}")
+        self.healthy, self.lag, self.reason, self.checked_at = healthy, lag, reason, time.time()
+        return {"healthy": healthy, "lag": lag, "reason": reason}
+
+    def check(self) -> Dict[str, Any]:
+        try:
+            with self.pool.connection(timeout=DB_CONNECT_TIMEOUT) as conn:
+                c = conn.cursor()
+                try:
+                    c.execute("SHOW REPLICA STATUS")
+                    keys = ("Replica_IO_Running", "Replica_SQL_Running", "Seconds_Behind_Source")
+                except pymysql.err.MySQLError:  # MySQL 8.0.22 以前
+                    c.execute("SHOW SLAVE STATUS")
+                    keys = ("Slave_IO_Running", "Slave_SQL_Running", "Seconds_Behind_Master")
+                row = c.fetchone()
+        except Exception as e:
+            return self._set(False, None, f"無法檢查複寫狀態：{e}")
+        if not row:
+            return self._set(False, None, "沒有複寫狀態（不是 replica）")
+        lag = row.get(keys[2])
+        lag = None if lag is None else float(lag)
+        if row.get(keys[0]) != "Yes" or row.get(keys[1]) != "Yes":
+            return self._set(False, lag, "複寫未在執行")
+        if lag is None or lag > DB_REPLICA_MAX_LAG:
+            return self._set(False, lag, f"複寫延遲 {lag if lag is not None else '未知'} 秒")
+        return self._set(True, lag, "ok")
+
+    def acquire(self) -> PooledConnection:
+        if self.pool is None or not self.healthy or _read_primary.get():
+            self.primary_reads += 1
+            return get_db()
+        try:
+            conn = self.pool.acquire()
+        except DBUnavailable as e:
+            self.fallbacks += 1
+            if e.__cause__ is not None:  # 連不上（不是池滿）：到下次檢查前都先讀 primary
+                self._set(False, self.lag, str(e))
+            return get_db()
+        self.replica_reads += 1
+        return conn
+
+    def stats(self) -> Dict[str, Any]:
+        return {"configured": self.pool is not None, "host": DB_READ_HOST or None, "healthy": self.healthy,
+                "lag": self.lag, "reason": self.reason, "checked_at": self.checked_at, "max_lag": DB_REPLICA_MAX_LAG,
+                "replica_reads": self.replica_reads, "primary_reads": self.primary_reads, "fallbacks": self.fallbacks,
+                "pool": self.pool.stats() if self.pool else None}
+
+read_router = ReplicaRouter(ConnectionPool(
+    size=DB_READ_POOL_SIZE,
+    max_overflow=DB_POOL_MAX_OVERFLOW,
+    timeout=DB_POOL_TIMEOUT,
+    recycle=DB_POOL_RECYCLE,
+    ping_interval=DB_POOL_PING_INTERVAL,
+    host=DB_READ_HOST, port=DB_READ_PORT, user=DB_READ_USER, password=DB_READ_PASS,
+) if DB_READ_HOST else None)
+
+
+def get_read_db() -> PooledConnection:
+    """唯讀查詢用的連線：replica 可用且此用戶端沒有剛寫入時連 replica，否則連 primary。不可用來寫入"""
+    return read_router.acquire()
+
+
+class ReadYourWritesMiddleware:
+    """寫入成功的回應設定 cookie 記下期限；期限內同一用戶端的 get_read_db() 都走 primary"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or read_router.pool is None:
+            return await self.app(scope, receive, send)
+        try:
+            until = float(Headers(scope=scope).get("cookie", "").partition(f"{READ_YOUR_WRITES_COOKIE}=")[2].split(";")[0])
+        except ValueError:
+            until = 0.0
+        token = _read_primary.set(until > time.time())
+        writing = scope["method"] in ("POST", "PUT", "PATCH", "DELETE")
+
+        async def send_wrapper(message):
+            if writing and message["type"] == "http.response.start" and message["status"] < 400:
+                window = DB_REPLICA_MAX_LAG + DB_REPLICA_CHECK_INTERVAL
+                MutableHeaders(scope=message).append(
+                    "Set-Cookie", f"{READ_YOUR_WRITES_COOKIE}={time.time() + window:.3f}; Max-Age={int(window) + 1}; "
+                                  "Path=/; HttpOnly; SameSite=Lax")
+            await send(message)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _read_primary.reset(token)
+
+app.add_middleware(ReadYourWritesMiddleware)
+
+
+def wait_for_db(retries: int = 10, interval: float = 2.0):
+    """啟動時等待 MySQL 就緒（容器剛起來時 DB 可能還沒好）；僅供啟動流程使用"""
+    for i in range(retries):
+        try:
+            conn = get_db()
+            conn.close()
             if i > 0:
                 print(f"✅ 已成功連線 MySQL（第 {i+1} 次嘗試）")
-            return conn
-        except Exception as e:
-            print(f"⚠️ 第 {i+1}/10 次連線 MySQL 失敗：{e}")
-            time.sleep(2)
-    raise Exception("❌ 無法連線到 MySQL，請確認容器是否正常啟動")
+            return
+        except DBUnavailable as e:
+            print(f"⚠️ 第 {i+1}/{retries} 次連線 MySQL 失敗：{e}")
+            time.sleep(interval)
+    raise DBUnavailable("❌ 無法連線到 MySQL，請確認容器是否正常啟動")
+
+
+@app.exception_handler(DBUnavailable)
+def db_unavailable_handler(request, exc: DBUnavailable):
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
+
+@app.get("/db/pool")
+def db_pool_stats():
+    return {**db_pool.stats(), "replica": read_router.stats()}
+
+@app.get("/healthz")
+def healthz():
+    """liveness：程序還能回應即可，不檢查 DB"""
+    return {"ok": True}
+
+@app.get("/readyz")
+def readyz():
+    """readiness：DB 可連線且 schema 已是最新版本才回 200，否則 503"""
+    checks: Dict[str, Any] = {"startup": "done" if startup_state["db_ready"] else (startup_state["error"] or "pending")}
+    ready = startup_state["db_ready"]
+    try:
+        with db_pool.connection(timeout=1) as conn:
+            c = conn.cursor()
+            c.execute("SELECT COALESCE(MAX(version), 0) AS v FROM schema_migrations")
+            version = int((c.fetchone() or {}).get("v", 0))
+        checks["db"] = "ok"
+        checks["schema"] = f"{version}/{latest_schema_version()}"
+        ready = ready and version >= latest_schema_version()
+    except Exception as e:
+        checks["db"] = str(e)
+        ready = False
+    return JSONResponse(status_code=200 if ready else 503, content={"ready": ready, "checks": checks})
 
 def hash_password(pw: str) -> str:
     return hashlib.sha256((pw or "").encode("utf-8")).hexdigest()
 
+# ---------- Schema Migrations ----------
+# 以版本號依序套用，已套用的版本記錄在 schema_migrations。
+# 新增結構變更時請加一個新的 @migration(下一號)，不要修改已發佈的 migration。
+MIGRATIONS: List[tuple] = []  # (version, name, fn(cursor))
+MIGRATION_LOCK = "fixture_suite_schema_migrate"
+
+def migration(version: int, name: str):
+    def deco(fn):
+        MIGRATIONS.append((version, name, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return deco
+
+def index_exists(c, table: str, index: str) -> bool:
+    c.execute("""SELECT 1 FROM information_schema.STATISTICS
+                 WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND INDEX_NAME=%s LIMIT 1""", (table, index))
+    return c.fetchone() is not None
+
+def column_exists(c, table: str, column: str) -> bool:
+    c.execute("""SELECT 1 FROM information_schema.COLUMNS
+                 WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND COLUMN_NAME=%s LIMIT 1""", (table, column))
+    return c.fetchone() is not None
+
+def add_index_online(c, table: str, index: str, columns: str, unique: bool = False):
+    """線上建立索引（INPLACE、不鎖表，建立期間仍可讀寫）；已存在則略過"""
+    if index_exists(c, table, index):
+        return
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    c.execute(f"ALTER TABLE {table} ADD {kind} {index} ({columns}), ALGORITHM=INPLACE, LOCK=NONE")
+    print(f"🧱 已建立索引 {table}.{index}")
+
+def current_schema_version(c) -> int:
+    c.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                     version INT PRIMARY KEY,
+                     name VARCHAR(255),
+                     applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""")
+    c.execute("SELECT COALESCE(MAX(version), 0) AS v FROM schema_migrations")
+    return int((c.fetchone() or {}).get("v", 0))
+
+def latest_schema_version() -> int:
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+def run_migrations(target: Optional[int] = None) -> List[int]:
+    """
+    套用尚未執行的 migration，回傳本次套用的版本號。
+    以 MySQL GET_LOCK 互斥，多個 worker 同時啟動時只有一個會實際執行。
+    """
+    applied = []
+    conn = get_db(); c = conn.cursor()
+    try:
+        c.execute("SELECT GET_LOCK(%s, 120) AS ok", (MIGRATION_LOCK,))
+        if not (c.fetchone() or {}).get("ok"):
+            raise RuntimeError("等待 schema migration 鎖逾時")
+        try:
+            current = current_schema_version(c)
+            for version, name, fn in MIGRATIONS:
+                if version <= current or (target is not None and version > target):
+                    continue
+                print(f"⏫ 套用 migration {version:04d}_{name}")
+                fn(c)
+                c.execute("INSERT INTO schema_migrations (version, name) VALUES (%s,%s)", (version, name))
+                conn.commit()
+                applied.append(version)
+        finally:
+            c.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK,))
+    finally:
+        conn.close()
+    return applied
+
 def init_tables():
-    conn = get_db()
-    c = conn.cursor()
+    """建立/升級資料表到最新版本"""
+    return run_migrations()
 
+@migration(1, "base_tables")
+def _m0001_base_tables(c):
     # users
     c.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -254,23 +877,986 @@ def init_tables():
             ("admin", hash_password("admin"), "admin"),
         )
 
-    conn.commit()
-    conn.close()
+@migration(2, "hot_query_indexes")
+def _m0002_hot_query_indexes(c):
+    add_index_online(c, "usage_logs", "idx_usage_fixture_used", "fixture_id, used_at")
+    add_index_online(c, "usage_logs", "idx_usage_used_at", "used_at")
+    add_index_online(c, "replacement_logs", "idx_replacement_fixture", "fixture_id, replacement_date")
+    add_index_online(c, "receipts", "idx_receipts_fixture_code", "fixture_code")
+    add_index_online(c, "returns_table", "idx_returns_fixture_code", "fixture_code")
+    add_index_online(c, "fixture_requirements", "idx_req_model_station", "model_code, station")
+    add_index_online(c, "fixtures", "idx_fixtures_name", "name")
+    add_index_online(c, "logs", "idx_logs_created_at", "created_at")
+    add_index_online(c, "logs", "idx_logs_fixture", "fixture")
 
-# 啟動時自動建立資料表
-try:
-    init_tables()
-    print("✅ 資料表初始化完成")
-except Exception as e:
-    print("⚠️ 初始化資料表失敗:", e)
+@migration(3, "unique_model_codes")
+def _m0003_unique_model_codes(c):
+    # 舊版匯入每次都新增一份，先去重（保留最新一筆）再建唯一索引，之後匯入改為依 code upsert
+    for table in ("fixture_models", "machine_models"):
+        c.execute(f"""DELETE t1 FROM {table} t1 JOIN {table} t2
+                      ON t1.code = t2.code AND t1.id < t2.id""")
+        add_index_online(c, table, f"uniq_{table}_code", "code", unique=True)
+
+@migration(4, "fixture_serials")
+def _m0004_fixture_serials(c):
+    # 收/退料序號正規化：每個 (治具編號, 序號) 一列，記錄目前狀態與最後一次收/退料單
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS fixture_serials (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            fixture_code VARCHAR(255) NOT NULL,
+            serial VARCHAR(255) NOT NULL,
+            state VARCHAR(20) NOT NULL,
+            receipt_id INT NULL,
+            return_id INT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            UNIQUE KEY uniq_fixture_serial (fixture_code, serial),
+            KEY idx_serial (serial),
+            KEY idx_serial_receipt (receipt_id),
+            KEY idx_serial_return (return_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+
+@migration(5, "table_versions")
+def _m0005_table_versions(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS table_versions (
+            table_name VARCHAR(64) PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+
+@migration(6, "usage_rollups")
+def _m0006_usage_rollups(c):
+    # 使用記錄彙總：每個 (治具, 時段, 站別) 一列；未填站別記為 0（主鍵欄位不可為 NULL）
+    for table, bucket_type in (("usage_rollup_hourly", "DATETIME"), ("usage_rollup_daily", "DATE")):
+        c.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                fixture_id VARCHAR(50) NOT NULL,
+                bucket {bucket_type} NOT NULL,
+                station_id INT NOT NULL DEFAULT 0,
+                events INT NOT NULL DEFAULT 0,
+                use_count BIGINT NOT NULL DEFAULT 0,
+                abnormal_count INT NOT NULL DEFAULT 0,
+                PRIMARY KEY (fixture_id, bucket, station_id),
+                KEY idx_{table}_bucket (bucket)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """)
+
+@migration(7, "idempotency_keys")
+def _m0007_idempotency_keys(c):
+    # 批次寫入的冪等鍵：同一個 (scope, key) 只會寫入一次，重送時回傳第一次的結果
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            scope VARCHAR(50) NOT NULL,
+            idem_key VARCHAR(128) NOT NULL,
+            request_hash CHAR(64) NOT NULL,
+            result TEXT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (scope, idem_key),
+            KEY idx_idem_created (created_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
 
+@migration(8, "change_events")
+def _m0008_change_events(c):
+    # 即時異動通知：seq 由 AUTO_INCREMENT 產生，所有 worker 共用同一個遞增序號
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS change_events (
+            seq BIGINT AUTO_INCREMENT PRIMARY KEY,
+            table_name VARCHAR(64) NOT NULL,
+            op VARCHAR(16) NOT NULL,
+            row_id VARCHAR(100) NULL,
+            fields TEXT NULL,
+            created_at TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+            KEY idx_change_created (created_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+
+@migration(9, "fixture_inventory")
+def _m0009_fixture_inventory(c):
+    # 庫存帳：每個治具編號一列；fixture_code 用 binary collation，與收退料單上的代碼逐字相同才算同一治具
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS fixture_inventory (
+            fixture_code VARCHAR(255) COLLATE utf8mb4_bin PRIMARY KEY,
+            received_qty INT NOT NULL DEFAULT 0,
+            returned_qty INT NOT NULL DEFAULT 0,
+            on_hand INT AS (received_qty - returned_qty) STORED,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+    # 由既有收退料單建立期初數量
+    totals, _ = inventory_totals(c, with_quantity=False)  # quantity 欄位在 schema 13 才加入
+    rows = [(code, r, t) for code, (r, t) in totals.items()]
+    for i in range(0, len(rows), 1000):
+        c.executemany("INSERT INTO fixture_inventory (fixture_code, received_qty, returned_qty) VALUES (%s,%s,%s)",
+                      rows[i:i + 1000])
+
+@migration(10, "jobs")
+def _m0010_jobs(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id CHAR(32) PRIMARY KEY,
+            kind VARCHAR(50) NOT NULL,
+            status VARCHAR(16) NOT NULL,
+            params TEXT NULL,
+            progress FLOAT NOT NULL DEFAULT 0,
+            message VARCHAR(255) NULL,
+            result MEDIUMTEXT NULL,
+            error TEXT NULL,
+            cancel_requested TINYINT NOT NULL DEFAULT 0,
+            worker VARCHAR(100) NULL,
+            created_by VARCHAR(100) NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP NULL,
+            finished_at TIMESTAMP NULL,
+            heartbeat_at TIMESTAMP NULL,
+            KEY idx_jobs_status (status, heartbeat_at),
+            KEY idx_jobs_created (created_at),
+            KEY idx_jobs_finished (finished_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """)
+
+@migration(11, "timeline_indexes")
+def _m0011_timeline_indexes(c):
+    # 治具履歷依 (治具, 時間) 取範圍；取代只有治具欄位的索引（新索引的前綴一樣可用）
+    for table, col, old in (("receipts", "fixture_code", "idx_receipts_fixture_code"),
+                            ("returns_table", "fixture_code", "idx_returns_fixture_code"),
+                            ("logs", "fixture", "idx_logs_fixture")):
+        add_index_online(c, table, f"idx_{table}_fixture_time", f"{col}, created_at")
+        if index_exists(c, table, old):
+            c.execute(f"ALTER TABLE {table} DROP INDEX {old}, ALGORITHM=INPLACE, LOCK=NONE")
+
+@migration(12, "bulk_tokens")
+def _m0012_bulk_tokens(c):
+    # 批次寫入以 bulk_token 查回這一批的 id（auto_increment_increment > 1 或 interleaved 取號時 id 不一定連續）
+    for table in BULK_TABLES:
+        if not column_exists(c, table, "bulk_token"):
+            c.execute(f"ALTER TABLE {table} ADD COLUMN bulk_token CHAR(32) NULL, ALGORITHM=INSTANT")
+        add_index_online(c, table, f"idx_{table}_bulk_token", "bulk_token")
+
+@migration(13, "material_quantity")
+def _m0013_material_quantity(c):
+    # 沒有序號的收/退料單以單據上的數量計入庫存（NULL 表示依展開後的序號數）
+    for table in ("receipts", "returns_table"):
+        if not column_exists(c, table, "quantity"):
+            c.execute(f"ALTER TABLE {table} ADD COLUMN quantity INT NULL AFTER serials, ALGORITHM=INSTANT")
+
+
+# ---------- Cache ----------
+class CachedValue:
+    """
+    程序內快取單一計算結果：TTL 到期或被 invalidate() 後，下一次 get() 才重新計算。
+    同時只會有一個執行緒計算，其他請求等它算完直接共用結果。
+    """
+
+    def __init__(self, loader, ttl: float):
+        self.loader = loader
+        self.ttl = ttl
+        self._value = None
+        self._expires = 0.0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self):
+        if time.monotonic() < self._expires:
+            self.hits += 1
+            return self._value
+        with self._lock:
+            if time.monotonic() < self._expires:
+                self.hits += 1
+                return self._value
+            self.misses += 1
+            gen = self._generation
+            value = self.loader()
+            self._value = value
+            # 計算期間若被 invalidate，結果可能已過時：這次照用，但不快取
+            self._expires = time.monotonic() + self.ttl if gen == self._generation else 0.0
+            return value
+
+    def invalidate(self):
+        self._generation += 1
+        self._expires = 0.0
+
+# ---------- Background Tasks ----------
+class PeriodicTask:
+    """背景執行緒每 interval 秒呼叫 fn 一次；例外只記錄不中斷，stop() 等目前這次執行完"""
+
+    def __init__(self, name: str, interval: float, fn):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.last_run: Optional[float] = None
+        self.last_result: Any = None
+        self.last_error: Optional[str] = None
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 30):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        # 啟動後先等一個短暫間隔，避免與 migration / 其他初始化搶資源
+        while not self._stopping.wait(min(self.interval, 60) if self.last_run is None else self.interval):
+            self.run_once()
+
+    def run_once(self):
+        try:
+            self.last_result = self.fn()
+            self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"⚠️ 背景工作 {self.name} 失敗:", e)
+        finally:
+            self.last_run = time.time()
+        return self.last_result
+
+    def stats(self) -> Dict[str, Any]:
+        return {"name": self.name, "interval": self.interval, "running": bool(self._thread and self._thread.is_alive()),
+                "last_run": datetime.fromtimestamp(self.last_run).isoformat() if self.last_run else None,
+                "last_error": self.last_error, "last_result": self.last_result}
+
+# ---------- Fast JSON ----------
+# 列表回傳的是 DB 查出的 dict，內容可信，不需要再經 response_model 驗證與 jsonable_encoder；
+# 直接以 orjson（未安裝時退回標準 json）編碼，輸出格式與 jsonable_encoder 一致。
+def _json_default(v):
+    if isinstance(v, Decimal):
+        return int(v) if v == v.to_integral_value() else float(v)
+    if isinstance(v, timedelta):
+        return v.total_seconds()
+    if isinstance(v, (datetime, date)):
+        return v.isoformat()
+    if isinstance(v, bytes):
+        return v.decode("utf-8", "replace")
+    if isinstance(v, (set, frozenset)):
+        return list(v)
+    raise TypeError(f"Object of type {type(v).__name__} is not JSON serializable")
+
+def dumps_json(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_json_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps_json(content)
+
+# layout=columns：{"columns": [...], "rows": [[...], ...]}，不重複每列的欄位名稱
+Layout = Query("rows", pattern="^(rows|columns)$")
+
+def shape_page(page: Dict[str, Any], layout: str = "rows") -> Dict[str, Any]:
+    if layout != "columns":
+        return page
+    rows = page.get("data") or []
+    out = {k: v for k, v in page.items() if k != "data"}
+    out["columns"] = list(rows[0].keys()) if rows else []
+    out["rows"] = [tuple(r.values()) for r in rows]  # 同一個 cursor 的列，欄位順序相同
+    return out
+
+# ---------- Table Versions / Conditional GET ----------
+# 每張主檔資料表有一個遞增版本號（table_versions），寫入時在同一個交易內 +1。
+# GET 時只需讀版本號就能產生 ETag / Last-Modified，未變更直接回 304，不必查資料列。
+TABLE_VERSION_TTL = float(os.getenv("TABLE_VERSION_TTL", "1"))  # 版本號在程序內的快取秒數
+_table_versions: Dict[str, tuple] = {}  # table -> (version, modified_epoch, fetched_monotonic)
+_table_version_gens: Dict[str, int] = collections.defaultdict(int)  # 每次提交異動 +1，讀取期間有變就不快取
+_table_versions_lock = threading.Lock()
+
+def touch_tables(c, *tables: str):
+    """
+    資料表內容有異動時呼叫（在寫入的同一個交易內）。
+    程序內快取在提交後才失效（PooledConnection.commit()）：提交前失效的話，並行的讀取會讀到舊版本號再快取 TTL 秒。
+    """
+    c.executemany("""INSERT INTO table_versions (table_name, version) VALUES (%s, 1)
+                     ON DUPLICATE KEY UPDATE version=version+1, updated_at=NOW(6)""", [(t,) for t in tables])
+    raw = c.connection
+    raw._touched_tables = getattr(raw, "_touched_tables", set()) | set(tables)
+
+def invalidate_table_versions(tables):
+    with _table_versions_lock:
+        for t in tables:
+            _table_version_gens[t] += 1
+            _table_versions.pop(t, None)
+
+def get_table_versions(tables: List[str]) -> Dict[str, tuple]:
+    now = time.monotonic()
+    with _table_versions_lock:
+        cached = {t: _table_versions[t] for t in tables
+                  if t in _table_versions and now - _table_versions[t][2] <= TABLE_VERSION_TTL}
+        gens = {t: _table_version_gens[t] for t in tables if t not in cached}
+    if gens:
+        stale = list(gens)
+        conn = get_db(); c = conn.cursor()
+        try:
+            c.execute(f"""SELECT table_name, version, UNIX_TIMESTAMP(updated_at) AS ts FROM table_versions
+                          WHERE table_name IN ({', '.join(['%s'] * len(stale))})""", stale)
+            rows = {r["table_name"]: r for r in c.fetchall() or []}
+        finally:
+            conn.close()
+        with _table_versions_lock:
+            for t in stale:
+                r = rows.get(t)
+                cached[t] = (int(r["version"]), float(r["ts"] or 0), now) if r else (0, 0.0, now)
+                if _table_version_gens[t] == gens[t]:  # 讀取期間有異動提交：這次的結果可能是舊的，不快取
+                    _table_versions[t] = cached[t]
+    return {t: cached[t] for t in tables}
+
+def etag_matches(request: Request, etag: str) -> bool:
+    # 壓縮後的回應 ETag 會加上 -gzip / -br，比對時去掉
+    for tag in request.headers.get("if-none-match", "").split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        for suffix in ('-gzip"', '-br"'):
+            if tag.endswith(suffix):
+                tag = tag[:-len(suffix)] + '"'
+        if tag == etag:
+            return True
+    return False
+
+def conditional_json(request: Request, tables: List[str], build) -> Response:
+    """
+    依資料表版本回應條件式 GET：ETag 由路徑、查詢參數與版本號組成，
+    命中 If-None-Match（或沒有 ETag 時命中 If-Modified-Since）回 304，否則才呼叫 build() 查資料。
+    """
+    versions = get_table_versions(tables)
+    key = "|".join([request.url.path, str(sorted(request.query_params.multi_items()))] +
+                   [f"{t}:{versions[t][0]}" for t in tables])
+    etag = '"' + hashlib.sha1(key.encode("utf-8")).hexdigest() + '"'
+    modified = max(v[1] for v in versions.values()) if versions else 0.0
+    headers = {"ETag": etag}
+    if modified:
+        headers["Last-Modified"] = formatdate(modified, usegmt=True)
+    if "if-none-match" in request.headers:
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+    elif modified and "if-modified-since" in request.headers:
+        try:
+            if int(modified) <= parsedate_to_datetime(request.headers["if-modified-since"]).timestamp():
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+    return FastJSONResponse(build(), headers=headers)
+
+# ---------- Change Feed (即時異動通知) ----------
+# 寫入 handler 在同一個交易內呼叫 publish_change(c, table, op, row_id, fields)，寫一筆 change_events；
+# seq 為 AUTO_INCREMENT，所有 worker 共用同一個遞增序號。
+# 每個程序一個 poller 執行緒把新事件讀進記憶體緩衝並喚醒 SSE 連線（本程序的寫入提交後立即讀取，不等輪詢）。
+# 並行交易的提交順序可能與 seq 不同：poller 只推進到連續的 seq，遇到缺號最多等 CHANGES_GAP_WAIT 秒
+# （逾時多半是 rollback 留下的永久缺號），因此用戶端收到的 seq 必定遞增，以最後一個 seq 續傳。
+# 跳過的 seq 會記住 CHANGES_LATE_WINDOW 秒並定期重查：交易提交得比 CHANGES_GAP_WAIT 還晚時，該事件本身
+# 不再送出（用戶端已越過它），改為發一筆該表的 reload 事件（row_id 為 "late:<seq>"，多個 worker 只會寫一筆），
+# 用戶端重載該表即可取得最新狀態。保證：晚於 CHANGES_LATE_WINDOW 才提交的事件才可能遺漏。
+#   GET /changes?since=<seq>          補抓 seq 之後的事件（斷線重連、或不用 SSE 的用戶端）
+#   GET /changes/stream?since=<seq>   SSE；瀏覽器斷線重連時自動帶 Last-Event-ID 續傳
+# since 早於保留範圍（CHANGES_RETENTION_HOURS）時回 reset，用戶端需重新載入完整列表。
+# op：insert / update / delete / upsert（以 code 為鍵的主檔）；reload 表示大量異動（匯入、歸檔），整張表需重載。
+CHANGES_ENABLED = os.getenv("CHANGES_ENABLED", "1") == "1"
+CHANGES_POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", "0.5"))
+CHANGES_GAP_WAIT = float(os.getenv("CHANGES_GAP_WAIT", "2"))
+CHANGES_LATE_WINDOW = float(os.getenv("CHANGES_LATE_WINDOW", "3600"))  # 跳過的 seq 持續重查的秒數
+CHANGES_BUFFER = int(os.getenv("CHANGES_BUFFER", "10000"))           # 程序內保留的最近事件數
+CHANGES_RETENTION_HOURS = int(os.getenv("CHANGES_RETENTION_HOURS", "24"))
+CHANGES_HEARTBEAT = float(os.getenv("CHANGES_HEARTBEAT", "15"))      # SSE 閒置時送註解行的間隔，避免被 proxy 斷線
+CHANGES_MAX_STREAMS = int(os.getenv("CHANGES_MAX_STREAMS", "500"))  # 每個 worker 的 SSE 連線上限
+CHANGES_PAGE_MAX = 1000
+
+def publish_change(c, table: str, op: str, row_id=None, fields: Optional[Dict[str, Any]] = None):
+    publish_changes(c, [(table, op, row_id, fields)])
+
+def publish_changes(c, events: List[tuple]):
+    """events: [(table, op, row_id, fields)]；在寫入的同一個交易內呼叫，rollback 時事件一併撤銷"""
+    if not events:
+        return
+    c.executemany("INSERT INTO change_events (table_name, op, row_id, fields) VALUES (%s,%s,%s,%s)",
+                  [(t, op, None if rid is None else str(rid), None if f is None else dumps_json(f).decode("utf-8"))
+                   for t, op, rid, f in events])
+    c.connection._changes_published = True  # PooledConnection.commit() 看到後通知 change_feed
+
+def _change_event(r: Dict[str, Any]) -> Dict[str, Any]:
+    return {"seq": int(r["seq"]), "table": r["table_name"], "op": r["op"], "id": r["row_id"],
+            "fields": json.loads(r["fields"]) if r["fields"] else None, "at": r["created_at"]}
+
+class ChangeFeed:
+    def __init__(self, poll_interval: float, buffer_size: int):
+        self.poll_interval = poll_interval
+        self.buffer_size = buffer_size
+        self.watermark: Optional[int] = None  # 已確認連續、可送出的最後一個 seq；None 表示尚未連上 DB
+        self._events: List[Dict[str, Any]] = []  # seq 遞增
+        self._gap: Optional[tuple] = None        # (缺號的 seq, 第一次發現的 monotonic)
+        self._skipped: Dict[int, float] = {}     # 逾時跳過的 seq -> 跳過時的 monotonic，之後定期重查
+        self._rescanned_at = 0.0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._waiters: set = set()  # (event loop, asyncio.Event)
+        self._listeners: List[Any] = []  # poller 讀到新事件時依 seq 順序呼叫 fn(events)
+        self._purged_at = 0.0
+        self.streams = 0
+        self.delivered = 0
+        self.gaps_skipped = 0
+        self.late_events = 0
+        self.last_error: Optional[str] = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="change-feed", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        self._stopping.set(); self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self._thread and self._thread.is_alive())
+
+    def on_change(self, fn):
+        self._listeners.append(fn)
+
+    def poke(self):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            if self._stopping.is_set() or not startup_state["db_ready"]:
+                continue
+            try:
+                while self.poll() >= CHANGES_PAGE_MAX:
+                    pass  # 一次讀不完（例如 DB 恢復連線後）就接著讀
+                self._purge()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+
+    def poll(self) -> int:
+        """讀取 watermark 之後的事件放進緩衝，回傳這次推進的筆數"""
+        conn = get_db(); c = conn.cursor()
+        try:
+            if self.watermark is None:
+                c.execute("SELECT COALESCE(MAX(seq), 0) AS seq FROM change_events")
+                self.watermark = int(c.fetchone()["seq"])
+                self._notify()
+                return 0
+            self._rescan_skipped(c)
+            c.execute("""SELECT seq, table_name, op, row_id, fields, created_at FROM change_events
+                         WHERE seq > %s ORDER BY seq LIMIT %s""", (self.watermark, CHANGES_PAGE_MAX))
+            rows = c.fetchall() or []
+        finally:
+            conn.close()
+        accepted = []
+        expected = self.watermark + 1
+        for r in rows:
+            seq = int(r["seq"])
+            if seq != expected:
+                # 缺號：較早取得 seq 的交易可能還沒提交，先等；逾時就跳過
+                if self._gap is None or self._gap[0] != expected:
+                    self._gap = (expected, time.monotonic())
+                if time.monotonic() - self._gap[1] < CHANGES_GAP_WAIT:
+                    break
+                self.gaps_skipped += 1
+                now = time.monotonic()
+                for s in range(expected, min(seq, expected + CHANGES_PAGE_MAX)):  # 大量缺號（auto-inc 跳號）只記前段
+                    self._skipped[s] = now
+            self._gap = None
+            accepted.append(_change_event(r))
+            expected = seq + 1
+        if accepted:
+            with self._lock:
+                self._events.extend(accepted)
+                if len(self._events) > self.buffer_size * 2:
+                    del self._events[:-self.buffer_size]
+                self.watermark = accepted[-1]["seq"]
+            self.delivered += len(accepted)
+            self._notify()
+            for fn in self._listeners:
+                try:
+                    fn(accepted)
+                except Exception as e:
+                    print("⚠️ change feed listener 失敗:", e)
+        return len(accepted)
+
+    def _rescan_skipped(self, c):
+        """重查先前跳過的 seq；晚到的事件改發該表的 reload（見上方說明）"""
+        now = time.monotonic()
+        if not self._skipped or now - self._rescanned_at < CHANGES_GAP_WAIT:
+            return
+        self._rescanned_at = now
+        for s in [s for s, at in self._skipped.items() if now - at > CHANGES_LATE_WINDOW]:
+            del self._skipped[s]
+        seqs = sorted(self._skipped)[:CHANGES_PAGE_MAX]
+        if not seqs:
+            return
+        c.execute(f"SELECT seq, table_name FROM change_events WHERE seq IN ({', '.join(['%s'] * len(seqs))})", seqs)
+        late = {}
+        for r in c.fetchall() or []:
+            self._skipped.pop(int(r["seq"]), None)
+            late.setdefault(r["table_name"], int(r["seq"]))
+        for table, seq in late.items():
+            # 每個 worker 都會發現同一個晚到的 seq：以 row_id 去重，只寫一筆 reload
+            row_id = f"late:{seq}"
+            c.execute("""INSERT INTO change_events (table_name, op, row_id, fields)
+                         SELECT %s, 'reload', %s, %s FROM DUAL
+                         WHERE NOT EXISTS (SELECT 1 FROM change_events WHERE table_name=%s AND op='reload' AND row_id=%s)""",
+                      (table, row_id, dumps_json({"late_seq": seq}).decode("utf-8"), table, row_id))
+            self.late_events += 1
+
+    def _purge(self):
+        if time.monotonic() - self._purged_at < 600:
+            return
+        self._purged_at = time.monotonic()
+        conn = get_db(); c = conn.cursor()
+        try:
+            c.execute("DELETE FROM change_events WHERE created_at < NOW() - INTERVAL %s HOUR LIMIT 10000",
+                      (CHANGES_RETENTION_HOURS,))
+        finally:
+            conn.close()
+
+    def _notify(self):
+        with self._lock:
+            waiters = list(self._waiters)
+        for loop, ev in waiters:
+            try:
+                loop.call_soon_threadsafe(ev.set)
+            except RuntimeError:
+                pass  # event loop 已關閉
+
+    async def wait(self, after: int, timeout: float) -> bool:
+        """等到有 seq > after 的事件（回傳 True）或逾時（回傳 False）"""
+        ev = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), ev)
+        with self._lock:
+            self._waiters.add(waiter)
+        try:
+            if self.watermark is not None and self.watermark > after:
+                return True
+            try:
+                await asyncio.wait_for(ev.wait(), timeout)
+                return True
+            except asyncio.TimeoutError:
+                return False
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+    @staticmethod
+    def _page(events, since: int, end: int, limit: int, tables: Optional[set]) -> Dict[str, Any]:
+        # last_seq 會跨過被 tables 過濾掉的事件，用戶端以它續傳即可
+        out = []
+        for e in events:
+            if tables is None or e["table"] in tables:
+                out.append(e)
+                if len(out) >= limit:
+                    return {"events": out, "last_seq": e["seq"], "reset": False}
+        return {"events": out, "last_seq": max(since, end), "reset": False}
+
+    def read_buffer(self, since: int, limit: int, tables: Optional[set] = None) -> Optional[Dict[str, Any]]:
+        """由記憶體緩衝回傳 seq > since 的事件；緩衝沒涵蓋 since 時回傳 None（改用 read() 查 DB）"""
+        with self._lock:
+            wm = self.watermark
+            if wm is None or since > wm:
+                return None
+            events = self._events
+            if since < (events[0]["seq"] - 1 if events else wm):
+                return None
+            i = bisect.bisect_right(events, since, key=lambda e: e["seq"])
+            return self._page(itertools.islice(events, i, None), since, wm, limit, tables)
+
+    def read(self, since: int, limit: int, tables: Optional[set] = None) -> Dict[str, Any]:
+        page = self.read_buffer(since, limit, tables)
+        if page is not None:
+            return page
+        wm = self.watermark
+        if wm is None:
+            raise HTTPException(status_code=503, detail="change feed 尚未就緒")
+        conn = get_db(); c = conn.cursor()
+        try:
+            c.execute("SELECT MIN(seq) AS lo, MAX(seq) AS hi FROM change_events")
+            r = c.fetchone() or {}
+            lo, hi = r.get("lo"), r.get("hi") or 0
+            if since > wm:
+                # 其他 worker 已送出、本程序尚未讀到：稍後再來；比 DB 最大值還大則是 DB 被重建過
+                return {"events": [], "last_seq": since, "reset": since > hi}
+            if since < (lo - 1 if lo is not None else wm):
+                return {"events": [], "last_seq": wm, "reset": True}  # 已超出保留範圍
+            where, params = "seq > %s AND seq <= %s", [since, wm]
+            if tables is not None:
+                where += f" AND table_name IN ({', '.join(['%s'] * len(tables))})"
+                params += sorted(tables)
+            c.execute(f"""SELECT seq, table_name, op, row_id, fields, created_at FROM change_events
+                          WHERE {where} ORDER BY seq LIMIT %s""", params + [limit])
+            events = [_change_event(r) for r in c.fetchall() or []]
+        finally:
+            conn.close()
+        if len(events) >= limit:
+            return {"events": events, "last_seq": events[-1]["seq"], "reset": False}
+        return {"events": events, "last_seq": wm, "reset": False}
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": CHANGES_ENABLED, "running": self.running,
+                "last_seq": self.watermark, "buffered": len(self._events), "streams": self.streams,
+                "delivered": self.delivered, "gaps_skipped": self.gaps_skipped,
+                "pending_gaps": len(self._skipped), "late_events": self.late_events, "last_error": self.last_error}
+
+change_feed = ChangeFeed(CHANGES_POLL_INTERVAL, CHANGES_BUFFER)
+
+def _parse_tables(tables: Optional[str]) -> Optional[set]:
+    names = {t.strip() for t in (tables or "").split(",") if t.strip()}
+    return names or None
+
+@app.get("/changes")
+def list_changes(since: Optional[int] = Query(None, ge=0), tables: Optional[str] = None,
+                 limit: int = Query(500, ge=1, le=CHANGES_PAGE_MAX)):
+    """
+    since 省略時只回傳目前的 last_seq：用戶端先記下它再載入完整列表，之後從這裡續傳。
+    回傳 {events, last_seq, reset}；events 未滿 limit 表示已追上，下一次以 last_seq 當 since。
+    """
+    if change_feed.watermark is None:
+        raise HTTPException(status_code=503, detail="change feed 尚未就緒")
+    if since is None:
+        return {"events": [], "last_seq": change_feed.watermark, "reset": False}
+    return FastJSONResponse(change_feed.read(since, limit, _parse_tables(tables)))
+
+@app.get("/changes/stats")
+def change_feed_stats():
+    return change_feed.stats()
+
+def _sse(event: str, data: Any, seq: Optional[int] = None) -> str:
+    head = f"id: {seq}\n" if seq is not None else ""
+    return f"{head}event: {event}\ndata: {dumps_json(data).decode('utf-8')}\n\n"
+
+async def _change_stream(since: int, tables: Optional[set]):
+    change_feed.streams += 1
+    try:
+        yield "retry: 3000\n" + _sse("hello", {"last_seq": since}, since)
+        last = since
+        while True:
+            page = change_feed.read_buffer(last, CHANGES_PAGE_MAX, tables)
+            if page is None:  # 落後超過緩衝範圍（或其他 worker 較新），改查 DB
+                page = await run_in_threadpool(change_feed.read, last, CHANGES_PAGE_MAX, tables)
+            if page["reset"]:
+                last = change_feed.watermark or 0
+                yield _sse("reset", {"last_seq": last}, last)
+                continue
+            for e in page["events"]:
+                yield _sse("change", e, e["seq"])
+            if page["last_seq"] != last and (not page["events"] or page["events"][-1]["seq"] != page["last_seq"]):
+                yield f"id: {page['last_seq']}\n\n"  # 只更新瀏覽器的 Last-Event-ID（略過被過濾的事件）
+            last = page["last_seq"]
+            if not await change_feed.wait(last, CHANGES_HEARTBEAT):
+                yield ": ping\n\n"
+    finally:
+        change_feed.streams -= 1
+
+@app.get("/changes/stream")
+async def stream_changes(request: Request, since: Optional[int] = Query(None, ge=0), tables: Optional[str] = None):
+    """SSE：event=change 的 data 為事件本身；reset 表示需重新載入完整列表；: ping 為心跳"""
+    if change_feed.watermark is None:
+        raise HTTPException(status_code=503, detail="change feed 尚未就緒")
+    if change_feed.streams >= CHANGES_MAX_STREAMS:
+        raise HTTPException(status_code=503, detail="即時連線數已達上限")
+    last_id = request.headers.get("last-event-id", "")
+    if last_id.isdigit():
+        since = int(last_id)  # 瀏覽器自動重連：以最後收到的 seq 為準
+    elif since is None:
+        since = change_feed.watermark
+    return StreamingResponse(_change_stream(since, _parse_tables(tables)), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ---------- HTTP Caching / Compression ----------
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+
+# 依路徑設定 Cache-Control（精確路徑優先，其次為前綴）；handler 自己設定的不覆蓋
+CACHE_CONTROL_POLICIES = {
+    "/fixtures": "private, no-cache",
+    "/fixtures/models": "private, no-cache",
+    "/machines/models": "private, no-cache",
+    "/settings/smtp": "private, no-cache",
+    "/dashboard": "private, no-cache",
+    "/inventory": "private, no-cache",
+}
+CACHE_CONTROL_PREFIXES = [
+    ("/app/", "no-cache"),
+    ("/uploads/", "public, max-age=86400"),
+]
+
+def cache_control_for(path: str) -> Optional[str]:
+    if path in CACHE_CONTROL_POLICIES:
+        return CACHE_CONTROL_POLICIES[path]
+    for prefix, policy in CACHE_CONTROL_PREFIXES:
+        if path.startswith(prefix):
+            return policy
+    return None
+
+class CacheControlMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            return await self.app(scope, receive, send)
+        policy = cache_control_for(scope["path"])
+        if not policy:
+            return await self.app(scope, receive, send)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                if "cache-control" not in headers:
+                    headers["Cache-Control"] = policy
+            await send(message)
+        await self.app(scope, receive, send_wrapper)
+
+class JSONCompressionMiddleware:
+    """
+    壓縮大於 minimum_size 的 JSON 回應：用戶端支援 br 且有安裝 brotli 時用 br，否則 gzip。
+    只處理一次送完的回應，串流回應（匯出）原樣通過。
+    """
+
+    def __init__(self, app, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        accept = Headers(scope=scope).get("accept-encoding", "")
+        tokens = {t.split(";")[0].strip().lower() for t in accept.split(",")}
+        encoding = "br" if brotli and "br" in tokens else "gzip" if "gzip" in tokens else None
+        if not encoding:
+            return await self.app(scope, receive, send)
+        start = None
+
+        async def send_wrapper(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] == "http.response.body" and start is not None:
+                headers = MutableHeaders(scope=start)
+                body = message.get("body", b"")
+                if (headers.get("content-type", "").startswith("application/json")
+                        and "content-encoding" not in headers
+                        and not message.get("more_body", False)):
+                    headers.add_vary_header("Accept-Encoding")
+                    if len(body) >= self.minimum_size:
+                        body = brotli.compress(body, quality=4) if encoding == "br" else gzip.compress(body, compresslevel=6)
+                        headers["Content-Encoding"] = encoding
+                        headers["Content-Length"] = str(len(body))
+                        etag = headers.get("etag")
+                        if etag and etag.endswith('"'):
+                            headers["ETag"] = etag[:-1] + f'-{encoding}"'
+                        message = {**message, "body": body}
+                await send(start)
+                start = None
+            await send(message)
+        await self.app(scope, receive, send_wrapper)
+
+app.add_middleware(JSONCompressionMiddleware, minimum_size=COMPRESS_MIN_SIZE)
+app.add_middleware(CacheControlMiddleware)
+
+# ---------- Metrics ----------
+# GET /metrics 以 Prometheus text 格式輸出：
+#   - 每個路由：請求延遲 histogram，SQL 數、DB 時間、取得連線等待時間、讀出列數（累計 counter）
+#   - 全域：SQL 延遲 histogram（依語句類型）、連線池與使用記錄緩衝的目前狀態
+# 請求內的 DB 統計以 contextvar 累計（sync handler 在 threadpool 執行時 context 會一起帶過去）；
+# 背景執行緒（使用記錄 flush、排程）的查詢只計入全域 histogram。
+# SLOW_QUERY_MS > 0 時，超過門檻的 SQL 連同參數記錄在 GET /metrics/slow_queries（保留最近 SLOW_QUERY_KEEP 筆）。
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "0"))
+SLOW_QUERY_KEEP = int(os.getenv("SLOW_QUERY_KEEP", "200"))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _label_str(names, values, **extra) -> str:
+    """{a="x",b="y"}；沒有 label 時回傳空字串"""
+    pairs = list(zip(names, values)) + list(extra.items())
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self._values: Dict[tuple, float] = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple, value: float = 1.0):
+        with self._lock:
+            self._values[labels] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"] + \
+               [f"{self.name}{_label_str(self.labelnames, k)} {v:g}" for k, v in items]
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames, self.buckets = name, help, labelnames, buckets
+        self._series: Dict[tuple, list] = {}  # labels -> [各 bucket 次數..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            if i < len(self.buckets):
+                s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, s in items:
+            cum = 0
+            for b, n in zip(self.buckets, s):
+                cum += n
+                lines.append(f"{self.name}_bucket{_label_str(self.labelnames, labels, le=f'{b:g}')} {cum}")
+            lines.append(f"{self.name}_bucket{_label_str(self.labelnames, labels, le='+Inf')} {s[-1]}")
+            lines.append(f"{self.name}_sum{_label_str(self.labelnames, labels)} {s[-2]:.6f}")
+            lines.append(f"{self.name}_count{_label_str(self.labelnames, labels)} {s[-1]}")
+        return lines
+
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency", ("method", "route", "status"))
+ROUTE_DB_QUERIES = Counter("http_request_db_queries_total", "SQL statements executed by requests", ("method", "route"))
+ROUTE_DB_SECONDS = Counter("http_request_db_seconds_total", "Time spent in SQL by requests", ("method", "route"))
+ROUTE_DB_ACQUIRE = Counter("http_request_db_acquire_seconds_total", "Time spent waiting for a pooled connection", ("method", "route"))
+ROUTE_DB_ROWS = Counter("http_request_db_rows_total", "Rows fetched from MySQL by requests", ("method", "route"))
+DB_QUERY_LATENCY = Histogram("db_query_duration_seconds", "SQL statement latency", ("op",))
+DB_ACQUIRE_LATENCY = Histogram("db_pool_acquire_seconds", "Connection pool acquire latency", ())
+METRICS = [HTTP_LATENCY, ROUTE_DB_QUERIES, ROUTE_DB_SECONDS, ROUTE_DB_ACQUIRE, ROUTE_DB_ROWS, DB_QUERY_LATENCY, DB_ACQUIRE_LATENCY]
+
+class RequestStats:
+    __slots__ = ("target", "queries", "db_seconds", "acquire_seconds", "rows")
+
+    def __init__(self, target: str):
+        self.target = target  # "GET /path"，慢查詢記錄用
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.acquire_seconds = 0.0
+        self.rows = 0
+
+_request_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("request_stats", default=None)
+slow_queries: collections.deque = collections.deque(maxlen=SLOW_QUERY_KEEP)
+
+def observe_query(sql: str, args, elapsed: float, many: bool = False):
+    op = (sql.lstrip().split(None, 1) or ["?"])[0].upper()
+    DB_QUERY_LATENCY.observe((op,), elapsed)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        params = f"{len(args)} rows, first={args[0]!r}" if many and args else repr(args)
+        entry = {"at": datetime.now().isoformat(timespec="milliseconds"), "ms": round(elapsed * 1000, 2),
+                 "request": stats.target if stats else "background",
+                 "sql": " ".join(str(sql).split())[:2000], "params": params[:500]}
+        slow_queries.append(entry)
+        print(f"🐢 慢查詢 {entry['ms']}ms [{entry['request']}] {entry['sql'][:300]} -- {entry['params'][:200]}")
+
+def observe_acquire(elapsed: float):
+    DB_ACQUIRE_LATENCY.observe((), elapsed)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.acquire_seconds += elapsed
+
+def count_rows(n: int):
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.rows += n
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats(f"{scope['method']} {scope['path']}")
+        token = _request_stats.set(stats)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - t0
+            _request_stats.reset(token)
+            # 用路由樣板（/fixtures/{fid}）當 label，避免每個 id 一條序列
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            labels = (scope["method"], route)
+            HTTP_LATENCY.observe(labels + (f"{status // 100}xx",), elapsed)
+            ROUTE_DB_QUERIES.inc(labels, stats.queries)
+            ROUTE_DB_SECONDS.inc(labels, stats.db_seconds)
+            ROUTE_DB_ACQUIRE.inc(labels, stats.acquire_seconds)
+            ROUTE_DB_ROWS.inc(labels, stats.rows)
+
+# 最後加入 = 最外層，延遲包含壓縮等其他 middleware 的時間
+app.add_middleware(MetricsMiddleware)
+
+def _gauge_lines(name: str, help: str, value) -> List[str]:
+    return [f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value:g}"]
+
+@app.get("/metrics")
+def metrics():
+    lines: List[str] = []
+    for m in METRICS:
+        lines += m.render()
+    pool = db_pool.stats()
+    lines += _gauge_lines("db_pool_checked_out", "Connections currently checked out", pool["checked_out"])
+    lines += _gauge_lines("db_pool_idle", "Idle pooled connections", pool["idle"])
+    lines += _gauge_lines("db_pool_timeouts_total", "Pool acquire timeouts", pool["timeouts"])
+    lines += _gauge_lines("db_pool_connect_errors_total", "Failed MySQL connects", pool["connect_errors"])
+    replica = read_router.stats()
+    if replica["configured"]:
+        lines += _gauge_lines("db_replica_healthy", "1 if read-only queries are routed to the replica", int(replica["healthy"]))
+        lines += _gauge_lines("db_replica_lag_seconds", "Replica lag at the last check (-1 if unknown)",
+                              replica["lag"] if replica["lag"] is not None else -1)
+        lines += _gauge_lines("db_replica_reads_total", "Read-only connections served by the replica", replica["replica_reads"])
+        lines += _gauge_lines("db_replica_fallbacks_total", "Read-only connections that fell back to the primary", replica["fallbacks"])
+    lines += _gauge_lines("usage_buffer_pending", "Usage log rows waiting to be flushed", usage_buffer.stats()["pending"])
+    lines += _gauge_lines("change_feed_streams", "Open change feed SSE connections", change_feed.streams)
+    lines += _gauge_lines("change_feed_last_seq", "Last change event sequence seen by this worker", change_feed.watermark or 0)
+    lines += _gauge_lines("jobs_active", "Background jobs queued or running in this worker", job_runner.stats()["active"])
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/metrics/slow_queries")
+def list_slow_queries(limit: int = Query(50, ge=1, le=1000)):
+    return {"threshold_ms": SLOW_QUERY_MS, "data": list(slow_queries)[-limit:][::-1]}
 
 # ---------- Schemas ----------
-class PageResp(BaseModel):
-    total: int
-    page: int
-    page_size: int
+class CursorPage(BaseModel):
     data: List[Dict[str, Any]]
+    next_cursor: Optional[str] = None
+    limit: int
+    total: Optional[int] = None
 
 class UserIn(BaseModel):
     username: str
@@ -292,6 +1878,7 @@ class ReceiptIn(BaseModel):
     serial_start: str = Field(default="")
     serial_end: str = Field(default="")
     serials: str = Field(default="")
+    quantity: Optional[int] = Field(default=None, ge=0)
     operator: str = Field(default="")
     note: Optional[str] = None
 
@@ -303,22 +1890,38 @@ class ReturnIn(BaseModel):
     serial_start: str = Field(default="")
     serial_end: str = Field(default="")
     serials: str = Field(default="")
+    quantity: Optional[int] = Field(default=None, ge=0)
     operator: str = Field(default="")
     note: Optional[str] = None
 
+class RequirementIn(BaseModel):
+    model_code: str
+    station: str
+    fixture_code: str
+    required_qty: int = Field(default=1, ge=0)
+
+class CapacityQuery(BaseModel):
+    model_codes: List[str]
+    what_if: Optional[Dict[str, int]] = None
+
+class SerialLookupIn(BaseModel):
+    serials: List[str]
+    fixture_code: Optional[str] = None
+
 class LogIn(BaseModel):
     fixture: str
     type: str
     note: Optional[str] = None
 
 class UsageLogIn(BaseModel):
-    fixture_id: str
-    serial_number: Optional[str] = None
-    station_id: Optional[int] = None
-    use_count: int = 1
-    abnormal_status: Optional[str] = None
-    note: Optional[str] = None
-    operator: Optional[str] = None
+    # 長度/範圍與 usage_logs 欄位一致：緩衝寫入時才失敗的話，站台已經收到 ok，錯誤無從回報
+    fixture_id: str = Field(min_length=1, max_length=50)
+    serial_number: Optional[str] = Field(default=None, max_length=100)
+    station_id: Optional[int] = Field(default=None, ge=-2147483648, le=2147483647)
+    use_count: int = Field(default=1, ge=0, le=2147483647)
+    abnormal_status: Optional[str] = Field(default=None, max_length=255)
+    note: Optional[str] = Field(default=None, max_length=16000)  # TEXT 65535 bytes，utf8mb4 每字最多 4 bytes
+    operator: Optional[str] = Field(default=None, max_length=100)
 
 class ReplacementLogIn(BaseModel):
     fixture_id: str
@@ -328,50 +1931,441 @@ class ReplacementLogIn(BaseModel):
     executor: Optional[str] = None
     note: Optional[str] = None
 
-# ---------- Auth ----------
-@app.post("/login")
+class FixtureBulkIn(FixtureIn):
+    idempotency_key: Optional[str] = Field(default=None, max_length=128)
+
+class ReceiptBulkIn(ReceiptIn):
+    idempotency_key: Optional[str] = Field(default=None, max_length=128)
+
+class ReturnBulkIn(ReturnIn):
+    idempotency_key: Optional[str] = Field(default=None, max_length=128)
+
+class ReplacementLogBulkIn(ReplacementLogIn):
+    idempotency_key: Optional[str] = Field(default=None, max_length=128)
+
+class JobIn(BaseModel):
+    kind: str
+    params: Dict[str, Any] = Field(default_factory=dict)
+
+class ExportJobIn(BaseModel):
+    kind: str
+    start: Optional[date] = None
+    end: Optional[date] = None
+    fixture: Optional[str] = None
+    format: str = Field(default="csv", pattern="^(csv|xlsx)$")
+
+class BackupJobIn(BaseModel):
+    pass
+
+class ImportJobIn(BaseModel):
+    table: str = Field(pattern="^(fixture_models|machine_models)$")
+    path: str
+    filename: str = ""
+
+# ---------- Pagination ----------
+PAGE_LIMIT_DEFAULT = int(os.getenv("PAGE_LIMIT_DEFAULT", "100"))
+PAGE_LIMIT_MAX = int(os.getenv("PAGE_LIMIT_MAX", "1000"))
+
+def encode_cursor(last_id: Union[int, str]) -> str:
+    raw = json.dumps({"id": last_id}, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> Union[int, str]:
+    """主鍵為字串（例如 users.username）時原樣回傳，其餘一律轉 int"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        last = json.loads(raw)["id"]
+        return last if isinstance(last, str) else int(last)
+    except Exception:
+        raise HTTPException(status_code=400, detail="cursor 格式錯誤")
+
+def keyset_page(c, table: str, pk: str, where: str = "1=1", params: tuple = (),
+                cursor: Optional[str] = None, limit: int = PAGE_LIMIT_DEFAULT,
+                with_total: bool = False, columns: str = "*", ascending: bool = False) -> Dict[str, Any]:
+    """
+    以主鍵做 keyset（游標）分頁，依主鍵由新到舊排序（ascending=True 時由小到大）。
+    多抓一筆判斷是否還有下一頁；total 只有 with_total=True 時才另外 COUNT。
+    """
+    sql = f"SELECT {columns} FROM {table} WHERE ({where})"
+    args = list(params)
+    if cursor:
+        sql += f" AND {pk} {'>' if ascending else '<'} %s"
+        args.append(decode_cursor(cursor))
+    sql += f" ORDER BY {pk} {'ASC' if ascending else 'DESC'} LIMIT %s"
+    c.execute(sql, args + [limit + 1])
+    rows = list(c.fetchall() or [])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][pk])
+    total = None
+    if with_total:
+        c.execute(f"SELECT COUNT(*) AS n FROM {table} WHERE ({where})", params)
+        total = int((c.fetchone() or {}).get("n", 0))
+    return {"data": rows, "next_cursor": next_cursor, "limit": limit, "total": total}
+
+PageLimit = Query(PAGE_LIMIT_DEFAULT, ge=1, le=PAGE_LIMIT_MAX)
+
+# ---------- Jobs (背景工作) ----------
+# 匯入、匯出、備份等長時間工作以 job 執行，API 立即回傳 job id，之後查詢進度/結果或取消：
+#   - CPU 密集的解析（例如 XLSX）在 process pool（JOB_PROCESSES 個 spawn 子程序），不與 API 搶 GIL
+#   - DB 密集的寫入/查詢在 JOB_THREADS 條執行緒，與處理 API 請求的 threadpool 分開，數量有上限
+#   - 狀態、進度與結果存在 jobs 資料表，任何 worker 都能查詢與取消（實際執行在送出的那個 worker）
+#   - 執行中/排隊中的 job 每 JOB_HEARTBEAT 秒更新 heartbeat_at；程序異常終止留下的 job
+#     超過 JOB_STALE_SECONDS 沒有 heartbeat 會被標成 failed
+#   - 結束超過 JOB_RETENTION_HOURS 小時的 job 與 JOB_DIR 內的結果檔會被清除
+# 新增工作類型：以 @job_kind(name, Schema) 註冊 fn(ctx, **params)，ctx.progress() 回報進度並檢查取消。
+JOB_DIR = os.getenv("JOB_DIR", os.path.join(APP_DIR, "data", "jobs"))
+JOB_THREADS = int(os.getenv("JOB_THREADS", "2"))
+JOB_PROCESSES = int(os.getenv("JOB_PROCESSES", "1"))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "20"))          # 每個 worker 排隊 + 執行中的上限
+JOB_HEARTBEAT = float(os.getenv("JOB_HEARTBEAT", "5"))
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "60"))
+JOB_RETENTION_HOURS = int(os.getenv("JOB_RETENTION_HOURS", "72"))
+JOB_WORKER = f"{socket.gethostname()}:{os.getpid()}"
+
+JOB_KINDS: Dict[str, tuple] = {}  # kind -> (fn, 參數 schema, 是否可由 POST /jobs 送出)
+
+def job_kind(name: str, schema: type, public: bool = True):
+    def register(fn):
+        JOB_KINDS[name] = (fn, schema, public)
+        return fn
+    return register
+
+class JobCancelled(Exception):
+    """job 被取消（或程序關閉）；由 JobContext.check() 丟出"""
+
+class JobContext:
+    def __init__(self, runner: "JobRunner", job_id: str, kind: str, params: Dict[str, Any]):
+        self.runner = runner
+        self.id = job_id
+        self.kind = kind
+        self.params = params
+        self.cancel_event = threading.Event()
+        self.done = threading.Event()
+        self.result: Any = None
+        self.exception: Optional[BaseException] = None
+        self.progress_value = 0.0
+        self.message = ""
+        self._saved_at = 0.0
+
+    def check(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+    def progress(self, fraction: Optional[float] = None, message: Optional[str] = None):
+        """回報進度（0~1，不知道總量時可只給 message）；最多每秒寫一次 DB。被取消時丟 JobCancelled"""
+        self.check()
+        if fraction is not None:
+            self.progress_value = max(0.0, min(1.0, fraction))
+        if message is not None:
+            self.message = message[:255]
+        if time.monotonic() - self._saved_at >= 1.0:
+            self._saved_at = time.monotonic()
+            self.runner._update(self.id, progress=self.progress_value, message=self.message)
+
+    def path(self, suffix: str) -> str:
+        return os.path.join(JOB_DIR, f"{self.id}{suffix}")
+
+    def run_cpu(self, fn, *args):
+        """在 process pool 執行 fn（需為模組層級函式、參數與回傳值可 pickle）；等待期間仍可取消"""
+        fut = self.runner.processes().submit(fn, *args)
+        while True:
+            try:
+                return fut.result(timeout=0.5)
+            except concurrent.futures.TimeoutError:
+                if self.cancel_event.is_set():
+                    fut.cancel()  # 已在子程序執行的無法中斷，結果直接丟棄
+                    raise JobCancelled()
+
+def _job_row(r: Dict[str, Any]) -> Dict[str, Any]:
+    r = dict(r)
+    for k in ("params", "result"):
+        r[k] = json.loads(r[k]) if r.get(k) else None
+    r["cancel_requested"] = bool(r.get("cancel_requested"))
+    return r
+
+class JobRunner:
+    def __init__(self, threads: int, processes: int, queue_max: int):
+        self.queue_max = queue_max
+        self._threads = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix="job")
+        self._process_count = processes
+        self._processes: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._active: Dict[str, JobContext] = {}  # 本程序排隊中/執行中的 job
+        self.heartbeat = PeriodicTask("job-heartbeat", JOB_HEARTBEAT, self._heartbeat)
+        self.submitted = 0
+
+    def processes(self) -> concurrent.futures.ProcessPoolExecutor:
+        # 第一次用到才啟動；用 spawn 不用 fork：API 程序有許多執行緒，fork 可能複製到被鎖住的 lock
+        with self._lock:
+            if self._processes is None:
+                self._processes = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self._process_count, mp_context=multiprocessing.get_context("spawn"))
+            return self._processes
+
+    def start(self):
+        os.makedirs(JOB_DIR, exist_ok=True)
+        self.heartbeat.start()
+
+    def shutdown(self):
+        """程序關閉：排隊中與執行中的 job 都標成取消，等執行緒結束"""
+        self.heartbeat.stop()
+        for ctx in list(self._active.values()):
+            ctx.cancel_event.set()
+        self._threads.shutdown(wait=True)
+        if self._processes is not None:
+            self._processes.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, kind: str, params: Dict[str, Any], created_by: Optional[str] = None) -> str:
+        return self._submit(kind, params, created_by).id
+
+    def run(self, kind: str, params: Dict[str, Any], created_by: Optional[str] = None) -> JobContext:
+        """送出並等待 job 結束，回傳其 JobContext（ctx.result 為結果，ctx.exception 為失敗原因）"""
+        ctx = self._submit(kind, params, created_by)
+        ctx.done.wait()
+        return ctx
+
+    def _submit(self, kind: str, params: Dict[str, Any], created_by: Optional[str]) -> JobContext:
+        if kind not in JOB_KINDS:
+            raise HTTPException(status_code=400, detail=f"不支援的工作類型：{kind}")
+        _, schema, _ = JOB_KINDS[kind]
+        try:
+            params = schema(**(params or {})).model_dump(mode="json")
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=f"工作參數錯誤：{e}")
+        with self._lock:
+            if len(self._active) >= self.queue_max:
+                raise HTTPException(status_code=503, detail="背景工作已滿，請稍後再試")
+            job_id = uuid.uuid4().hex
+            self._active[job_id] = ctx = JobContext(self, job_id, kind, params)
+        try:
+            conn = get_db(); c = conn.cursor()
+            try:
+                conn.begin()
+                c.execute("""INSERT INTO jobs (id, kind, status, params, worker, created_by, heartbeat_at)
+                             VALUES (%s,%s,'queued',%s,%s,%s,NOW())""",
+                          (job_id, kind, json.dumps(params, ensure_ascii=False), JOB_WORKER, created_by))
+                publish_change(c, "jobs", "insert", job_id, {"kind": kind, "status": "queued"})
+                conn.commit()
+            except Exception:
+                conn.rollback(); raise
+            finally:
+                conn.close()
+        except Exception:
+            self._active.pop(job_id, None); raise
+        self._threads.submit(self._run, ctx)
+        self.submitted += 1
+        return ctx
+
+    def _run(self, ctx: JobContext):
+        fn = JOB_KINDS[ctx.kind][0]
+        try:
+            ctx.check()
+            self._update(ctx.id, "started_at", status="running")
+            ctx.result = fn(ctx, **ctx.params)
+            self._finish(ctx, "succeeded", result=ctx.result, progress=1.0)
+        except JobCancelled as e:
+            ctx.exception = e
+            self._finish(ctx, "cancelled", error="已取消")
+        except HTTPException as e:
+            ctx.exception = e
+            self._finish(ctx, "failed", error=str(e.detail))
+        except Exception as e:
+            ctx.exception = e
+            print(f"⚠️ 背景工作 {ctx.kind} {ctx.id} 失敗:", e)
+            self._finish(ctx, "failed", error=str(e))
+        finally:
+            with self._lock:
+                self._active.pop(ctx.id, None)
+            ctx.done.set()
+
+    def _finish(self, ctx: JobContext, status: str, **cols):
+        try:
+            self._update(ctx.id, "finished_at", status=status, message=ctx.message, **cols)
+        except Exception as e:
+            print(f"⚠️ 無法記錄背景工作 {ctx.id} 的結果:", e)
+
+    def _update(self, job_id: str, stamp: Optional[str] = None, **cols):
+        """更新 job 欄位並刷新 heartbeat；stamp 為要記上 DB 目前時間的欄位（started_at / finished_at）"""
+        if "result" in cols:
+            cols["result"] = dumps_json(cols["result"]).decode("utf-8")
+        sets = [f"{k}=%s" for k in cols] + ["heartbeat_at=NOW()"] + ([f"{stamp}=NOW()"] if stamp else [])
+        conn = get_db(); c = conn.cursor()
+        try:
+            conn.begin()
+            c.execute(f"UPDATE jobs SET {', '.join(sets)} WHERE id=%s", list(cols.values()) + [job_id])
+            if "status" in cols:
+                publish_change(c, "jobs", "update", job_id, {k: cols[k] for k in ("status", "progress", "error") if k in cols})
+            conn.commit()
+        except Exception:
+            conn.rollback(); raise
+        finally:
+            conn.close()
+
+    def cancel(self, job_id: str) -> Dict[str, Any]:
+        conn = get_db(); c = conn.cursor()
+        try:
+            c.execute("UPDATE jobs SET cancel_requested=1 WHERE id=%s AND status IN ('queued','running')", (job_id,))
+        finally:
+            conn.close()
+        ctx = self._active.get(job_id)
+        if ctx is not None:
+            ctx.cancel_event.set()  # 在其他 worker 執行的，由它的 heartbeat 讀到 cancel_requested 後取消
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Dict[str, Any]:
+        with get_db() as conn:
+            c = conn.cursor()
+            c.execute("SELECT * FROM jobs WHERE id=%s", (job_id,))
+            row = c.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail=f"找不到工作 {job_id}")
+        row = _job_row(row)
+        ctx = self._active.get(job_id)
+        if ctx is not None and row["status"] == "running":
+            row["progress"], row["message"] = ctx.progress_value, ctx.message  # 本程序執行中：回傳最新進度
+        return row
+
+    def _heartbeat(self):
+        conn = get_db(); c = conn.cursor()
+        try:
+            ids = list(self._active)
+            if ids:
+                marks = ", ".join(["%s"] * len(ids))
+                c.execute(f"UPDATE jobs SET heartbeat_at=NOW() WHERE id IN ({marks}) AND status IN ('queued','running')", ids)
+                c.execute(f"SELECT id FROM jobs WHERE id IN ({marks}) AND cancel_requested=1", ids)
+                for r in c.fetchall() or []:
+                    ctx = self._active.get(r["id"])
+                    if ctx is not None:
+                        ctx.cancel_event.set()
+            c.execute("""UPDATE jobs SET status='failed', error='執行的程序已中斷', finished_at=NOW()
+                         WHERE status IN ('queued','running') AND heartbeat_at < NOW() - INTERVAL %s SECOND""",
+                      (JOB_STALE_SECONDS,))
+            c.execute("DELETE FROM jobs WHERE finished_at < NOW() - INTERVAL %s HOUR LIMIT 500", (JOB_RETENTION_HOURS,))
+        finally:
+            conn.close()
+        # 結果檔與程序中斷時遺留的上傳檔：依修改時間清除
+        cutoff = time.time() - JOB_RETENTION_HOURS * 3600
+        for entry in os.scandir(JOB_DIR) if os.path.isdir(JOB_DIR) else []:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                with contextlib.suppress(OSError):
+                    os.remove(entry.path)
+        return {"active": len(self._active)}
+
+    def stats(self) -> Dict[str, Any]:
+        return {"worker": JOB_WORKER, "active": len(self._active), "queue_max": self.queue_max,
+                "threads": JOB_THREADS, "processes": JOB_PROCESSES, "submitted": self.submitted,
+                "heartbeat": self.heartbeat.stats()}
+
+job_runner = JobRunner(JOB_THREADS, JOB_PROCESSES, JOB_QUEUE_MAX)
+
+@app.post("/jobs")
+def submit_job(body: JobIn):
+    """送出背景工作，回傳 job id（匯入需上傳檔案，請用各匯入端點加 background=true）"""
+    if body.kind in JOB_KINDS and not JOB_KINDS[body.kind][2]:
+        raise HTTPException(status_code=400, detail=f"{body.kind} 不能直接送出")
+    job_id = job_runner.submit(body.kind, body.params, created_by="api")
+    return JSONResponse(status_code=202, content={"job_id": job_id, "status": "queued"})
+
+@app.get("/jobs")
+def list_jobs(kind: Optional[str] = None, status: Optional[str] = None, limit: int = Query(50, ge=1, le=500)):
+    where, params = [], []
+    if kind:
+        where.append("kind=%s"); params.append(kind)
+    if status:
+        where.append("status=%s"); params.append(status)
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(f"""SELECT id, kind, status, progress, message, error, cancel_requested, worker, created_by,
+                             created_at, started_at, finished_at FROM jobs
+                      {'WHERE ' + ' AND '.join(where) if where else ''} ORDER BY created_at DESC LIMIT %s""", params + [limit])
+        rows = c.fetchall() or []
+    return FastJSONResponse({"data": rows, "runner": job_runner.stats(), "kinds": sorted(JOB_KINDS)})
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    return FastJSONResponse(job_runner.get(job_id))
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    return FastJSONResponse(job_runner.cancel(job_id))
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str):
+    """成功的 job：有檔案結果（匯出、備份）時下載檔案，否則回傳結果 JSON"""
+    job = job_runner.get(job_id)
+    if job["status"] != "succeeded":
+        raise HTTPException(status_code=409, detail=f"工作狀態為 {job['status']}，沒有結果")
+    result = job["result"] or {}
+    if isinstance(result, dict) and result.get("file"):
+        if not os.path.exists(result["file"]):
+            raise HTTPException(status_code=410, detail="結果檔案已不存在（可能已過保存期限或在其他主機）")
+        return FileResponse(result["file"], filename=result.get("filename") or os.path.basename(result["file"]),
+                            media_type=result.get("media_type"))
+    return FastJSONResponse(result)
+
+# ---------- Auth ----------
+@app.post("/login")
 def login(body: UserIn):
-    conn = get_db(); c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE username=%s", (body.username,))
-    row = c.fetchone()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM users WHERE username=%s", (body.username,))
+        row = c.fetchone()
     if not row: raise HTTPException(status_code=401, detail="帳號不存在")
     if hash_password(body.password or "") != row["password_hash"]:
         raise HTTPException(status_code=401, detail="密碼錯誤")
     return {"username": row["username"], "role": row["role"]}
 
 # ---------- Users ----------
-@app.get("/users", response_model=PageResp)
-def list_users(q: Optional[str] = None, page: int = 1, page_size: int = 20):
-    conn = get_db(); c = conn.cursor()
-    base = "FROM users WHERE 1=1"
-    params = []
+@app.get("/users", response_model=CursorPage)
+def list_users(q: Optional[str] = None, cursor: Optional[str] = None, limit: int = PageLimit,
+               with_total: bool = False, layout: str = Layout):
+    # 依帳號由小到大的 keyset 分頁；游標為最後一筆的 username
     if q:
-        base += " AND (username LIKE %s OR role LIKE %s)"
-        like = f"%{q}%"; params += [like, like]
-    c.execute(f"SELECT COUNT(*) AS total {base}", params); total = (c.fetchone() or {}).get("total", 0)
-    off = (page-1)*page_size
-    c.execute(f"SELECT username, role {base} ORDER BY username LIMIT %s OFFSET %s", params + [page_size, off])
-    data = c.fetchall() or []
-    conn.close()
-    return PageResp(total=total, page=page, page_size=page_size, data=data)
+        # 由搜尋索引取得符合的帳號，在記憶體內做 keyset 分頁，只查這一頁
+        names = sorted(search_index.search_keys("user", q))
+        total = len(names)
+        if cursor:
+            last = str(decode_cursor(cursor))
+            names = [n for n in names if n > last]
+        names = names[:limit + 1]
+        rows = []
+        if names:
+            with get_db() as conn:
+                c = conn.cursor()
+                c.execute(f"SELECT username, role FROM users WHERE username IN ({', '.join(['%s'] * len(names))})", names)
+                # 依記憶體內的排序（與游標比較一致），不用 DB 定序
+                rows = sorted(c.fetchall() or [], key=lambda r: r["username"])
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]["username"])
+        return FastJSONResponse(shape_page({"data": rows, "next_cursor": next_cursor, "limit": limit,
+                                            "total": total if with_total else None}, layout))
+    with get_db() as conn:
+        page = keyset_page(conn.cursor(), "users", "username", cursor=cursor, limit=limit, with_total=with_total,
+                           columns="username, role", ascending=True)
+    return FastJSONResponse(shape_page(page, layout))
 
 @app.post("/users")
 def create_user(body: UserIn):
     conn = get_db(); c = conn.cursor()
     try:
+        conn.begin()
         pw = hash_password(body.password or "1234")
         c.execute("INSERT INTO users (username, password_hash, role) VALUES (%s,%s,%s)", (body.username, pw, body.role))
+        publish_change(c, "users", "insert", body.username, {"username": body.username, "role": body.role})
         conn.commit()
     except Exception as e:
         conn.rollback(); raise HTTPException(status_code=400, detail=str(e))
     finally:
         conn.close()
+    search_index.put("user", {"username": body.username, "role": body.role})
     return {"ok": True}
 
 @app.put("/users/{username}")
 def update_user(username: str, body: UserIn):
-    conn = get_db(); c = conn.cursor()
     updates = []; params = []
     if body.password:
         updates.append("password_hash=%s"); params.append(hash_password(body.password))
@@ -379,8 +2373,19 @@ def update_user(username: str, body: UserIn):
         updates.append("role=%s"); params.append(body.role)
     if not updates: raise HTTPException(status_code=400, detail="No updates provided")
     params.append(username)
-    c.execute(f"UPDATE users SET {', '.join(updates)} WHERE username=%s", params)
-    conn.commit(); conn.close()
+    conn = get_db(); c = conn.cursor()
+    try:
+        conn.begin()
+        c.execute(f"UPDATE users SET {', '.join(updates)} WHERE username=%s", params)
+        if c.rowcount and body.role:
+            publish_change(c, "users", "update", username, {"role": body.role})
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    if body.role:
+        search_index.put("user", {"username": username, "role": body.role})
     return {"ok": True}
 
 @app.delete("/users/{username}")
@@ -388,186 +2393,1273 @@ def delete_user(username: str):
     if username == "admin":
         raise HTTPException(status_code=400, detail="Cannot delete default admin")
     conn = get_db(); c = conn.cursor()
-    c.execute("DELETE FROM users WHERE username=%s", (username,))
-    conn.commit(); conn.close()
+    try:
+        conn.begin()
+        c.execute("DELETE FROM users WHERE username=%s", (username,))
+        if c.rowcount:
+            publish_change(c, "users", "delete", username)
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    search_index.remove("user", username)
     return {"ok": True}
 
 # ---------- Fixtures (治具) ----------
-@app.get("/fixtures")
-def get_fixtures(q: Optional[str] = None):
-    conn = get_db(); c = conn.cursor()
-    if q:
-        like = f"%{q}%"
-        c.execute("SELECT * FROM fixtures WHERE name LIKE %s OR status LIKE %s ORDER BY id DESC", (like, like))
-    else:
-        c.execute("SELECT * FROM fixtures ORDER BY id DESC")
-    rows = c.fetchall() or []; conn.close(); return rows
+def fixture_saved(fid: int, body: "FixtureIn"):
+    """治具新增/修改後，同步各個程序內的衍生資料"""
+    stats_cache.invalidate()
+    search_index.put("fixture", {"id": fid, "name": body.name, "status": body.status})
+
+def fixture_deleted(fid: int):
+    stats_cache.invalidate()
+    search_index.remove("fixture", fid)
+
+def search_fixtures_page(q: str, cursor: Optional[str], limit: int, with_total: bool) -> Dict[str, Any]:
+    """以搜尋索引找出符合的治具 id，在記憶體內做 keyset 分頁，只到 DB 取這一頁的資料"""
+    ids = sorted(search_index.search_keys("fixture", q), reverse=True)
+    total = len(ids)
+    if cursor:
+        last = decode_cursor(cursor)
+        ids = [i for i in ids if i < last]
+    page_ids = ids[:limit + 1]
+    rows = []
+    if page_ids:
+        with get_db() as conn:
+            c = conn.cursor()
+            c.execute(f"SELECT * FROM fixtures WHERE id IN ({', '.join(['%s'] * len(page_ids))}) ORDER BY id DESC", page_ids)
+            rows = list(c.fetchall() or [])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["id"])
+    return {"data": rows, "next_cursor": next_cursor, "limit": limit, "total": total if with_total else None}
+
+@app.get("/fixtures", response_model=CursorPage)
+def get_fixtures(request: Request, q: Optional[str] = None, cursor: Optional[str] = None,
+                 limit: int = PageLimit, with_total: bool = False, layout: str = Layout):
+    def build():
+        if q:
+            return shape_page(search_fixtures_page(q, cursor, limit, with_total), layout)
+        with get_db() as conn:
+            page = keyset_page(conn.cursor(), "fixtures", "id", cursor=cursor, limit=limit, with_total=with_total)
+        return shape_page(page, layout)
+    return conditional_json(request, ["fixtures"], build)
 
 @app.post("/fixtures")
 def create_fixture(body: FixtureIn):
     conn = get_db(); c = conn.cursor()
-    c.execute("""INSERT INTO fixtures (name, status, life_type, used, life_value) VALUES (%s,%s,%s,%s,%s)""",
-        (body.name, body.status, body.life_type, body.used, body.life_value))
-    conn.commit(); conn.close(); return {"ok": True}
+    try:
+        # 資料、版本號與異動事件在同一個交易內（連線預設 autocommit）
+        conn.begin()
+        c.execute("""INSERT INTO fixtures (name, status, life_type, used, life_value) VALUES (%s,%s,%s,%s,%s)""",
+            (body.name, body.status, body.life_type, body.used, body.life_value))
+        fid = c.lastrowid
+        touch_tables(c, "fixtures")
+        publish_change(c, "fixtures", "insert", fid, {"id": fid, **body.model_dump()})
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    fixture_saved(fid, body)
+    return {"ok": True}
 
 @app.put("/fixtures/{fid}")
 def update_fixture(fid: int, body: FixtureIn):
+    # used 由使用記錄累計；只有請求明確帶 used 時才覆寫，未帶時保留伺服器上的值
+    fields = [k for k in FIXTURE_COLUMNS if k != "used" or "used" in body.model_fields_set]
     conn = get_db(); c = conn.cursor()
-    c.execute("""UPDATE fixtures SET name=%s, status=%s, life_type=%s, used=%s, life_value=%s WHERE id=%s""",
-        (body.name, body.status, body.life_type, body.used, body.life_value, fid))
-    conn.commit(); conn.close(); return {"ok": True}
+    try:
+        conn.begin()
+        c.execute(f"UPDATE fixtures SET {', '.join(f'{k}=%s' for k in fields)} WHERE id=%s",
+                  [getattr(body, k) for k in fields] + [fid])
+        updated = c.rowcount
+        touch_tables(c, "fixtures")
+        if updated:
+            publish_change(c, "fixtures", "update", fid, body.model_dump(include=set(fields)))
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    if updated:
+        fixture_saved(fid, body)
+    return {"ok": True}
 
 @app.delete("/fixtures/{fid}")
 def delete_fixture(fid: int):
     conn = get_db(); c = conn.cursor()
-    c.execute("DELETE FROM fixtures WHERE id=%s", (fid,))
-    conn.commit(); conn.close(); return {"ok": True}
+    try:
+        conn.begin()
+        c.execute("DELETE FROM fixtures WHERE id=%s", (fid,))
+        if c.rowcount:
+            publish_change(c, "fixtures", "delete", fid)
+        touch_tables(c, "fixtures")
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    fixture_deleted(fid)
+    return {"ok": True}
+
+# ---------- XLSX Import ----------
+IMPORT_CHUNK_ROWS = int(os.getenv("IMPORT_CHUNK_ROWS", "1000"))
+IMPORT_MAX_ERRORS = 1000  # 回傳的錯誤明細上限（error_count 仍為完整數量）
+
+# 欄位 -> 最大長度（與資料表定義一致）
+FIXTURE_MODEL_FIELDS = {"code": 100, "name": 255, "spec": 255, "note": 255}
+MACHINE_MODEL_FIELDS = {"code": 100, "name": 255, "note": 255}
+
+def _cell_text(v) -> str:
+    if v is None:
+        return ""
+    if isinstance(v, float) and v.is_integer():
+        v = int(v)  # Excel 數字格式的代碼 1001 會讀成 1001.0
+    return str(v)
+
+def _import_chunk(c, table: str, fields: Dict[str, int], cols: List[str], chunk: List[list],
+                  row_nos: List[int], report: Dict[str, Any], seen: Dict[str, int]):
+    """
+    驗證一批列（向量化），再以一次 multi-row upsert 寫入。
+    seen：整份檔案已寫入的代碼（casefold 後，與 DB 不分大小寫的定序一致）-> 列號；同一代碼以第一次出現的列為準，
+    之後的列（不論在哪一批）回報為錯誤，不會再算成 updated。
+    """
+    import pandas as pd  # 只有匯入時才需要，延後載入以加快啟動
+
+    df = pd.DataFrame(chunk, columns=cols, index=row_nos)
+    df = df.apply(lambda col: col.str.strip())
+
+    errs = pd.Series("", index=df.index)
+    for f in ("code", "name"):
+        errs = errs.mask((errs == "") & (df[f] == ""), f"{f} 不可空白")
+    for f in cols:
+        errs = errs.mask((errs == "") & (df[f].str.len() > fields[f]), f"{f} 超過 {fields[f]} 字")
+    ok = errs == ""
+    if ok.any():
+        keys = df.loc[ok, "code"].str.casefold()
+        rows = pd.Series(df.index[ok], index=df.index[ok])
+        first = keys.map(seen).fillna(rows.groupby(keys).transform("first")).astype(int)
+        dup = first[first != rows]
+        errs.loc[dup.index] = [f"代碼重複（與第 {n} 列相同，不分大小寫），此列略過" for n in dup]
+
+    bad = errs[errs != ""]
+    report["skipped"] += len(bad)
+    report["error_count"] += len(bad)
+    room = IMPORT_MAX_ERRORS - len(report["errors"])
+    for row_no, msg in bad.iloc[:max(room, 0)].items():
+        report["errors"].append({"row": int(row_no), "code": df.at[row_no, "code"], "error": msg})
+
+    good = df[errs == ""]
+    if good.empty:
+        return
+    seen.update(zip(good["code"].str.casefold(), (int(n) for n in good.index)))
+    codes = good["code"].tolist()
+    c.execute(f"SELECT {', '.join(cols)} FROM {table} WHERE code IN ({', '.join(['%s'] * len(codes))})", codes)
+    # code 以 DB 的定序比對（不分大小寫）；既有列的 code 不會被 upsert 改寫，只比較其他欄位
+    existing = {r["code"].casefold(): tuple(r[f] or "" for f in cols[1:]) for r in c.fetchall()}
+
+    values = list(good.itertuples(index=False, name=None))
+    write = []
+    for v in values:
+        old = existing.get(v[0].casefold())
+        if old is None:
+            report["inserted"] += 1
+        elif old == v[1:]:
+            report["skipped"] += 1; report["unchanged"] += 1
+            continue
+        else:
+            report["updated"] += 1
+        write.append(v)
+    if write:
+        updates = ", ".join(f"{f}=VALUES({f})" for f in cols if f != "code")
+        c.executemany(f"""INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join(['%s'] * len(cols))})
+                          ON DUPLICATE KEY UPDATE {updates}""", write)
+
+IMPORT_TARGETS = {  # 資料表 -> (欄位, 搜尋索引的 kind)
+    "fixture_models": (FIXTURE_MODEL_FIELDS, "fixture_model"),
+    "machine_models": (MACHINE_MODEL_FIELDS, "machine_model"),
+}
+
+def xlsx_to_csv(src: str, dst: str, fields: List[str]) -> Dict[str, Any]:
+    """
+    在 job 的子程序執行（XML 解析是 CPU 密集）：把第一個工作表中需要的欄位轉成 CSV，
+    每列第一欄為 Excel 列號，整列空白略過。openpyxl read-only 逐列讀取，記憶體用量固定。
+    """
+    import openpyxl
+
+    try:
+        wb = openpyxl.load_workbook(src, read_only=True, data_only=True)
+    except Exception as e:
+        return {"error": f"無法讀取 Excel 檔案：{e}"}
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = [_cell_text(h).strip().lower() for h in (next(rows, None) or ())]
+        for k in ("code", "name"):
+            if k not in header:
+                return {"error": f"缺少必要欄位：{k}"}
+        cols = [f for f in fields if f in header]
+        pos = [header.index(f) for f in cols]
+        count = 0
+        with open(dst, "w", newline="", encoding="utf-8") as out:
+            writer = csv.writer(out)
+            for row_no, values in enumerate(rows, start=2):  # 第 1 列是表頭
+                cells = [_cell_text(values[i]) if i < len(values) else "" for i in pos]
+                if any(cells):  # 整列空白（Excel 常見的尾端格式列）略過
+                    writer.writerow([row_no] + cells)
+                    count += 1
+    finally:
+        wb.close()
+    return {"cols": cols, "rows": count}
+
+@job_kind("import_models", ImportJobIn, public=False)
+def import_models_job(ctx: JobContext, table: str, path: str, filename: str = "") -> Dict[str, Any]:
+    """
+    匯入 XLSX 到 fixture_models / machine_models：
+    - 子程序把 XLSX 轉成 CSV，這裡逐 IMPORT_CHUNK_ROWS 列驗證，並以 multi-row upsert（依 code）寫入
+    - 整份檔案在同一個交易內，任何 DB 錯誤或取消都整批回滾
+    表頭不存在的可選欄位不會覆蓋資料庫裡的既有值。
+    """
+    fields, search_kind = IMPORT_TARGETS[table]
+    csv_path = path + ".csv"
+    try:
+        ctx.progress(0, f"解析 {filename or 'Excel'}")
+        parsed = ctx.run_cpu(xlsx_to_csv, path, csv_path, list(fields))
+        if parsed.get("error"):
+            raise HTTPException(status_code=400, detail=parsed["error"])
+        cols, total = parsed["cols"], parsed["rows"]
+        report = {"ok": True, "inserted": 0, "updated": 0, "skipped": 0, "unchanged": 0,
+                  "error_count": 0, "errors": []}
+        conn = get_db(); c = conn.cursor()
+        try:
+            conn.begin()
+            done = 0
+            seen: Dict[str, int] = {}
+            with open(csv_path, newline="", encoding="utf-8") as f:
+                reader = csv.reader(f)
+                while True:
+                    batch = list(itertools.islice(reader, IMPORT_CHUNK_ROWS))
+                    if not batch:
+                        break
+                    _import_chunk(c, table, fields, cols, [r[1:] for r in batch], [int(r[0]) for r in batch], report, seen)
+                    done += len(batch)
+                    ctx.progress(done / total if total else 1.0, f"已處理 {done}/{total} 列")
+            if report["inserted"] or report["updated"]:
+                touch_tables(c, table)
+                publish_change(c, table, "reload", None, {"inserted": report["inserted"], "updated": report["updated"]})
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+    finally:
+        for p in (path, csv_path):
+            with contextlib.suppress(OSError):
+                os.remove(p)
+    if report["inserted"] or report["updated"]:
+        search_index.mark_dirty(search_kind)
+    return report
+
+def submit_import(table: str, file: UploadFile, background: bool):
+    """把上傳檔存到 JOB_DIR 並送出匯入 job；background=false 時等 job 完成直接回傳匯入報告（與舊版相同）"""
+    os.makedirs(JOB_DIR, exist_ok=True)
+    path = os.path.join(JOB_DIR, f"upload-{uuid.uuid4().hex}.xlsx")
+    with open(path, "wb") as out:
+        shutil.copyfileobj(file.file, out, 1024 * 1024)
+    params = {"table": table, "path": path, "filename": file.filename or ""}
+    try:
+        if background:
+            job_id = job_runner.submit("import_models", params, created_by="api")
+            return JSONResponse(status_code=202, content={"job_id": job_id, "status": "queued"})
+        ctx = job_runner.run("import_models", params, created_by="api")
+    except Exception:
+        with contextlib.suppress(OSError):
+            os.remove(path)
+        raise
+    if isinstance(ctx.exception, JobCancelled):
+        raise HTTPException(status_code=409, detail="匯入已取消")
+    if ctx.exception is not None:
+        raise ctx.exception
+    return ctx.result
 
 # ---------- Fixture Models (治具資料維護) ----------
-@app.get("/fixtures/models")
-def list_fixture_models():
-    conn = get_db(); c = conn.cursor()
-    c.execute("SELECT * FROM fixture_models ORDER BY id DESC")
-    rows = c.fetchall() or []; conn.close(); return rows
+@app.get("/fixtures/models", response_model=CursorPage)
+def list_fixture_models(request: Request, cursor: Optional[str] = None, limit: int = PageLimit, with_total: bool = False,
+                           layout: str = Layout):
+    def build():
+        with get_db() as conn:
+            page = keyset_page(conn.cursor(), "fixture_models", "id", cursor=cursor, limit=limit, with_total=with_total)
+        return shape_page(page, layout)
+    return conditional_json(request, ["fixture_models"], build)
 
 @app.post("/fixtures/models")
 def add_fixture_model(code: str = Form(...), name: str = Form(...), spec: str = Form(""), note: str = Form("")):
     conn = get_db(); c = conn.cursor()
-    c.execute("INSERT INTO fixture_models (code, name, spec, note) VALUES (%s,%s,%s,%s)", (code, name, spec, note))
-    conn.commit(); conn.close(); return {"ok": True}
+    try:
+        conn.begin()
+        c.execute("""INSERT INTO fixture_models (code, name, spec, note) VALUES (%s,%s,%s,%s)
+                     ON DUPLICATE KEY UPDATE name=VALUES(name), spec=VALUES(spec), note=VALUES(note)""", (code, name, spec, note))
+        touch_tables(c, "fixture_models")
+        publish_change(c, "fixture_models", "upsert", code, {"code": code, "name": name, "spec": spec, "note": note})
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    search_index.put("fixture_model", {"code": code, "name": name, "spec": spec})
+    return {"ok": True}
 
 @app.post("/fixtures/import_xlsx")
-async def import_fixtures_xlsx(file: UploadFile = File(...)):
-    content = await file.read()
-    df = pd.read_excel(io.BytesIO(content))
-    # 允許欄位：code,name,spec,note
-    cols = {c.lower(): c for c in df.columns}
-    need = ["code","name"]
-    for k in need:
-        if k not in cols:
-            raise HTTPException(status_code=400, detail=f"缺少必要欄位：{k}")
-    conn = get_db(); c = conn.cursor()
-    for _, row in df.iterrows():
-        code = str(row.get(cols.get("code"), "")).strip()
-        name = str(row.get(cols.get("name"), "")).strip()
-        spec = str(row.get(cols.get("spec"), "")).strip() if "spec" in cols else ""
-        note = str(row.get(cols.get("note"), "")).strip() if "note" in cols else ""
-        if code and name:
-            c.execute("INSERT INTO fixture_models (code, name, spec, note) VALUES (%s,%s,%s,%s)", (code,name,spec,note))
-    conn.commit(); conn.close()
-    return {"ok": True}
+def import_fixtures_xlsx(file: UploadFile = File(...), background: bool = False):
+    # 允許欄位：code,name,spec,note；background=true 時立即回傳 job id（見 /jobs）
+    return submit_import("fixture_models", file, background)
 
 # ---------- Machine Models (機種資料維護) ----------
-@app.get("/machines/models")
-def list_machine_models():
-    conn = get_db(); c = conn.cursor()
-    c.execute("SELECT * FROM machine_models ORDER BY id DESC")
-    rows = c.fetchall() or []; conn.close(); return rows
+@app.get("/machines/models", response_model=CursorPage)
+def list_machine_models(request: Request, cursor: Optional[str] = None, limit: int = PageLimit, with_total: bool = False,
+                           layout: str = Layout):
+    def build():
+        with get_db() as conn:
+            page = keyset_page(conn.cursor(), "machine_models", "id", cursor=cursor, limit=limit, with_total=with_total)
+        return shape_page(page, layout)
+    return conditional_json(request, ["machine_models"], build)
 
 @app.post("/machines/models")
 def add_machine_model(code: str = Form(...), name: str = Form(...), note: str = Form("")):
     conn = get_db(); c = conn.cursor()
-    c.execute("INSERT INTO machine_models (code, name, note) VALUES (%s,%s,%s)", (code, name, note))
-    conn.commit(); conn.close(); return {"ok": True}
+    try:
+        conn.begin()
+        c.execute("""INSERT INTO machine_models (code, name, note) VALUES (%s,%s,%s)
+                     ON DUPLICATE KEY UPDATE name=VALUES(name), note=VALUES(note)""", (code, name, note))
+        touch_tables(c, "machine_models")
+        publish_change(c, "machine_models", "upsert", code, {"code": code, "name": name, "note": note})
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    search_index.put("machine_model", {"code": code, "name": name})
+    return {"ok": True}
 
 @app.post("/machines/import_xlsx")
-async def import_machines_xlsx(file: UploadFile = File(...)):
-    content = await file.read()
-    df = pd.read_excel(io.BytesIO(content))
-    cols = {c.lower(): c for c in df.columns}
-    need = ["code","name"]
-    for k in need:
-        if k not in cols:
-            raise HTTPException(status_code=400, detail=f"缺少必要欄位：{k}")
-    conn = get_db(); c = conn.cursor()
-    for _, row in df.iterrows():
-        code = str(row.get(cols.get("code"), "")).strip()
-        name = str(row.get(cols.get("name"), "")).strip()
-        note = str(row.get(cols.get("note"), "")).strip() if "note" in cols else ""
-        if code and name:
-            c.execute("INSERT INTO machine_models (code, name, note) VALUES (%s,%s,%s)", (code,name,note))
-    conn.commit(); conn.close()
-    return {"ok": True}
+def import_machines_xlsx(file: UploadFile = File(...), background: bool = False):
+    # 允許欄位：code,name,note
+    return submit_import("machine_models", file, background)
 
 # ---------- Receipts / Returns ----------
-@app.get("/receipts")
-def list_receipts():
+SERIAL_RANGE_MAX = int(os.getenv("SERIAL_RANGE_MAX", "100000"))  # 單張收/退料單最多展開的序號數
+SERIAL_LOOKUP_MAX = 5000
+_SERIAL_SPLIT = re.compile(r"[\s,，;；、]+")
+_SERIAL_TAIL = re.compile(r"^(.*?)(\d+)$")
+
+def expand_serial_range(start: str, end: str) -> List[str]:
+    """
+    展開流水號區間：前綴需相同，數字部分依起始值的位數補零，例如 SN0098 ~ SN0102。
+    無法展開的區間（前綴不同、沒有數字結尾、起訖顛倒、超過 SERIAL_RANGE_MAX 筆）照舊以原文存檔，只索引起訖兩個序號。
+    """
+    start, end = (start or "").strip(), (end or "").strip()
+    if not start or not end:
+        return [x for x in (start, end) if x]
+    if start == end:
+        return [start]
+    ms, me = _SERIAL_TAIL.match(start), _SERIAL_TAIL.match(end)
+    if not ms or not me or ms.group(1) != me.group(1):
+        return [start, end]
+    prefix, width = ms.group(1), len(ms.group(2))
+    lo, hi = int(ms.group(2)), int(me.group(2))
+    if hi < lo or hi - lo + 1 > SERIAL_RANGE_MAX:
+        return [start, end]
+    return [f"{prefix}{n:0{width}d}" for n in range(lo, hi + 1)]
+
+def expand_serials(body) -> List[str]:
+    """依收/退料單的類型展開序號：batch 用起訖區間，其他用逗號/空白分隔的序號清單"""
+    if (body.type or "batch") == "batch":
+        out = expand_serial_range(body.serial_start, body.serial_end)
+    else:
+        out = [x for x in _SERIAL_SPLIT.split(body.serials or "") if x]
+    return list(dict.fromkeys(out))
+
+def record_serials(c, state: str, fixture_code: str, serials: List[str], doc_id: int):
+    """更新序號表的目前狀態；在收/退料單同一個交易內呼叫"""
+    if not serials or not fixture_code:
+        return
+    ref = "receipt_id" if state == "received" else "return_id"
+    for i in range(0, len(serials), 1000):
+        c.executemany(f"""INSERT INTO fixture_serials (fixture_code, serial, state, {ref}) VALUES (%s,%s,%s,%s)
+                          ON DUPLICATE KEY UPDATE state=VALUES(state), {ref}=VALUES({ref})""",
+                      [(fixture_code, s, state, doc_id) for s in serials[i:i + 1000]])
+
+def unrecord_serials(c, state: str, doc_id: int, fixture_code: str):
+    """
+    刪除收/退料單時還原序號狀態（單據本身已刪除，在同一個交易內呼叫）：
+    仍指向這張單的序號，以同治具其餘的收/退料單依時間重播（與 backfill_serials 相同順序）重算狀態與單號，
+    例如同一序號先前也被另一張收料單收過，就改指向那張；其餘單據都沒有這個序號才刪除。
+    """
+    ref = "receipt_id" if state == "received" else "return_id"
+    c.execute(f"SELECT serial FROM fixture_serials WHERE {ref}=%s AND fixture_code=%s FOR UPDATE", (doc_id, fixture_code))
+    affected = {r["serial"] for r in c.fetchall() or []}
+    if not affected:
+        return
+    c.execute("""SELECT 'received' AS state, id, type, serial_start, serial_end, serials, created_at FROM receipts
+                 WHERE fixture_code=%s
+                 UNION ALL
+                 SELECT 'returned' AS state, id, type, serial_start, serial_end, serials, created_at FROM returns_table
+                 WHERE fixture_code=%s
+                 ORDER BY created_at, state, id""", (fixture_code, fixture_code))
+    replay: Dict[str, Dict[str, Any]] = {}
+    for row in c.fetchall() or []:
+        for s in affected.intersection(document_serials(row) or ()):
+            cur = replay.setdefault(s, {"receipt_id": None, "return_id": None})
+            cur["state"] = row["state"]
+            cur["receipt_id" if row["state"] == "received" else "return_id"] = row["id"]
+    keep = [(v["state"], v["receipt_id"], v["return_id"], fixture_code, s) for s, v in replay.items()]
+    drop = sorted(affected - replay.keys())
+    for i in range(0, len(keep), 1000):
+        c.executemany("""UPDATE fixture_serials SET state=%s, receipt_id=%s, return_id=%s
+                         WHERE fixture_code=%s AND serial=%s""", keep[i:i + 1000])
+    for i in range(0, len(drop), 1000):
+        part = drop[i:i + 1000]
+        c.execute(f"DELETE FROM fixture_serials WHERE fixture_code=%s AND serial IN ({', '.join(['%s'] * len(part))})",
+                  [fixture_code] + part)
+
+MATERIAL_COLUMNS = ["type", "vendor", "order_no", "fixture_code", "serial_start", "serial_end", "serials", "quantity",
+                    "operator", "note"]
+
+def document_serials(row: Dict[str, Any]) -> Optional[List[str]]:
+    """展開已存檔收/退料單的序號；舊資料格式錯誤無法展開時回傳 None"""
+    try:
+        return expand_serials(ReceiptIn(**{k: row[k] or "" for k in ("type", "serial_start", "serial_end", "serials")}))
+    except HTTPException:
+        return None
+
+def document_quantity(doc, serials: Optional[List[str]]) -> int:
+    """單據計入庫存的數量：有序號時為展開後的序號數，沒有序號時用單據上的 quantity（未填為 0）"""
+    if serials:
+        return len(serials)
+    quantity = doc.get("quantity") if isinstance(doc, dict) else doc.quantity
+    return int(quantity or 0)
+
+def add_material(table: str, state: str, body) -> Dict[str, Any]:
+    serials = expand_serials(body)
+    conn = get_db(); c = conn.cursor()
+    try:
+        conn.begin()
+        c.execute(f"""INSERT INTO {table} (type, vendor, order_no, fixture_code, serial_start, serial_end, serials, quantity, operator, note) 
+                      VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
+                  (body.type, body.vendor, body.order_no, body.fixture_code, body.serial_start, body.serial_end, body.serials, body.quantity, body.operator, body.note))
+        doc_id = c.lastrowid
+        record_serials(c, state, body.fixture_code, serials, doc_id)
+        stock = apply_inventory(c, {body.fixture_code: inventory_delta(state, document_quantity(body, serials))})
+        publish_change(c, table, "insert", doc_id, {"id": doc_id, **{k: getattr(body, k) for k in MATERIAL_COLUMNS}})
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    inventory_saved(stock)
+    return {"ok": True, "id": doc_id, "serial_count": len(serials), "quantity": document_quantity(body, serials)}
+
+def del_material(table: str, state: str, doc_id: int) -> Dict[str, Any]:
     conn = get_db(); c = conn.cursor()
-    c.execute("SELECT * FROM receipts ORDER BY id DESC")
-    rows = c.fetchall() or []; conn.close(); return rows
+    try:
+        conn.begin()
+        c.execute(f"SELECT type, fixture_code, serial_start, serial_end, serials, quantity FROM {table} WHERE id=%s FOR UPDATE",
+                  (doc_id,))
+        row = c.fetchone()
+        stock = []
+        if row:
+            c.execute(f"DELETE FROM {table} WHERE id=%s", (doc_id,))
+            publish_change(c, table, "delete", doc_id)
+            unrecord_serials(c, state, doc_id, row["fixture_code"])
+            # 扣回這張單據計入的數量（與新增時同樣依 document_quantity 計）
+            stock = apply_inventory(c, {row["fixture_code"]: inventory_delta(state, -document_quantity(row, document_serials(row)))})
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    inventory_saved(stock)
+    return {"ok": True}
+
+def lookup_serials(serials: List[str], fixture_code: Optional[str] = None) -> List[Dict[str, Any]]:
+    if not serials:
+        return []
+    sql = f"""SELECT fixture_code, serial, state, receipt_id, return_id, updated_at FROM fixture_serials
+              WHERE serial IN ({', '.join(['%s'] * len(serials))})"""
+    params = list(serials)
+    if fixture_code:
+        sql += " AND fixture_code=%s"; params.append(fixture_code)
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(sql, params)
+        return c.fetchall() or []
+
+def backfill_serials() -> Dict[str, Any]:
+    """
+    依時間順序重播所有收/退料單，重建 fixture_serials。
+    以 server-side cursor 讀取，每 500 張單提交一次；無法展開的舊資料略過並計數。
+    """
+    report = {"documents": 0, "serials": 0, "skipped": 0}
+    reader = get_db()
+    try:
+        writer = get_db()
+    except Exception:
+        reader.close(); raise
+    try:
+        cur = reader.cursor(pymysql.cursors.SSDictCursor)
+        cur.execute("""SELECT 'received' AS state, id, type, fixture_code, serial_start, serial_end, serials, created_at FROM receipts
+                       UNION ALL
+                       SELECT 'returned' AS state, id, type, fixture_code, serial_start, serial_end, serials, created_at FROM returns_table
+                       ORDER BY created_at, state, id""")
+        w = writer.cursor()
+        writer.begin()
+        for row in cur:
+            serials = document_serials(row)
+            if serials is None:
+                report["skipped"] += 1
+                continue
+            record_serials(w, row["state"], row["fixture_code"], serials, row["id"])
+            report["documents"] += 1
+            report["serials"] += len(serials)
+            if report["documents"] % 500 == 0:
+                writer.commit(); writer.begin()
+        writer.commit()
+        cur.close()
+    except Exception:
+        writer.rollback(); reader.invalidate(); raise
+    finally:
+        writer.close(); reader.close()
+    return report
+
+
+@app.get("/receipts", response_model=CursorPage)
+def list_receipts(cursor: Optional[str] = None, limit: int = PageLimit, with_total: bool = False, layout: str = Layout):
+    with get_read_db() as conn:
+        page = keyset_page(conn.cursor(), "receipts", "id", cursor=cursor, limit=limit, with_total=with_total)
+    return FastJSONResponse(shape_page(page, layout))
 
 @app.post("/receipts")
 def add_receipt(body: ReceiptIn):
-    conn = get_db(); c = conn.cursor()
-    c.execute("""INSERT INTO receipts (type, vendor, order_no, fixture_code, serial_start, serial_end, serials, operator, note) 
-                 VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-              (body.type, body.vendor, body.order_no, body.fixture_code, body.serial_start, body.serial_end, body.serials, body.operator, body.note))
-    conn.commit(); conn.close(); return {"ok": True}
+    return add_material("receipts", "received", body)
 
 @app.delete("/receipts/{rid}")
 def del_receipt(rid: int):
-    conn = get_db(); c = conn.cursor()
-    c.execute("DELETE FROM receipts WHERE id=%s", (rid,))
-    conn.commit(); conn.close(); return {"ok": True}
+    return del_material("receipts", "received", rid)
 
-@app.get("/returns")
-def list_returns():
-    conn = get_db(); c = conn.cursor()
-    c.execute("SELECT * FROM returns_table ORDER BY id DESC")
-    rows = c.fetchall() or []; conn.close(); return rows
+@app.get("/returns", response_model=CursorPage)
+def list_returns(cursor: Optional[str] = None, limit: int = PageLimit, with_total: bool = False, layout: str = Layout):
+    with get_read_db() as conn:
+        page = keyset_page(conn.cursor(), "returns_table", "id", cursor=cursor, limit=limit, with_total=with_total)
+    return FastJSONResponse(shape_page(page, layout))
 
 @app.post("/returns")
 def add_return(body: ReturnIn):
-    conn = get_db(); c = conn.cursor()
-    c.execute("""INSERT INTO returns_table (type, vendor, order_no, fixture_code, serial_start, serial_end, serials, operator, note) 
-                 VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-              (body.type, body.vendor, body.order_no, body.fixture_code, body.serial_start, body.serial_end, body.serials, body.operator, body.note))
-    conn.commit(); conn.close(); return {"ok": True}
+    return add_material("returns_table", "returned", body)
 
 @app.delete("/returns/{rid}")
 def del_return(rid: int):
+    return del_material("returns_table", "returned", rid)
+
+# ---------- Serials (序號) ----------
+@app.get("/serials/{serial}")
+def get_serial(serial: str, fixture_code: Optional[str] = None):
+    """查詢序號目前狀態（received / returned）；未指定治具編號時回傳所有同序號的治具"""
+    found = lookup_serials([serial], fixture_code)
+    if not found:
+        raise HTTPException(status_code=404, detail=f"找不到序號 {serial}")
+    return found
+
+@app.post("/serials/lookup")
+def lookup_serials_batch(body: SerialLookupIn):
+    """一次查詢多個掃描序號"""
+    if len(body.serials) > SERIAL_LOOKUP_MAX:
+        raise HTTPException(status_code=413, detail=f"一次最多 {SERIAL_LOOKUP_MAX} 個序號")
+    wanted = list(dict.fromkeys(s.strip() for s in body.serials if s and s.strip()))
+    found = lookup_serials(wanted, body.fixture_code)
+    hit = {r["serial"] for r in found}
+    return {"data": found, "not_found": [s for s in wanted if s not in hit]}
+
+@app.post("/serials/backfill")
+def backfill_serials_api():
+    """由既有收/退料單重建序號表（可重複執行）"""
+    return backfill_serials()
+
+# ---------- Inventory (庫存) ----------
+# fixture_inventory 依治具編號（fixture_code）記錄累計收料數、退料數與在庫數 on_hand = 收 - 退，
+# 數量為單據展開後的序號數，沒有序號的單據用單據上的 quantity（document_quantity）。新增/刪除收退料單時在同一個交易內增減（apply_inventory），
+# 查詢庫存與開站數試算都直接讀這個結果，不必重新加總收退料歷史。
+# 帳與單據不一致時（例如直接改 DB）以 check_inventory(repair=True) 由單據重算補正。
+def inventory_delta(state: str, n: int) -> tuple:
+    return (n, 0) if state == "received" else (0, n)
+
+def apply_inventory(c, deltas: Dict[str, tuple]) -> List[Dict[str, Any]]:
+    """
+    deltas: {fixture_code: (收料增減, 退料增減)}；在收/退料單同一個交易內呼叫，回傳異動後的庫存列。
+    依代碼排序更新，多個交易同時異動時鎖定順序一致，避免 deadlock。
+    """
+    items = sorted((code, d) for code, d in deltas.items() if code and any(d))
+    if not items:
+        return []
+    c.executemany("""INSERT INTO fixture_inventory (fixture_code, received_qty, returned_qty) VALUES (%s,%s,%s)
+                     ON DUPLICATE KEY UPDATE received_qty = received_qty + VALUES(received_qty),
+                                             returned_qty = returned_qty + VALUES(returned_qty)""",
+                  [(code, r, t) for code, (r, t) in items])
+    codes = [code for code, _ in items]
+    c.execute(f"""SELECT fixture_code, received_qty, returned_qty, on_hand FROM fixture_inventory
+                  WHERE fixture_code IN ({', '.join(['%s'] * len(codes))})""", codes)
+    rows = c.fetchall() or []
+    touch_tables(c, "fixture_inventory")
+    publish_changes(c, [("fixture_inventory", "update", r["fixture_code"],
+                         {k: r[k] for k in ("received_qty", "returned_qty", "on_hand")}) for r in rows])
+    return rows
+
+def inventory_saved(rows: List[Dict[str, Any]]):
+    """提交後更新本程序的開站數庫存；change feed 執行中時由它依 seq 順序更新（含其他 worker 的異動）"""
+    if not change_feed.running:
+        for r in rows:
+            capacity.stock_changed(r["fixture_code"], r["on_hand"])
+
+def inventory_totals(c, with_quantity: bool = True) -> tuple:
+    """由收退料單重算 {fixture_code: [收料數, 退料數]}（與新增單據時相同的 document_quantity），回傳 (totals, 無法展開而略過的單據數)"""
+    totals: Dict[str, List[int]] = collections.defaultdict(lambda: [0, 0])
+    skipped = 0
+    cols = "id, type, fixture_code, serial_start, serial_end, serials" + (", quantity" if with_quantity else "")
+    for i, table in enumerate(("receipts", "returns_table")):
+        last = 0
+        while True:
+            c.execute(f"""SELECT {cols} FROM {table}
+                          WHERE id > %s ORDER BY id LIMIT 1000""", (last,))
+            rows = c.fetchall() or []
+            if not rows:
+                break
+            for r in rows:
+                serials = document_serials(r)
+                if serials is None:
+                    skipped += 1
+                elif r["fixture_code"]:
+                    totals[r["fixture_code"]][i] += document_quantity(r, serials)
+            last = rows[-1]["id"]
+    return totals, skipped
+
+def check_inventory(repair: bool = False) -> Dict[str, Any]:
+    """
+    由收退料單重算庫存並與 fixture_inventory 比對，回傳不一致的治具。
+    重算與讀帳在同一個一致性快照內完成，repair 時把「差額」累加回帳：
+    快照之後才提交的單據已由增量更新計入，不會被覆蓋或重複計算，因此不必停止寫入。
+    """
     conn = get_db(); c = conn.cursor()
-    c.execute("DELETE FROM returns_table WHERE id=%s", (rid,))
-    conn.commit(); conn.close(); return {"ok": True}
+    try:
+        c.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+        totals, skipped = inventory_totals(c)
+        c.execute("SELECT fixture_code, received_qty, returned_qty FROM fixture_inventory")
+        ledger = {r["fixture_code"]: (int(r["received_qty"]), int(r["returned_qty"])) for r in c.fetchall() or []}
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    codes = sorted(set(totals) | set(ledger))
+    mismatches, deltas = [], {}
+    for code in codes:
+        want, have = tuple(totals.get(code, (0, 0))), ledger.get(code, (0, 0))
+        if want != have:
+            mismatches.append({"fixture_code": code, "received_qty": have[0], "returned_qty": have[1],
+                               "expected_received_qty": want[0], "expected_returned_qty": want[1]})
+            deltas[code] = (want[0] - have[0], want[1] - have[1])
+    if repair and deltas:
+        conn = get_db(); c = conn.cursor()
+        try:
+            conn.begin()
+            stock = apply_inventory(c, deltas)
+            conn.commit()
+        except Exception:
+            conn.rollback(); raise
+        finally:
+            conn.close()
+        inventory_saved(stock)
+    return {"checked": len(codes), "mismatches": len(mismatches), "repaired": bool(repair and deltas),
+            "skipped_documents": skipped, "details": mismatches[:1000]}
+
+@app.get("/inventory")
+def list_inventory(request: Request, codes: Optional[str] = None):
+    """各治具編號的收料數、退料數與在庫數；codes 以逗號分隔只查部分治具"""
+    wanted = [x for x in (codes or "").split(",") if x.strip()]
+
+    def build():
+        sql = "SELECT fixture_code, received_qty, returned_qty, on_hand, updated_at FROM fixture_inventory"
+        if wanted:
+            sql += f" WHERE fixture_code IN ({', '.join(['%s'] * len(wanted))})"
+        with get_db() as conn:
+            c = conn.cursor()
+            c.execute(sql + " ORDER BY fixture_code", [x.strip() for x in wanted])
+            rows = c.fetchall() or []
+        return {"data": rows}
+    return conditional_json(request, ["fixture_inventory"], build)
+
+@app.get("/inventory/{fixture_code}")
+def get_inventory(fixture_code: str):
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("""SELECT fixture_code, received_qty, returned_qty, on_hand, updated_at FROM fixture_inventory
+                     WHERE fixture_code=%s""", (fixture_code,))
+        row = c.fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail=f"查無治具 {fixture_code} 的收退料記錄")
+    return row
+
+@app.post("/inventory/check")
+def check_inventory_api(repair: bool = False):
+    """比對庫存帳與收退料單；repair=true 時補正差額（可重複執行）"""
+    return check_inventory(repair)
 
 # ---------- Logs ----------
-@app.get("/logs")
-def list_logs():
-    conn = get_db(); c = conn.cursor()
-    c.execute("SELECT * FROM logs ORDER BY id DESC")
-    rows = c.fetchall() or []; conn.close(); return rows
+@app.get("/logs", response_model=CursorPage)
+def list_logs(cursor: Optional[str] = None, limit: int = PageLimit, with_total: bool = False, layout: str = Layout):
+    with get_read_db() as conn:
+        page = keyset_page(conn.cursor(), "logs", "id", cursor=cursor, limit=limit, with_total=with_total)
+    return FastJSONResponse(shape_page(page, layout))
 
 @app.post("/logs")
 def add_log(body: LogIn):
     conn = get_db(); c = conn.cursor()
-    c.execute("INSERT INTO logs (fixture, type, note) VALUES (%s,%s,%s)", (body.fixture, body.type, body.note))
-    conn.commit(); conn.close(); return {"ok": True}
+    try:
+        conn.begin()
+        c.execute("INSERT INTO logs (fixture, type, note) VALUES (%s,%s,%s)", (body.fixture, body.type, body.note))
+        publish_change(c, "logs", "insert", c.lastrowid, {"id": c.lastrowid, **body.model_dump()})
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    return {"ok": True}
 
 @app.get("/logs/export")
-def export_logs():
-    # Export CSV with UTF-8 BOM to avoid garbled characters when opened in Excel
-    conn = get_db(); c = conn.cursor()
-    c.execute("SELECT created_at, fixture, type, note FROM logs ORDER BY id DESC")
-    rows = c.fetchall() or []; conn.close()
+def export_logs(start: Optional[date] = None, end: Optional[date] = None,
+                fixture: Optional[str] = None, format: str = Query("csv", pattern="^(csv|xlsx)$")):
+    return export_table("logs", start, end, fixture, format)
+
+# ---------- Exports ----------
+EXPORT_FETCH_ROWS = int(os.getenv("EXPORT_FETCH_ROWS", "2000"))  # 每次從 server-side cursor 取的列數
+
+# 匯出設定：資料表、主鍵、日期篩選欄位、治具篩選欄位、(欄位, 標題)
+EXPORTS = {
+    "logs": {
+        "table": "logs", "pk": "id", "date_col": "created_at", "fixture_col": "fixture",
+        "columns": [("created_at", "時間"), ("fixture", "治具"), ("type", "類型"), ("note", "備註")],
+    },
+    "usage_logs": {
+        "table": "usage_logs", "pk": "log_id", "date_col": "used_at", "fixture_col": "fixture_id",
+        "columns": [("used_at", "時間"), ("fixture_id", "治具編號"), ("serial_number", "序號"),
+                    ("station_id", "站別"), ("use_count", "使用次數"), ("abnormal_status", "異常狀態"),
+                    ("operator", "操作人員"), ("note", "備註")],
+    },
+    "replacement_logs": {
+        "table": "replacement_logs", "pk": "replacement_id", "date_col": "replacement_date", "fixture_col": "fixture_id",
+        "columns": [("replacement_date", "更換日期"), ("fixture_id", "治具編號"), ("serial_number", "序號"),
+                    ("reason", "更換原因"), ("executor", "執行人員"), ("note", "備註"), ("created_at", "建立時間")],
+    },
+    "receipts": {
+        "table": "receipts", "pk": "id", "date_col": "created_at", "fixture_col": "fixture_code",
+        "columns": [("created_at", "時間"), ("type", "類型"), ("vendor", "廠商"), ("order_no", "單號"),
+                    ("fixture_code", "治具編號"), ("serial_start", "流水號起"), ("serial_end", "流水號迄"),
+                    ("serials", "序號"), ("quantity", "數量"), ("operator", "操作人員"), ("note", "備註")],
+    },
+    "returns": {
+        "table": "returns_table", "pk": "id", "date_col": "created_at", "fixture_col": "fixture_code",
+        "columns": [("created_at", "時間"), ("type", "類型"), ("vendor", "廠商"), ("order_no", "單號"),
+                    ("fixture_code", "治具編號"), ("serial_start", "流水號起"), ("serial_end", "流水號迄"),
+                    ("serials", "序號"), ("quantity", "數量"), ("operator", "操作人員"), ("note", "備註")],
+    },
+}
+
+def _export_query(spec: Dict[str, Any], start: Optional[date], end: Optional[date], fixture: Optional[str],
+                  before: Optional[int] = None, with_pk: bool = False):
+    where, params = ["1=1"], []
+    if before is not None:
+        where.append(f"{spec['pk']} < %s"); params.append(before)
+    if start:
+        where.append(f"{spec['date_col']} >= %s"); params.append(start)
+    if end:
+        where.append(f"{spec['date_col']} < %s"); params.append(end + timedelta(days=1))  # end 當天包含在內
+    if fixture:
+        where.append(f"{spec['fixture_col']} = %s"); params.append(fixture)
+    cols = ", ".join(([spec["pk"]] if with_pk else []) + [col for col, _ in spec["columns"]])
+    return f"SELECT {cols} FROM {spec['table']} WHERE {' AND '.join(where)} ORDER BY {spec['pk']} DESC", params
 
+def _iter_export_rows(sql: str, params: list):
+    """以 unbuffered server-side cursor 分批讀出，整個匯出只佔用 EXPORT_FETCH_ROWS 列的記憶體"""
+    conn = get_read_db()
+    done = False
+    try:
+        cur = conn.cursor(pymysql.cursors.SSCursor)
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(EXPORT_FETCH_ROWS)
+            if not rows:
+                break
+            yield rows
+        cur.close()
+        done = True
+    finally:
+        if done:
+            conn.close()
+        else:
+            # 中途中斷（用戶端斷線）時結果集還沒讀完，連線不能再用，直接丟棄
+            conn.invalidate()
+
+def _csv_stream(headers: List[str], batches):
     buf = io.StringIO()
     writer = csv.writer(buf)
-    writer.writerow(["時間","治具","類型","備註"])
-    for r in rows:
-        writer.writerow([str(r.get("created_at") or ""), r.get("fixture") or "", r.get("type") or "", r.get("note") or ""])
+    buf.write("\ufeff")  # UTF-8 BOM，Excel 開啟才不會亂碼
+    writer.writerow(headers)
+    for rows in batches:
+        for r in rows:
+            writer.writerow(["" if v is None else str(v) for v in r])
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0); buf.truncate(0)
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+def _xlsx_stream(title: str, headers: List[str], batches, chunk_size: int = 64 * 1024):
+    # xlsx 是 zip，必須整份寫完才能送出；write_only 模式逐列寫入暫存檔，記憶體用量固定
+    import openpyxl
+
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+    ws.append(headers)
+    for rows in batches:
+        for r in rows:
+            ws.append(list(r))
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as tmp:
+        wb.save(tmp)
+        tmp.seek(0)
+        while True:
+            data = tmp.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def export_chunks(kind: str, start: Optional[date], end: Optional[date], fixture: Optional[str], format: str):
+    """回傳匯出檔內容的 bytes 產生器（HTTP 串流與背景匯出 job 共用）"""
+    spec = EXPORTS.get(kind)
+    if not spec:
+        raise HTTPException(status_code=404, detail=f"不支援的匯出類型：{kind}")
+    sql, params = _export_query(spec, start, end, fixture)
+    headers = [h for _, h in spec["columns"]]
+    batches = _iter_export_rows(sql, params)
+    if archive_covers(kind, start, end):
+        # 日期區間早於保存期限的部分已搬到歸檔檔案，接在線上資料後面（同樣由新到舊）
+        batches = itertools.chain(batches, iter_archive_rows(kind, start, end, fixture))
+    return _xlsx_stream(kind, headers, batches) if format == "xlsx" else _csv_stream(headers, batches)
+
+def export_table(kind: str, start: Optional[date], end: Optional[date], fixture: Optional[str], format: str):
+    chunks = export_chunks(kind, start, end, fixture, format)
+    return StreamingResponse(chunks, media_type=XLSX_MEDIA_TYPE if format == "xlsx" else "text/csv",
+                             headers={"Content-Disposition": f"attachment; filename={kind}.{format}"})
+
+@job_kind("export", ExportJobIn)
+def export_job(ctx: JobContext, kind: str, start: Optional[str] = None, end: Optional[str] = None,
+               fixture: Optional[str] = None, format: str = "csv") -> Dict[str, Any]:
+    """背景匯出到 JOB_DIR，完成後由 GET /jobs/{id}/result 下載；大範圍匯出不必佔著一條 HTTP 連線"""
+    chunks = export_chunks(kind, date.fromisoformat(start) if start else None, date.fromisoformat(end) if end else None,
+                           fixture, format)
+    path = ctx.path(f".{format}")
+    size = 0
+    try:
+        with open(path, "wb") as out:
+            for data in chunks:
+                out.write(data)
+                size += len(data)
+                ctx.progress(message=f"已匯出 {size / 1e6:.1f} MB")
+    except BaseException:
+        chunks.close()  # 釋放 server-side cursor
+        with contextlib.suppress(OSError):
+            os.remove(path)
+        raise
+    return {"file": path, "filename": f"{kind}.{format}", "size": size,
+            "media_type": XLSX_MEDIA_TYPE if format == "xlsx" else "text/csv"}
+
+@app.get("/exports/{kind}")
+def export_records(kind: str, start: Optional[date] = None, end: Optional[date] = None,
+                   fixture: Optional[str] = None, format: str = Query("csv", pattern="^(csv|xlsx)$")):
+    """串流匯出 logs / usage_logs / replacement_logs / receipts / returns（可依日期區間、治具篩選）"""
+    return export_table(kind, start, end, fixture, format)
+
+# ---------- Retention (資料保存與歸檔) ----------
+# logs / usage_logs / replacement_logs 超過 RETENTION_DAYS 天的資料搬到 ARCHIVE_DIR/<table>/<YYYY-MM>.csv.gz：
+#   - 每批 RETENTION_BATCH 筆：寫入歸檔並 fsync → 記下待刪主鍵 → 依主鍵刪除，批次間暫停 RETENTION_SLEEP 秒，不長時間鎖表
+#   - 每次追加是一個獨立的 gzip member（gzip 可直接串接），第一列為欄位名稱
+#   - 中途中斷時，重跑會先刪掉已歸檔但未刪除的列；重複寫入歸檔的列讀取時依主鍵去重
+#   - 進度檔記下每個月份的主鍵範圍（bounds），/history 依範圍由大到小只讀需要的月份，取滿一頁就停
+# 匯出與 /history 的日期區間涵蓋歸檔月份時，自動合併讀取歸檔；讀出的值依線上資料表的欄位型別轉回。
+# 使用趨勢彙總表不受影響。
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(APP_DIR, "data", "archive"))
+RETENTION_ENABLED = os.getenv("RETENTION_ENABLED", "0") == "1"
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "365"))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "1000"))
+RETENTION_SLEEP = float(os.getenv("RETENTION_SLEEP", "0.05"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "86400"))
+RETENTION_KINDS = ("logs", "usage_logs", "replacement_logs")  # 對應 EXPORTS 的設定
+RETENTION_LOCK = "fixture_suite_retention"
+
+def _archive_dir(table: str) -> str:
+    return os.path.join(ARCHIVE_DIR, table)
+
+def _archive_state(table: str, state: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """讀取（或以 tmp + rename 原子寫入）歸檔進度檔"""
+    path = os.path.join(_archive_dir(table), "_state.json")
+    if state is None:
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+    os.makedirs(_archive_dir(table), exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f); f.flush(); os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+    return state
+
+def archive_months(table: str) -> List[str]:
+    try:
+        names = os.listdir(_archive_dir(table))
+    except FileNotFoundError:
+        return []
+    return sorted(n[:-len(".csv.gz")] for n in names if re.fullmatch(r"\d{4}-\d{2}\.csv\.gz", n))
+
+def _month_of(v) -> str:
+    return v.strftime("%Y-%m") if hasattr(v, "strftime") else str(v)[:7]
+
+def _append_archive(table: str, columns: List[str], rows_by_month: Dict[str, List[list]]):
+    os.makedirs(_archive_dir(table), exist_ok=True)
+    for month, rows in sorted(rows_by_month.items()):
+        path = os.path.join(_archive_dir(table), f"{month}.csv.gz")
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        with open(path, "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="ab") as gz:
+                text = io.TextIOWrapper(gz, encoding="utf-8", newline="")
+                w = csv.writer(text)
+                if is_new:
+                    w.writerow(columns)
+                w.writerows(rows)
+                text.flush(); text.detach()
+            raw.flush(); os.fsync(raw.fileno())
+
+_month_bounds_cache: Dict[tuple, tuple] = {}
+
+def _scan_month_bounds(table: str, month: str, pk: str) -> tuple:
+    """讀一次整個月份檔取得 (最小, 最大) 主鍵；依檔案大小與修改時間快取（供沒有記錄 bounds 的舊歸檔）"""
+    path = os.path.join(_archive_dir(table), f"{month}.csv.gz")
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    if key not in _month_bounds_cache:
+        lo = hi = None
+        with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+            for r in csv.DictReader(f):
+                v = int(r[pk])
+                lo = v if lo is None or v < lo else lo
+                hi = v if hi is None or v > hi else hi
+        _month_bounds_cache[key] = (lo if lo is not None else 0, hi if hi is not None else 0)
+    return _month_bounds_cache[key]
+
+_archive_decoders_cache: Dict[str, Dict[str, Any]] = {}
+
+def _archive_decoders(table: str) -> Dict[str, Any]:
+    """歸檔 CSV 的值都是字串：取線上資料表各欄位的型別，以 pymysql 的轉換函式轉回（與線上查詢結果一致）"""
+    if table not in _archive_decoders_cache:
+        conn = get_read_db(); c = conn.cursor()
+        try:
+            c.execute(f"SELECT * FROM {table} LIMIT 0")
+            _archive_decoders_cache[table] = {d[0]: pymysql.converters.decoders.get(d[1]) for d in c.description or ()}
+        finally:
+            conn.close()
+    return _archive_decoders_cache[table]
+
+def _decode_archived(value: str, decoder):
+    if value == "":
+        return None  # 歸檔時 NULL 寫成空字串
+    return decoder(value) if decoder else value
+
+def _delete_ids(c, table: str, pk: str, ids: List[int]):
+    if ids:
+        c.execute(f"DELETE FROM {table} WHERE {pk} IN ({', '.join(['%s'] * len(ids))})", ids)
+
+def archive_table(kind: str, cutoff: date) -> Dict[str, Any]:
+    """把 date_col 早於 cutoff 的列分批搬到歸檔檔案，回傳搬移筆數"""
+    spec = EXPORTS[kind]
+    table, pk, date_col = spec["table"], spec["pk"], spec["date_col"]
+    state = _archive_state(table)
+    moved = 0
+    conn = get_db(); c = conn.cursor()
+    try:
+        # 上次中斷：已寫入歸檔但還沒刪除的列
+        _delete_ids(c, table, pk, state.get("pending") or [])
+        state["pending"] = []
+        last = 0
+        while True:
+            c.execute(f"SELECT * FROM {table} WHERE {date_col} < %s AND {pk} > %s ORDER BY {pk} LIMIT %s",
+                      (cutoff, last, RETENTION_BATCH))
+            rows = c.fetchall() or []
+            if not rows:
+                break
+            columns = list(rows[0].keys())
+            by_month = collections.defaultdict(list)
+            bounds = state.setdefault("bounds", {})
+            for r in rows:
+                month = _month_of(r[date_col])
+                by_month[month].append(["" if r[k] is None else r[k] for k in columns])
+                if month not in bounds and os.path.exists(os.path.join(_archive_dir(table), f"{month}.csv.gz")):
+                    bounds[month] = list(_scan_month_bounds(table, month, pk))  # 沒有記錄範圍的舊歸檔先補上
+                lo, hi = bounds.get(month, (r[pk], r[pk]))
+                bounds[month] = [min(lo, r[pk]), max(hi, r[pk])]
+            _append_archive(table, columns, by_month)
+            ids = [r[pk] for r in rows]
+            state["pending"] = ids
+            _archive_state(table, state)
+            _delete_ids(c, table, pk, ids)
+            state["pending"] = []
+            state["archived"] = int(state.get("archived") or 0) + len(ids)
+            state["cutoff"] = str(cutoff)
+            _archive_state(table, state)
+            moved += len(ids)
+            last = ids[-1]
+            time.sleep(RETENTION_SLEEP)
+        if moved:
+            publish_change(c, table, "reload", None, {"archived_before": str(cutoff), "moved": moved})
+            conn.commit()  # 連線為 autocommit，事件已寫入；commit 讓 change feed 立即讀取
+    finally:
+        conn.close()
+    return {"table": table, "moved": moved, "cutoff": str(cutoff)}
+
+def run_retention(days: Optional[int] = None, kinds: Optional[List[str]] = None) -> Dict[str, Any]:
+    """依保存天數歸檔各表；多個 worker 同時執行時只有一個會實際搬移"""
+    cutoff = date.today() - timedelta(days=days if days is not None else RETENTION_DAYS)
+    conn = get_db(); c = conn.cursor()
+    try:
+        c.execute("SELECT GET_LOCK(%s, 0) AS ok", (RETENTION_LOCK,))
+        if not (c.fetchone() or {}).get("ok"):
+            return {"skipped": "其他程序正在歸檔"}
+        try:
+            return {"cutoff": str(cutoff), "tables": [archive_table(k, cutoff) for k in (kinds or RETENTION_KINDS)]}
+        finally:
+            c.execute("SELECT RELEASE_LOCK(%s)", (RETENTION_LOCK,))
+    finally:
+        conn.close()
+
+retention_task = PeriodicTask("retention", RETENTION_INTERVAL, run_retention)
+
+def archive_covers(kind: str, start: Optional[date], end: Optional[date]) -> bool:
+    if kind not in RETENTION_KINDS:
+        return False
+    months = archive_months(EXPORTS[kind]["table"])
+    return bool(months) and (start is None or months[-1] >= start.strftime("%Y-%m")) \
+        and (end is None or months[0] <= end.strftime("%Y-%m"))
+
+def _archive_plan(kind: str, start: Optional[date], end: Optional[date], before: Optional[int] = None) -> List[tuple]:
+    """日期區間內的歸檔月份 [(該月最大主鍵, 月份)]，依最大主鍵由大到小；主鍵全都 >= before 的月份略過"""
+    spec = EXPORTS[kind]
+    table = spec["table"]
+    recorded = _archive_state(table).get("bounds") or {}
+    months = []
+    for month in archive_months(table):
+        if (start and month < start.strftime("%Y-%m")) or (end and month > end.strftime("%Y-%m")):
+            continue
+        b = tuple(recorded[month]) if month in recorded else _scan_month_bounds(table, month, spec["pk"])
+        if before is None or b[0] < before:
+            months.append((b[1], month))
+    months.sort(reverse=True)
+    return months
+
+def _read_archive_month(kind: str, month: str, start: Optional[date], end: Optional[date], fixture: Optional[str],
+                        before: Optional[int] = None) -> List[tuple]:
+    """讀一個月份檔中符合條件的 [(pk, dict)]，由新到舊、依主鍵去重"""
+    spec = EXPORTS[kind]
+    table, pk, date_col = spec["table"], spec["pk"], spec["date_col"]
+    lo = start.isoformat() if start else None
+    hi = end.isoformat() if end else None
+    seen, rows = set(), []
+    with gzip.open(os.path.join(_archive_dir(table), f"{month}.csv.gz"), "rt", encoding="utf-8", newline="") as f:
+        for r in csv.DictReader(f):
+            day = r[date_col][:10]
+            if (lo and day < lo) or (hi and day > hi) or (fixture and r[spec["fixture_col"]] != fixture):
+                continue
+            key = int(r[pk])
+            if (before is None or key < before) and key not in seen:
+                seen.add(key); rows.append((key, r))
+    rows.sort(key=lambda kv: kv[0], reverse=True)
+    return rows
+
+def iter_archive_rows(kind: str, start: Optional[date], end: Optional[date], fixture: Optional[str]):
+    """以匯出欄位順序產生批次，格式與 _iter_export_rows 相同"""
+    cols = [col for col, _ in EXPORTS[kind]["columns"]]
+    decoders = _archive_decoders(EXPORTS[kind]["table"])
+    for _, month in _archive_plan(kind, start, end):
+        rows = _read_archive_month(kind, month, start, end, fixture)
+        for i in range(0, len(rows), EXPORT_FETCH_ROWS):
+            yield [tuple(_decode_archived(r.get(col) or "", decoders.get(col)) for col in cols)
+                   for _, r in rows[i:i + EXPORT_FETCH_ROWS]]
+
+@app.get("/history/{kind}")
+def query_history(kind: str, start: Optional[date] = None, end: Optional[date] = None, fixture: Optional[str] = None,
+                  before: Optional[int] = None, limit: int = PageLimit, layout: str = Layout):
+    """
+    依日期區間查詢 logs / usage_logs / replacement_logs，區間超過保存期限時一併讀取歸檔。
+    由新到舊（依主鍵）排序；下一頁以回傳的 next_before 帶入 before。
+    """
+    if kind not in RETENTION_KINDS:
+        raise HTTPException(status_code=404, detail=f"不支援的查詢類型：{kind}")
+    spec = EXPORTS[kind]
+    sql, params = _export_query(spec, start, end, fixture, before=before, with_pk=True)
+    cols = [spec["pk"]] + [col for col, _ in spec["columns"]]
+    with get_read_db() as conn:
+        c = conn.cursor()
+        c.execute(f"{sql} LIMIT %s", params + [limit + 1])
+        rows = c.fetchall() or []
+    if len(rows) <= limit and archive_covers(kind, start, end):
+        need = limit + 1 - len(rows)
+        top: List[tuple] = []  # 目前主鍵最大的 need 筆（min-heap）
+        for month_hi, month in _archive_plan(kind, start, end, before):
+            if len(top) >= need and month_hi < top[0][0]:
+                break  # 之後的月份主鍵都更小，不必再讀
+            for key, r in _read_archive_month(kind, month, start, end, fixture, before):
+                if len(top) < need:
+                    heapq.heappush(top, (key, r))
+                elif key > top[0][0]:
+                    heapq.heapreplace(top, (key, r))
+                else:
+                    break  # 月內由大到小，後面的更小
+        decoders = _archive_decoders(spec["table"])
+        rows += [{col: _decode_archived(r.get(col) or "", decoders.get(col)) if col != spec["pk"] else key for col in cols}
+                 for key, r in sorted(top, key=lambda kv: kv[0], reverse=True)]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    page = {"data": rows, "next_cursor": None, "limit": limit,
+            "next_before": rows[-1][spec["pk"]] if has_more and rows else None}
+    return FastJSONResponse(shape_page(page, layout))
+
+@app.get("/archives")
+def list_archives():
+    out = {}
+    for kind in RETENTION_KINDS:
+        table = EXPORTS[kind]["table"]
+        out[kind] = {"state": _archive_state(table), "months": [
+            {"month": m, "bytes": os.path.getsize(os.path.join(_archive_dir(table), f"{m}.csv.gz"))}
+            for m in archive_months(table)]}
+    return {"archive_dir": ARCHIVE_DIR, "retention_days": RETENTION_DAYS, "scheduled": RETENTION_ENABLED, "kinds": out}
+
+@app.post("/archives/run")
+def run_archives(days: Optional[int] = Query(None, ge=1)):
+    """立即歸檔超過 days（預設 RETENTION_DAYS）天的資料"""
+    return run_retention(days)
+
+# ---------- Backup (資料庫備份) ----------
+# 以背景 job 執行 mysqldump（--single-transaction，不鎖表），gzip 後存到 BACKUP_DIR/db_backup_<時間>.sql.gz，
+# 只保留最新 BACKUP_KEEP 份。BACKUP_INTERVAL_HOURS > 0 時定期排程（多個 worker 以 GET_LOCK 協調，只排一次）；
+# 也可手動 POST /jobs {"kind": "backup"}。
+BACKUP_DIR = os.getenv("BACKUP_DIR", "/backup")
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "0"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "14"))
+BACKUP_LOCK = "fixture_suite_backup"
+
+def _prune_backups():
+    names = sorted(n for n in os.listdir(BACKUP_DIR) if n.startswith("db_backup_") and n.endswith(".sql.gz"))
+    for name in names[:-BACKUP_KEEP] if BACKUP_KEEP > 0 else []:
+        with contextlib.suppress(OSError):
+            os.remove(os.path.join(BACKUP_DIR, name))
+
+@job_kind("backup", BackupJobIn)
+def backup_job(ctx: JobContext) -> Dict[str, Any]:
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    filename = f"db_backup_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.sql.gz"
+    path = os.path.join(BACKUP_DIR, filename)
+    part = path + ".part"
+    cmd = ["mysqldump", "-h", DB_HOST, "-P", str(DB_PORT), "-u", DB_USER,
+           "--single-transaction", "--quick", "--routines", "--triggers", DB_NAME]
+    # 密碼走環境變數，不出現在 ps 的命令列
+    env = dict(os.environ, MYSQL_PWD=DB_PASS)
+    size = 0
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err, env=env)
+        try:
+            with gzip.open(part, "wb") as out:
+                while True:
+                    data = proc.stdout.read(1 << 20)
+                    if not data:
+                        break
+                    out.write(data)
+                    size += len(data)
+                    ctx.progress(message=f"已備份 {size / 1e6:.1f} MB")
+            code = proc.wait()
+        except BaseException:
+            proc.kill(); proc.wait()
+            with contextlib.suppress(OSError):
+                os.remove(part)
+            raise
+        finally:
+            proc.stdout.close()
+        if code != 0:
+            with contextlib.suppress(OSError):
+                os.remove(part)
+            err.seek(0)
+            raise RuntimeError(f"mysqldump 失敗（{code}）：{err.read().decode('utf-8', 'replace').strip()[:500]}")
+    os.replace(part, path)
+    _prune_backups()
+    return {"file": path, "filename": filename, "media_type": "application/gzip",
+            "size": os.path.getsize(path), "dump_bytes": size}
+
+def schedule_backup() -> Optional[str]:
+    """距離上次成功的備份超過 BACKUP_INTERVAL_HOURS 且沒有進行中的備份時，排入一個備份 job"""
+    conn = get_db(); c = conn.cursor()
+    try:
+        c.execute("SELECT GET_LOCK(%s, 0) AS ok", (BACKUP_LOCK,))
+        if not (c.fetchone() or {}).get("ok"):
+            return None
+        try:
+            c.execute("""
+                SELECT 1 FROM jobs WHERE kind='backup'
+                  AND (status IN ('queued','running')
+                       OR (status='succeeded' AND finished_at >= NOW() - INTERVAL %s SECOND))
+                LIMIT 1
+            """, (int(BACKUP_INTERVAL_HOURS * 3600),))
+            if c.fetchone():
+                return None
+            return job_runner.submit("backup", {}, created_by="scheduler")
+        finally:
+            c.execute("SELECT RELEASE_LOCK(%s)", (BACKUP_LOCK,))
+    finally:
+        conn.close()
 
-    data = ("\ufeff" + buf.getvalue()).encode("utf-8")  # add BOM
-    return StreamingResponse(io.BytesIO(data), media_type="text/csv",
-                             headers={"Content-Disposition": "attachment; filename=logs.csv"})
+backup_task = PeriodicTask("backup-scheduler", 600, schedule_backup)
 
 # ---------- SMTP Settings ----------
 @app.get("/settings/smtp")
-def get_smtp_settings():
-    conn = get_db(); c = conn.cursor()
-    c.execute("SELECT skey, svalue FROM settings WHERE category='smtp'")
-    rows = c.fetchall() or []; conn.close()
-    out = {r["skey"]: r["svalue"] for r in rows}
-    return out
+def get_smtp_settings(request: Request):
+    return conditional_json(request, ["settings"], load_smtp_settings)
+
+def load_smtp_settings() -> Dict[str, str]:
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT skey, svalue FROM settings WHERE category='smtp'")
+        rows = c.fetchall() or []
+    return {r["skey"]: r["svalue"] or "" for r in rows}
+
+def send_mail(smtp: Dict[str, str], msg: EmailMessage):
+    """依 SMTP 設定寄信：465 用 SSL，其他 port 伺服器支援時自動 STARTTLS；有帳號才登入"""
+    host, port = smtp.get("host"), int(smtp.get("port") or 25)
+    cls = smtplib.SMTP_SSL if port == 465 else smtplib.SMTP
+    with cls(host, port, timeout=30) as server:
+        if cls is smtplib.SMTP:
+            server.ehlo()
+            if server.has_extn("starttls"):
+                server.starttls(); server.ehlo()
+        if smtp.get("user"):
+            server.login(smtp["user"], smtp.get("pass") or "")
+        server.send_message(msg)
 
 @app.post("/settings/smtp")
 def save_smtp_settings(
@@ -576,108 +3668,1515 @@ def save_smtp_settings(
     user: str = Form(...),
     password: str = Form(...),
     sender: str = Form(...),
+    alert_to: str = Form(""),
 ):
     conn = get_db(); c = conn.cursor()
-    pairs = {"host":host, "port":str(port), "user":user, "pass":password, "sender":sender}
-    for k,v in pairs.items():
-        c.execute("""INSERT INTO settings (category, skey, svalue) VALUES ('smtp', %s, %s)
-                     ON DUPLICATE KEY UPDATE svalue=VALUES(svalue)""", (k, v))
-    conn.commit(); conn.close()
+    pairs = {"host":host, "port":str(port), "user":user, "pass":password, "sender":sender, "alert_to":alert_to}
+    try:
+        conn.begin()  # 六個設定值一起生效
+        for k,v in pairs.items():
+            c.execute("""INSERT INTO settings (category, skey, svalue) VALUES ('smtp', %s, %s)
+                         ON DUPLICATE KEY UPDATE svalue=VALUES(svalue)""", (k, v))
+        touch_tables(c, "settings")
+        publish_change(c, "settings", "update", "smtp", {k: v for k, v in pairs.items() if k != "pass"})
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
     return {"ok": True}
 
 # ---------- Stats ----------
-@app.get("/stats/summary")
-def stats_summary():
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "30"))
+
+def compute_stats_summary() -> Dict[str, Any]:
+    # 一次 GROUP BY 掃描 fixtures，所有統計都由這個結果彙總。
+    # 讀 primary：結果被所有用戶端共用，寫入後 invalidate 的重算若讀到落後的 replica，舊值會被快取 STATS_CACHE_TTL 秒
     conn = get_db(); c = conn.cursor()
-    def one(sql: str, params: tuple = ()):
-        c.execute(sql, params); row = c.fetchone() or {}; return int(list(row.values())[0]) if row else 0
     try:
-        total = one("SELECT COUNT(*) AS n FROM fixtures")
-        active = one("SELECT COUNT(*) AS n FROM fixtures WHERE status='active'")
-        under = one("SELECT COUNT(*) AS n FROM fixtures WHERE life_type='count' AND used < life_value")
-        need = one("SELECT COUNT(*) AS n FROM fixtures WHERE life_type='count' AND used >= life_value")
-    except Exception:
-        init_tables(); total=active=under=need=0
+        c.execute("""SELECT status, life_type, COUNT(*) AS n,
+                            SUM(used < life_value) AS under_n,
+                            SUM(used >= life_value) AS need_n
+                     FROM fixtures GROUP BY status, life_type""")
+        rows = c.fetchall() or []
     finally:
         conn.close()
-    return {"total_fixtures": total, "active_fixtures": active, "under_lifespan": under, "need_replacement": need}
+    total = active = under = need = 0
+    by_status, by_life_type = collections.Counter(), collections.Counter()
+    for r in rows:
+        n = int(r["n"] or 0)
+        total += n
+        by_status[r["status"] or ""] += n
+        by_life_type[r["life_type"] or ""] += n
+        if r["status"] == "active":
+            active += n
+        if r["life_type"] == "count":
+            under += int(r["under_n"] or 0)
+            need += int(r["need_n"] or 0)
+    return {"total_fixtures": total, "active_fixtures": active, "under_lifespan": under, "need_replacement": need,
+            "by_status": dict(by_status), "by_life_type": dict(by_life_type)}
+
+stats_cache = CachedValue(compute_stats_summary, STATS_CACHE_TTL)
+
+@app.get("/stats/summary")
+def stats_summary():
+    return stats_cache.get()
+
+# ---------- Search (搜尋) ----------
+# 程序內搜尋索引，查詢不掃全表：
+#   - 每個欄位維護 (文字, key) 排序清單，完全相同/開頭相符以二分搜尋取出
+#   - 3-gram posting 交集後再確認子字串，處理「包含」的查詢
+# 經 API 的寫入即時更新；其他 worker 或直接改 DB 的異動由 SEARCH_RELOAD_INTERVAL 秒的整批重載補上。
+# 重載在背景工作（search_refresh_task）建好新索引後整個換上，查詢不會等重建；
+# 建立期間經 API 的異動先記下，換上前補進新索引。只有程序啟動後第一次查詢某個 kind 時會同步建立。
+# 少於 3 個字的「包含」查詢（例如單一中文字）沒有 3-gram 可用，改為掃描記憶體內文字，
+# 建議清單最多檢查 SEARCH_SCAN_MAX 筆，保持延遲固定。
+SEARCH_RELOAD_INTERVAL = float(os.getenv("SEARCH_RELOAD_INTERVAL", "300"))
+SEARCH_SCAN_MAX = int(os.getenv("SEARCH_SCAN_MAX", "5000"))
+SEARCH_SUGGEST_MAX = 50
+SEARCH_REFRESH_TICK = 1.0  # 背景工作檢查是否需要重建的間隔（秒）
+
+# kind -> 資料表、鍵、可搜尋欄位（依權重由高到低）、載入欄位
+SEARCH_KINDS = {
+    "fixture": {"table": "fixtures", "key": "id", "fields": ["name", "status"], "select": "id, name, status"},
+    "fixture_model": {"table": "fixture_models", "key": "code", "fields": ["code", "name", "spec"], "select": "code, name, spec"},
+    "machine_model": {"table": "machine_models", "key": "code", "fields": ["code", "name"], "select": "code, name"},
+    "user": {"table": "users", "key": "username", "fields": ["username", "role"], "select": "username, role"},
+}
+MATCH_TYPES = ("exact", "prefix", "word", "contains")
+
+def _norm_text(v) -> str:
+    return str(v or "").strip().casefold()
+
+def _trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class TrigramIndex:
+    def __init__(self, key: str, fields: List[str]):
+        self.key = key
+        self.fields = fields
+        self.docs: Dict[Any, tuple] = {}  # key -> (payload, 正規化後的欄位文字)
+        self.postings: Dict[str, set] = collections.defaultdict(set)
+        self.sorted: List[list] = [[] for _ in fields]  # 每個欄位的 (文字, key) 排序清單
+
+    @classmethod
+    def build(cls, key: str, fields: List[str], rows: List[Dict[str, Any]]) -> "TrigramIndex":
+        """整批建立：排序清單先收集、最後各排序一次（逐筆 insort 是 O(n²)）"""
+        idx = cls(key, fields)
+        for r in rows:
+            k = r[key]
+            texts = tuple(_norm_text(r.get(f)) for f in fields)
+            idx.docs[k] = (r, texts)
+            for i, t in enumerate(texts):
+                if t:
+                    idx.sorted[i].append((t, k))
+            for g in set().union(*(_trigrams(t) for t in texts)):
+                idx.postings[g].add(k)
+        for lst in idx.sorted:
+            lst.sort()
+        return idx
+
+    def put(self, payload: Dict[str, Any]):
+        k = payload[self.key]
+        self.remove(k)
+        texts = tuple(_norm_text(payload.get(f)) for f in self.fields)
+        self.docs[k] = (payload, texts)
+        for i, t in enumerate(texts):
+            if t:
+                bisect.insort(self.sorted[i], (t, k))
+        for g in set().union(*(_trigrams(t) for t in texts)):
+            self.postings[g].add(k)
+
+    def remove(self, k):
+        old = self.docs.pop(k, None)
+        if old is None:
+            return
+        for i, t in enumerate(old[1]):
+            lst = self.sorted[i]
+            pos = bisect.bisect_left(lst, (t, k))
+            if pos < len(lst) and lst[pos] == (t, k):
+                del lst[pos]
+        for g in set().union(*(_trigrams(t) for t in old[1])):
+            keys = self.postings.get(g)
+            if keys is not None:
+                keys.discard(k)
+                if not keys:
+                    del self.postings[g]
+
+    def prefixed(self, q: str, field: int, limit: int):
+        """欄位開頭為 q 的 (文字, key)，依文字排序，最多 limit 筆"""
+        lst = self.sorted[field]
+        out = []
+        for i in range(bisect.bisect_left(lst, (q,)), len(lst)):
+            if len(out) >= limit or not lst[i][0].startswith(q):
+                break
+            out.append(lst[i])
+        return out
+
+    def candidates(self, q: str):
+        grams = _trigrams(q)
+        if not grams:
+            return self.docs.keys()
+        sets = sorted((self.postings.get(g, set()) for g in grams), key=len)
+        out = set(sets[0])
+        for s in sets[1:]:
+            out &= s
+            if not out:
+                break
+        return out
+
+    def contains(self, q: str, k) -> bool:
+        return any(q in t for t in self.docs[k][1])
+
+    def rank(self, q: str, k) -> Optional[tuple]:
+        """(類型, 欄位, 文字)：類型 0 完全相同、1 開頭相符、2 字首相符、3 包含；越小越前面"""
+        best = None
+        for i, text in enumerate(self.docs[k][1]):
+            pos = text.find(q)
+            if pos < 0:
+                continue
+            tier = (0 if text == q else 1) if pos == 0 else (2 if not text[pos - 1].isalnum() else 3)
+            r = (tier, i, text)
+            if best is None or r < best:
+                best = r
+        return best
+
+class SearchIndex:
+    def __init__(self, reload_interval: float):
+        self.reload_interval = reload_interval
+        self._lock = threading.RLock()  # 保護索引內容與切換；查詢只持有幾毫秒，重建時不持有
+        self._indexes: Dict[str, TrigramIndex] = {}
+        self._loaded_at: Dict[str, float] = {}
+        self._dirty: set = set()
+        self._pending: Dict[str, list] = {}  # 重建中的 kind -> 期間的 (put/remove, 參數)
+        self._build_locks = {kind: threading.Lock() for kind in SEARCH_KINDS}
+        self.rebuilds = 0
+        self.last_build_ms: Dict[str, float] = {}
+
+    def _build(self, kind: str):
+        spec = SEARCH_KINDS[kind]
+        t0 = time.perf_counter()
+        with self._lock:
+            self._pending[kind] = []
+            self._dirty.discard(kind)  # 建立期間再被標記的會在下一輪重建
+        try:
+            conn = get_db(); c = conn.cursor()
+            try:
+                c.execute(f"SELECT {spec['select']} FROM {spec['table']}")
+                rows = c.fetchall() or []
+            finally:
+                conn.close()
+            idx = TrigramIndex.build(spec["key"], spec["fields"], rows)
+        except Exception:
+            with self._lock:
+                self._pending.pop(kind, None)
+            raise
+        with self._lock:
+            for op, arg in self._pending.pop(kind):
+                idx.put(arg) if op == "put" else idx.remove(arg)
+            self._indexes[kind] = idx
+            self._loaded_at[kind] = time.monotonic()
+        self.rebuilds += 1
+        self.last_build_ms[kind] = round((time.perf_counter() - t0) * 1000, 1)
+
+    def reload(self, kind: str):
+        with self._build_locks[kind]:
+            self._build(kind)
+
+    def refresh(self) -> Dict[str, Any]:
+        """背景工作：重建已載入過、且過期或被標記的索引"""
+        now = time.monotonic()
+        rebuilt = []
+        for kind in list(self._indexes):
+            if kind in self._dirty or now - self._loaded_at.get(kind, 0) > self.reload_interval:
+                self.reload(kind)
+                rebuilt.append(kind)
+        return {"rebuilt": rebuilt} if rebuilt else None
+
+    def ensure(self, kind: str) -> TrigramIndex:
+        idx = self._indexes.get(kind)
+        if idx is None:
+            with self._build_locks[kind]:
+                if kind not in self._indexes:
+                    self._build(kind)
+            idx = self._indexes[kind]
+        return idx
+
+    def mark_dirty(self, kind: str):
+        self._dirty.add(kind)
+
+    def _apply(self, kind: str, op: str, arg):
+        with self._lock:
+            if kind in self._pending:
+                self._pending[kind].append((op, arg))
+            if kind in self._indexes:  # 尚未載入時略過，第一次查詢會整批載入
+                idx = self._indexes[kind]
+                idx.put(arg) if op == "put" else idx.remove(arg)
+
+    def put(self, kind: str, payload: Dict[str, Any]):
+        self._apply(kind, "put", payload)
+
+    def remove(self, kind: str, key):
+        self._apply(kind, "remove", key)
+
+    def search_keys(self, kind: str, q: str) -> List[Any]:
+        """所有任一欄位包含 q 的 key（列表篩選用，不排序）"""
+        q = _norm_text(q)
+        if not q:
+            return []
+        self.ensure(kind)
+        with self._lock:
+            idx = self._indexes[kind]
+            return [k for k in idx.candidates(q) if idx.contains(q, k)]
+
+    def suggest(self, kind: str, q: str, limit: int) -> List[tuple]:
+        """回傳前 limit 筆 [(排序鍵, key)]；開頭相符一律排在包含之前"""
+        q = _norm_text(q)
+        if not q:
+            return []
+        self.ensure(kind)
+        with self._lock:
+            idx = self._indexes[kind]
+            ranked: Dict[Any, tuple] = {}
+            for i in range(len(idx.fields)):
+                for text, k in idx.prefixed(q, i, limit):
+                    r = (0 if text == q else 1, i, text)
+                    if k not in ranked or r < ranked[k]:
+                        ranked[k] = r
+            if len(ranked) < limit:
+                for n, k in enumerate(idx.candidates(q)):
+                    if n >= SEARCH_SCAN_MAX:
+                        break
+                    if k not in ranked:
+                        r = idx.rank(q, k)
+                        if r is not None:
+                            ranked[k] = r
+        top = heapq.nsmallest(limit, ranked.items(), key=lambda kv: (kv[1], str(kv[0])))
+        return [(r, k) for k, r in top]
+
+    def payload(self, kind: str, key) -> Dict[str, Any]:
+        with self._lock:
+            doc = self._indexes[kind].docs.get(key)
+        return dict(doc[0]) if doc else {}
+
+search_index = SearchIndex(SEARCH_RELOAD_INTERVAL)
+search_refresh_task = PeriodicTask("search-refresh", SEARCH_REFRESH_TICK, search_index.refresh)
+
+@app.get("/search/suggest")
+def search_suggest(q: str, kinds: Optional[str] = None, limit: int = Query(10, ge=1, le=SEARCH_SUGGEST_MAX)):
+    """
+    輸入框即時建議：搜尋治具名稱、治具資料（代碼/名稱/規格）、機種代碼。
+    kinds 以逗號分隔，可選 fixture, fixture_model, machine_model, user。
+    排序：完全相同 > 開頭相符 > 字首相符 > 包含，同類型時前面的欄位（代碼/名稱）優先。
+    """
+    t0 = time.perf_counter()
+    wanted = [k.strip() for k in (kinds or "fixture,fixture_model,machine_model").split(",") if k.strip()]
+    unknown = [k for k in wanted if k not in SEARCH_KINDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"不支援的搜尋類型：{', '.join(unknown)}")
+    hits = []
+    for kind in wanted:
+        fields = SEARCH_KINDS[kind]["fields"]
+        for (tier, i, text), key in search_index.suggest(kind, q, limit):
+            hits.append(((tier, i, text, kind), kind, key, fields[i]))
+    hits = heapq.nsmallest(limit, hits, key=lambda h: (h[0], str(h[2])))
+    results = [{"kind": kind, "key": key, "match": field, "match_type": MATCH_TYPES[r[0]], **search_index.payload(kind, key)}
+               for r, kind, key, field in hits]
+    return {"q": q, "results": results, "took_ms": round((time.perf_counter() - t0) * 1000, 3)}
+
+# ---------- Dashboard ----------
+def etag_json_response(request: Request, payload: Any, headers: Optional[Dict[str, str]] = None) -> Response:
+    """以內容雜湊產生 ETag；用戶端帶相同 If-None-Match 時回 304，不重送內容"""
+    body = dumps_json(payload)
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    hdrs = {"ETag": etag, **(headers or {})}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=hdrs)
+    return Response(content=body, media_type="application/json", headers=hdrs)
+
+def recent_rows(table: str, pk: str, n: int, columns: str = "*") -> List[Dict[str, Any]]:
+    with get_read_db() as conn:
+        c = conn.cursor()
+        c.execute(f"SELECT {columns} FROM {table} ORDER BY {pk} DESC LIMIT %s", (n,))
+        return c.fetchall() or []
+
+DASHBOARD_DOC_COLUMNS = "id, type, vendor, order_no, fixture_code, operator, created_at"
+
+@app.get("/dashboard")
+async def dashboard(request: Request, recent: int = Query(5, ge=1, le=50)):
+    """儀表板一次取得：統計、最近收料、最近退料（三者並行查詢）"""
+    stats, receipts, returns = await asyncio.gather(
+        run_in_threadpool(stats_cache.get),
+        run_in_threadpool(recent_rows, "receipts", "id", recent, DASHBOARD_DOC_COLUMNS),
+        run_in_threadpool(recent_rows, "returns_table", "id", recent, DASHBOARD_DOC_COLUMNS),
+    )
+    return etag_json_response(request, {"stats": stats, "recent_receipts": receipts, "recent_returns": returns})
+
+# ---------- Capacity (開站數) ----------
+# 庫存與需求常駐記憶體：庫存為 fixture_inventory 的在庫數（見 Inventory），需求為 fixture_requirements。
+# 經由 API 的異動（包含其他 worker 的，經 change feed）增量更新；
+# change feed 關閉或直接改 DB 的異動則靠 CAPACITY_RELOAD_INTERVAL 秒的整批重載補上。
+CAPACITY_RELOAD_INTERVAL = float(os.getenv("CAPACITY_RELOAD_INTERVAL", "60"))
+CAPACITY_BATCH_MAX = int(os.getenv("CAPACITY_BATCH_MAX", "500"))
+
+class CapacityIndex:
+    def __init__(self, reload_interval: float):
+        self.reload_interval = reload_interval
+        self._lock = threading.RLock()
+        self._loaded_at = 0.0
+        self._stock: Dict[str, int] = {}                    # fixture_code -> 在庫數
+        self._reqs: Dict[str, Dict[int, tuple]] = {}        # model -> {req id: (station, fixture_code, qty)}
+        self._req_model: Dict[int, str] = {}                # req id -> model
+        self.reloads = 0
+
+    def reload(self):
+        conn = get_db(); c = conn.cursor()
+        try:
+            c.execute("SELECT fixture_code, on_hand FROM fixture_inventory")
+            stock = {r["fixture_code"]: int(r["on_hand"] or 0) for r in c.fetchall() or []}
+            c.execute("SELECT id, model_code, station, fixture_code, required_qty FROM fixture_requirements")
+            reqs = c.fetchall() or []
+        finally:
+            conn.close()
+        req_index, req_model = {}, {}
+        for r in reqs:
+            req_index.setdefault(r["model_code"], {})[r["id"]] = (r["station"], r["fixture_code"], int(r["required_qty"] or 0))
+            req_model[r["id"]] = r["model_code"]
+        with self._lock:
+            self._stock = stock
+            self._reqs, self._req_model = req_index, req_model
+            self._loaded_at = time.monotonic()
+            self.reloads += 1
+
+    def ensure_loaded(self):
+        if time.monotonic() - self._loaded_at > self.reload_interval:
+            with self._lock:
+                if time.monotonic() - self._loaded_at > self.reload_interval:
+                    self.reload()
+
+    # --- 增量更新（尚未載入時略過，下次查詢會整批載入） ---
+    def stock_changed(self, fixture_code: str, on_hand: int):
+        with self._lock:
+            if self._loaded_at:
+                self._stock[fixture_code] = int(on_hand or 0)
+
+    def requirement_saved(self, rid: int, model_code: str, station: str, fixture_code: str, qty: int):
+        with self._lock:
+            if not self._loaded_at:
+                return
+            self.requirement_deleted(rid)
+            self._reqs.setdefault(model_code, {})[rid] = (station, fixture_code, int(qty or 0))
+            self._req_model[rid] = model_code
+
+    def requirement_deleted(self, rid: int):
+        with self._lock:
+            model = self._req_model.pop(rid, None)
+            if model is not None:
+                reqs = self._reqs.get(model, {})
+                reqs.pop(rid, None)
+                if not reqs:
+                    self._reqs.pop(model, None)
+
+    def stock_of(self, fixture_code: str) -> int:
+        return self._stock.get(fixture_code, 0)
+
+    def apply_changes(self, events: List[Dict[str, Any]]):
+        """change feed listener：套用庫存與需求的異動（其他 worker 寫入的也會收到）"""
+        for e in events:
+            t, f = e["table"], e["fields"] or {}
+            if t == "fixture_inventory" and e["op"] == "update":
+                self.stock_changed(e["id"], f.get("on_hand"))
+            elif t == "fixture_requirements" and e["op"] == "insert":
+                self.requirement_saved(int(e["id"]), f["model_code"], f["station"], f["fixture_code"], f["required_qty"])
+            elif t == "fixture_requirements" and e["op"] == "delete":
+                self.requirement_deleted(int(e["id"]))
+
+    def compute(self, model_code: str, what_if: Optional[Dict[str, int]] = None) -> Optional[Dict[str, Any]]:
+        """
+        回傳該機種各站可開站數與瓶頸治具；what_if 可覆寫部分治具的庫存做假設試算。
+        找不到機種需求時回傳 None。
+        """
+        with self._lock:
+            reqs = list((self._reqs.get(model_code) or {}).values())
+            if not reqs:
+                return None
+            stock = {f: self.stock_of(f) for _, f, _ in reqs}
+        if what_if:
+            stock.update({f: q for f, q in what_if.items() if f in stock})
+        stations: Dict[str, int] = {}
+        bottlenecks: Dict[str, Dict[str, Any]] = {}
+        for station, f, need in reqs:
+            have = stock.get(f, 0)
+            possible = have // need if need else 0
+            if station not in stations or possible < stations[station]:
+                stations[station] = possible
+                bottlenecks[station] = {"fixture_code": f, "stock_qty": have, "required_qty": need}
+        return {"model": model_code, "stations": stations, "bottlenecks": bottlenecks}
+
+capacity = CapacityIndex(CAPACITY_RELOAD_INTERVAL)
+change_feed.on_change(capacity.apply_changes)
 
 @app.get("/models/max_stations")
 def get_max_stations(model_code: str):
     """
     計算指定機種在各站可開的最大站數
     """
-    conn = get_db(); c = conn.cursor()
+    capacity.ensure_loaded()
+    result = capacity.compute(model_code)
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"找不到機種 {model_code} 的需求資料")
+    return result
 
-    # 查詢該機種各站治具需求
-    c.execute("""
-        SELECT station, fixture_code, required_qty
-        FROM fixture_requirements
-        WHERE model_code=%s
-    """, (model_code,))
-    reqs = c.fetchall()
+@app.post("/models/max_stations/batch")
+def get_max_stations_batch(body: CapacityQuery):
+    """
+    一次計算多個機種的各站可開站數與瓶頸治具。
+    what_if：{治具編號: 假設庫存}，只影響本次試算，不會寫入資料庫。
+    """
+    if len(body.model_codes) > CAPACITY_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"一次最多 {CAPACITY_BATCH_MAX} 個機種")
+    capacity.ensure_loaded()
+    results, missing = [], []
+    for code in dict.fromkeys(body.model_codes):
+        r = capacity.compute(code, body.what_if)
+        if r is None:
+            missing.append(code)
+        else:
+            results.append(r)
+    return {"results": results, "missing": missing, "what_if": bool(body.what_if)}
+
+@app.get("/models/requirements")
+def list_requirements(model_code: str):
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("""SELECT id, model_code, station, fixture_code, required_qty FROM fixture_requirements
+                     WHERE model_code=%s ORDER BY station, id""", (model_code,))
+        return c.fetchall() or []
+
+@app.post("/models/requirements")
+def add_requirement(body: RequirementIn):
+    conn = get_db(); c = conn.cursor()
+    try:
+        conn.begin()
+        c.execute("""INSERT INTO fixture_requirements (model_code, station, fixture_code, required_qty) VALUES (%s,%s,%s,%s)""",
+                  (body.model_code, body.station, body.fixture_code, body.required_qty))
+        rid = c.lastrowid
+        publish_change(c, "fixture_requirements", "insert", rid, {"id": rid, **body.model_dump()})
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    capacity.requirement_saved(rid, body.model_code, body.station, body.fixture_code, body.required_qty)
+    return {"ok": True, "id": rid}
 
-    if not reqs:
+@app.delete("/models/requirements/{rid}")
+def del_requirement(rid: int):
+    conn = get_db(); c = conn.cursor()
+    try:
+        conn.begin()
+        c.execute("DELETE FROM fixture_requirements WHERE id=%s", (rid,))
+        if c.rowcount:
+            publish_change(c, "fixture_requirements", "delete", rid)
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
         conn.close()
-        raise HTTPException(status_code=404, detail=f"找不到機種 {model_code} 的需求資料")
+    capacity.requirement_deleted(rid)
+    return {"ok": True}
 
-    # 查庫存
-    c.execute("SELECT name AS fixture_code, life_value AS stock_qty FROM fixtures")
-    stock = {r["fixture_code"]: r["stock_qty"] for r in c.fetchall()}
+# ---------- Usage Logs (使用記錄) ----------
+# 站台每個 cycle 都會上報，為避免每筆一次 INSERT + commit，先放進程序內的 write-behind 緩衝，
+# 每 USAGE_FLUSH_INTERVAL 秒（或累積 USAGE_FLUSH_ROWS 筆）以一個交易批次寫入：
+#   - usage_logs 以 multi-row INSERT 寫入
+#   - 同一治具的 use_count 先合併，再以 used = used + n 原子更新 fixtures.used
+# 遺失上限：程序異常終止時最多遺失一個 flush 週期內、且不超過 USAGE_BUFFER_MAX 筆的資料；
+# 正常關閉（lifespan shutdown）會先寫完。緩衝滿時回 503，由站台重送。
+# 連線等暫時性錯誤整批放回緩衝重試；資料本身寫不進去（DataError / IntegrityError）時改逐筆寫入，
+# 寫不進去的列記入 dead letter（GET /usage_logs/buffer 可查看最近 USAGE_DEAD_LETTER_KEEP 筆），不擋住後面的資料。
+# usage_logs.fixture_id 對應 fixtures.name（與 /models/max_stations 的治具編號一致）。
+USAGE_BUFFER_ENABLED = os.getenv("USAGE_BUFFER_ENABLED", "1") == "1"
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "1.0"))
+USAGE_FLUSH_ROWS = int(os.getenv("USAGE_FLUSH_ROWS", "2000"))
+USAGE_BUFFER_MAX = int(os.getenv("USAGE_BUFFER_MAX", "50000"))
+USAGE_BATCH_MAX = int(os.getenv("USAGE_BATCH_MAX", "5000"))
+USAGE_DEAD_LETTER_KEEP = 100
+USAGE_PERMANENT_ERRORS = (pymysql.err.DataError, pymysql.err.IntegrityError)
 
-    conn.close()
+USAGE_COLUMNS = ("fixture_id", "serial_number", "station_id", "use_count", "abnormal_status", "note", "operator")
 
-    # 計算
-    station_avail = {}
-    for r in reqs:
-        f = r["fixture_code"]
-        s = r["station"]
-        need = r["required_qty"] or 0
-        have = stock.get(f, 0)
-        possible = have // need if need else 0
-        station_avail.setdefault(s, []).append(possible)
+class UsageBuffer:
+    def __init__(self, interval: float, flush_rows: int, max_rows: int):
+        self.interval = interval
+        self.flush_rows = flush_rows
+        self.max_rows = max_rows
+        self._pending: List[tuple] = []  # (enqueued_monotonic, row tuple)
+        self._lock = threading.Lock()        # 保護 _pending
+        self._flush_lock = threading.Lock()  # 同時只有一個 flush
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._listeners: List[Any] = []  # flush 成功後呼叫 fn(fixture_counts)
+        self.accepted = 0
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.rejected = 0
+        self.dead_letters = 0
+        self.recent_dead_letters: collections.deque = collections.deque(maxlen=USAGE_DEAD_LETTER_KEEP)
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self.last_flush_ms = 0.0
 
-    result = {s: min(v) if v else 0 for s, v in station_avail.items()}
-    return {"model": model_code, "stations": result}
+    def on_flush(self, fn):
+        self._listeners.append(fn)
+        return fn
 
-# ---------- Usage Logs (使用記錄) ----------
-@app.get("/usage_logs")
-def list_usage_logs():
+    def add(self, rows: List[tuple]):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._pending) + len(rows) > self.max_rows:
+                self.rejected += len(rows)
+                raise DBUnavailable("使用記錄緩衝已滿，請稍後重送")
+            self._pending.extend((now, r) for r in rows)
+            self.accepted += len(rows)
+            full = len(self._pending) >= self.flush_rows
+        if full:
+            self._wake.set()
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            t0 = time.monotonic()
+            try:
+                counts = write_usage_rows(batch)
+                written = len(batch)
+            except USAGE_PERMANENT_ERRORS as e:
+                print(f"⚠️ 使用記錄批次寫入失敗，改逐筆寫入：{e}")
+                counts, written = self._write_each(batch)
+            except Exception as e:
+                self._requeue(batch, e)
+                raise
+            self.flushes += 1
+            self.flushed_rows += written
+            self.last_flush_ms = round((time.monotonic() - t0) * 1000, 3)
+        self.notify(counts)
+        return written
+
+    def _write_each(self, batch: List[tuple]):
+        """逐筆寫入；寫不進去的列記入 dead letter，遇到暫時性錯誤則把剩下的放回緩衝"""
+        counts, written = collections.Counter(), 0
+        for i, item in enumerate(batch):
+            try:
+                counts.update(write_usage_rows([item]))
+                written += 1
+            except USAGE_PERMANENT_ERRORS as e:
+                with self._lock:
+                    self.dead_letters += 1
+                    self.recent_dead_letters.append({"row": dict(zip(USAGE_COLUMNS, item[1])), "error": str(e)})
+                print(f"⚠️ 使用記錄無法寫入，已移到 dead letter：{item[1][0]!r} {e}")
+            except Exception as e:
+                self.flushed_rows += written
+                self.notify(counts)
+                self._requeue(batch[i:], e)
+                raise
+        return counts, written
+
+    def _requeue(self, batch: List[tuple], e: Exception):
+        with self._lock:
+            # 暫時性錯誤：放回緩衝等下次重試（仍受 max_rows 限制，超出的最舊資料丟棄）
+            self._pending = batch + self._pending
+            overflow = len(self._pending) - self.max_rows
+            if overflow > 0:
+                del self._pending[:overflow]
+                self.rejected += overflow
+            self.errors += 1
+            self.last_error = str(e)
+        print(f"⚠️ 使用記錄寫入失敗（{len(batch)} 筆，稍後重試）：{e}")
+
+    def notify(self, counts: Dict[str, int]):
+        for fn in self._listeners:
+            try:
+                fn(counts)
+            except Exception as e:
+                print(f"⚠️ usage flush listener 失敗：{e}")
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass  # 已在 flush 內記錄，資料留在緩衝下次重試
+
+    def start(self):
+        if not USAGE_BUFFER_ENABLED or self._thread:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="usage-buffer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set(); self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval + 5)
+            self._thread = None
+        try:
+            self.flush()
+        except Exception:
+            print(f"⚠️ 關閉時仍有 {len(self._pending)} 筆使用記錄未寫入")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pending = len(self._pending)
+            oldest = round(time.monotonic() - self._pending[0][0], 3) if self._pending else 0.0
+        return {
+            "enabled": USAGE_BUFFER_ENABLED, "running": self._thread is not None,
+            "pending": pending, "oldest_pending_s": oldest, "max_rows": self.max_rows,
+            "interval": self.interval, "accepted": self.accepted, "flushed_rows": self.flushed_rows,
+            "flushes": self.flushes, "rejected": self.rejected, "errors": self.errors,
+            "last_error": self.last_error, "last_flush_ms": self.last_flush_ms,
+            "dead_letters": self.dead_letters, "recent_dead_letters": list(self.recent_dead_letters),
+        }
+
+def publish_usage_changes(c, names: List[str], inserted: int = 0):
+    """
+    使用記錄不逐筆發事件（站台每個 cycle 都上報）：一次 flush 發一筆 usage_logs 事件（只帶筆數），
+    另外對每個 used 有變動的治具發 fixtures update（帶新的 used），前端可直接更新該列。
+    """
+    events = [("usage_logs", "insert", None, {"count": inserted})] if inserted else []
+    for i in range(0, len(names), 500):
+        part = names[i:i + 500]
+        c.execute(f"SELECT id, used FROM fixtures WHERE name IN ({', '.join(['%s'] * len(part))})", part)
+        events += [("fixtures", "update", r["id"], {"used": r["used"]}) for r in c.fetchall() or []]
+    publish_changes(c, events)
+
+def write_usage_rows(batch: List[tuple]) -> Dict[str, int]:
+    """
+    一個交易寫入一批使用記錄並累加 fixtures.used，回傳各治具增加的次數。
+    used_at 以 DB 時鐘減去在緩衝中等待的時間，保留實際上報時間。
+    """
+    counts = collections.Counter()
+    for _, r in batch:
+        counts[r[0]] += r[3] or 0
     conn = get_db(); c = conn.cursor()
-    c.execute("SELECT * FROM usage_logs ORDER BY log_id DESC")
-    rows = c.fetchall() or []; conn.close(); return rows
+    try:
+        c.execute("SELECT NOW(6) AS now")
+        db_now = c.fetchone()["now"]
+        now = time.monotonic()
+        rows = [r + (db_now - timedelta(seconds=now - t),) for t, r in batch]
+        conn.begin()
+        c.executemany(f"""INSERT INTO usage_logs ({', '.join(USAGE_COLUMNS)}, used_at)
+                          VALUES ({', '.join(['%s'] * (len(USAGE_COLUMNS) + 1))})""", rows)
+        # 依治具名稱排序更新，多個 worker 同時 flush 時鎖定順序一致，避免 deadlock
+        items = sorted((k, n) for k, n in counts.items() if n)
+        for i in range(0, len(items), 500):
+            part = items[i:i + 500]
+            case = " ".join(["WHEN %s THEN %s"] * len(part))
+            params = [x for kv in part for x in kv] + [k for k, _ in part]
+            c.execute(f"""UPDATE fixtures SET used = used + CASE name {case} ELSE 0 END
+                          WHERE name IN ({', '.join(['%s'] * len(part))})""", params)
+        if items:
+            touch_tables(c, "fixtures")
+        apply_usage_rollups(c, [(r[0], r[2], r[3], r[4], r[-1]) for r in rows])
+        publish_usage_changes(c, [k for k, _ in items], len(rows))
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    return dict(counts)
+
+usage_buffer = UsageBuffer(USAGE_FLUSH_INTERVAL, USAGE_FLUSH_ROWS, USAGE_BUFFER_MAX)
+# 使用記錄寫入會改變 fixtures.used，儀表板統計需重算
+usage_buffer.on_flush(lambda counts: stats_cache.invalidate())
+
+def ingest_usage(items: List[UsageLogIn], wait: bool = False) -> Dict[str, Any]:
+    rows = [tuple(getattr(b, k) for k in USAGE_COLUMNS) for b in items]
+    if not USAGE_BUFFER_ENABLED:
+        usage_buffer.notify(write_usage_rows([(time.monotonic(), r) for r in rows]))
+        return {"ok": True, "accepted": len(rows), "buffered": False}
+    usage_buffer.add(rows)
+    if wait:
+        try:
+            usage_buffer.flush()
+        except Exception:
+            # 資料已在緩衝中，背景會重試；不要讓用戶端重送造成重複
+            return {"ok": True, "accepted": len(rows), "buffered": True}
+    return {"ok": True, "accepted": len(rows), "buffered": not wait}
+
+@app.get("/usage_logs", response_model=CursorPage)
+def list_usage_logs(cursor: Optional[str] = None, limit: int = PageLimit, with_total: bool = False, layout: str = Layout):
+    with get_read_db() as conn:
+        page = keyset_page(conn.cursor(), "usage_logs", "log_id", cursor=cursor, limit=limit, with_total=with_total)
+    return FastJSONResponse(shape_page(page, layout))
 
 @app.post("/usage_logs")
-def add_usage_log(body: UsageLogIn):
-    conn = get_db(); c = conn.cursor()
-    c.execute("""INSERT INTO usage_logs (fixture_id, serial_number, station_id, use_count, abnormal_status, note, operator) 
-                 VALUES (%s,%s,%s,%s,%s,%s,%s)""",
-              (body.fixture_id, body.serial_number, body.station_id, body.use_count, body.abnormal_status, body.note, body.operator))
-    conn.commit(); conn.close(); return {"ok": True}
+def add_usage_log(body: UsageLogIn, wait: bool = False):
+    """wait=true 時等資料寫入 DB 才回傳（前端手動新增用）；站台上報用預設值即可"""
+    return ingest_usage([body], wait)
+
+@app.post("/usage_logs/batch")
+def add_usage_logs_batch(body: List[UsageLogIn], wait: bool = False):
+    if len(body) > USAGE_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"一次最多 {USAGE_BATCH_MAX} 筆")
+    return ingest_usage(body, wait)
+
+@app.get("/usage_logs/buffer")
+def usage_buffer_stats():
+    return usage_buffer.stats()
 
 @app.delete("/usage_logs/{log_id}")
 def del_usage_log(log_id: int):
     conn = get_db(); c = conn.cursor()
-    c.execute("DELETE FROM usage_logs WHERE log_id=%s", (log_id,))
-    conn.commit(); conn.close(); return {"ok": True}
+    try:
+        conn.begin()
+        c.execute("""SELECT fixture_id, station_id, use_count, abnormal_status, used_at
+                     FROM usage_logs WHERE log_id=%s FOR UPDATE""", (log_id,))
+        row = c.fetchone()
+        if row:
+            c.execute("DELETE FROM usage_logs WHERE log_id=%s", (log_id,))
+            # 扣回該筆的使用次數，讓 fixtures.used 與彙總表都與使用記錄一致
+            c.execute("UPDATE fixtures SET used = GREATEST(used - %s, 0) WHERE name=%s",
+                      (row["use_count"] or 0, row["fixture_id"]))
+            touch_tables(c, "fixtures")
+            apply_usage_rollups(c, [(row["fixture_id"], row["station_id"], row["use_count"],
+                                     row["abnormal_status"], row["used_at"])], sign=-1)
+            publish_change(c, "usage_logs", "delete", log_id)
+            publish_usage_changes(c, [row["fixture_id"]])
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    stats_cache.invalidate()
+    return {"ok": True}
+
+# ---------- Usage Rollups (使用趨勢) ----------
+# usage_rollup_hourly / usage_rollup_daily 依 (治具, 時段, 站別) 累計 events（筆數）、use_count、abnormal_count。
+# 寫入/刪除使用記錄時在同一個交易內增減，趨勢圖只讀彙總表；
+# 彙總表與原始記錄不一致時（例如直接改 DB）以 rebuild_usage_rollups() 由原始記錄重算。
+TRENDS_MAX_POINTS = int(os.getenv("TRENDS_MAX_POINTS", "2000"))
+TRENDS_FIXTURES_MAX = 200
+ROLLUP_TABLES = {"hour": "usage_rollup_hourly", "day": "usage_rollup_daily"}
+
+def _rollup_bucket(ts: datetime, granularity: str):
+    return ts.replace(minute=0, second=0, microsecond=0) if granularity == "hour" else ts.date()
+
+def apply_usage_rollups(c, events: List[tuple], sign: int = 1):
+    """
+    events: [(fixture_id, station_id, use_count, abnormal_status, used_at)]
+    先在記憶體彙總成每個 (治具, 時段, 站別) 一列，再以 upsert 累加；sign=-1 用於刪除記錄時扣回。
+    """
+    for granularity, table in ROLLUP_TABLES.items():
+        agg = collections.defaultdict(lambda: [0, 0, 0])
+        for fixture_id, station_id, use_count, abnormal_status, used_at in events:
+            a = agg[(fixture_id, _rollup_bucket(used_at, granularity), station_id or 0)]
+            a[0] += 1
+            a[1] += use_count or 0
+            a[2] += 1 if abnormal_status else 0
+        # 依主鍵排序寫入，多個 worker 同時 flush 時鎖定順序一致
+        rows = [k + tuple(sign * v for v in agg[k]) for k in sorted(agg)]
+        for i in range(0, len(rows), 1000):
+            c.executemany(f"""INSERT INTO {table} (fixture_id, bucket, station_id, events, use_count, abnormal_count)
+                              VALUES (%s,%s,%s,%s,%s,%s)
+                              ON DUPLICATE KEY UPDATE events=events+VALUES(events),
+                                use_count=use_count+VALUES(use_count), abnormal_count=abnormal_count+VALUES(abnormal_count)""",
+                          rows[i:i + 1000])
+
+def rebuild_usage_rollups(start: Optional[date] = None, end: Optional[date] = None) -> Dict[str, Any]:
+    """
+    由 usage_logs 重算彙總表（start~end 含當天，未指定則為全部資料），可重複執行。
+    一天一個交易：INSERT ... SELECT 會鎖住該天的原始記錄範圍，重算期間同一天的新寫入會等它完成。
+    """
+    conn = get_db(); c = conn.cursor()
+    try:
+        if start is None or end is None:
+            c.execute("SELECT MIN(used_at) AS lo, MAX(used_at) AS hi FROM usage_logs")
+            r = c.fetchone() or {}
+            if r.get("lo") is None:
+                return {"days": 0}
+            start = start or r["lo"].date()
+            end = end or r["hi"].date()
+        days = 0
+        day = start
+        while day <= end:
+            lo, hi = day, day + timedelta(days=1)
+            conn.begin()
+            c.execute("DELETE FROM usage_rollup_hourly WHERE bucket >= %s AND bucket < %s", (lo, hi))
+            c.execute("DELETE FROM usage_rollup_daily WHERE bucket = %s", (lo,))
+            c.execute("""INSERT INTO usage_rollup_hourly (fixture_id, bucket, station_id, events, use_count, abnormal_count)
+                         SELECT fixture_id, DATE_FORMAT(used_at, '%%Y-%%m-%%d %%H:00:00'), COALESCE(station_id, 0),
+                                COUNT(*), COALESCE(SUM(use_count), 0),
+                                SUM(abnormal_status IS NOT NULL AND abnormal_status <> '')
+                         FROM usage_logs WHERE used_at >= %s AND used_at < %s
+                         GROUP BY 1, 2, 3""", (lo, hi))
+            c.execute("""INSERT INTO usage_rollup_daily (fixture_id, bucket, station_id, events, use_count, abnormal_count)
+                         SELECT fixture_id, DATE(bucket), station_id, SUM(events), SUM(use_count), SUM(abnormal_count)
+                         FROM usage_rollup_hourly WHERE bucket >= %s AND bucket < %s
+                         GROUP BY 1, 2, 3""", (lo, hi))
+            conn.commit()
+            days += 1
+            day = hi
+        return {"days": days, "start": str(start), "end": str(end)}
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+
+@app.get("/usage/trends")
+def usage_trends(fixture_ids: Optional[str] = None, start: Optional[date] = None, end: Optional[date] = None,
+                 granularity: str = Query("day", pattern="^(hour|day)$"), station_id: Optional[int] = None,
+                 by_station: bool = False):
+    """
+    使用趨勢（由彙總表讀取）：fixture_ids 以逗號分隔，未指定則為全部治具合計。
+    start~end 含當天，預設最近 30 天（day）或 7 天（hour）；沒有資料的時段補 0。
+    by_station=true 時每個站別各一條序列。
+    """
+    ids = [x.strip() for x in (fixture_ids or "").split(",") if x.strip()]
+    if len(ids) > TRENDS_FIXTURES_MAX:
+        raise HTTPException(status_code=400, detail=f"一次最多 {TRENDS_FIXTURES_MAX} 個治具")
+    end = end or date.today()
+    start = start or end - timedelta(days=29 if granularity == "day" else 6)
+    if start > end:
+        raise HTTPException(status_code=400, detail="start 不可晚於 end")
+    if granularity == "hour":
+        first, stop, step = (datetime.combine(start, datetime.min.time()),
+                             datetime.combine(end + timedelta(days=1), datetime.min.time()), timedelta(hours=1))
+    else:
+        first, stop, step = start, end + timedelta(days=1), timedelta(days=1)
+    n = (stop - first) // step
+    if n > TRENDS_MAX_POINTS:
+        raise HTTPException(status_code=400, detail=f"時間範圍過大（最多 {TRENDS_MAX_POINTS} 個時段）")
+    buckets = [first + step * i for i in range(n)]
+
+    where, params = ["bucket >= %s", "bucket < %s"], [first, stop]
+    if ids:
+        where.append(f"fixture_id IN ({', '.join(['%s'] * len(ids))})"); params += ids
+    if station_id is not None:
+        where.append("station_id = %s"); params.append(station_id)
+    keys = (["fixture_id"] if ids else []) + (["station_id"] if by_station else [])
+    cols = ", ".join(keys + ["bucket"])
+    with get_read_db() as conn:
+        c = conn.cursor()
+        c.execute(f"""SELECT {cols}, SUM(events) AS events, SUM(use_count) AS use_count, SUM(abnormal_count) AS abnormal_count
+                      FROM {ROLLUP_TABLES[granularity]} WHERE {' AND '.join(where)}
+                      GROUP BY {cols}""", params)
+        rows = c.fetchall() or []
+
+    def empty(**labels):
+        return {**labels, "events": [0] * n, "use_count": [0] * n, "abnormal_count": [0] * n}
+
+    index = {bk: i for i, bk in enumerate(buckets)}
+    series: Dict[tuple, Dict[str, Any]] = {}
+    if not by_station:
+        # 指定的治具即使沒有資料也回傳一條全 0 的序列；全部合計時只有一條
+        for fid in ids or [None]:
+            series[(fid,) if ids else ()] = empty(**({"fixture_id": fid} if ids else {}))
+    for r in rows:
+        k = tuple(r[x] for x in keys)
+        if k not in series:
+            series[k] = empty(**{x: r[x] for x in keys})
+        bucket = r["bucket"]
+        if granularity == "day" and isinstance(bucket, datetime):
+            bucket = bucket.date()
+        i = index.get(bucket)
+        if i is not None:
+            for m in ("events", "use_count", "abnormal_count"):
+                series[k][m][i] = int(r[m] or 0)
+    return FastJSONResponse({"granularity": granularity, "start": str(start), "end": str(end),
+                             "buckets": buckets, "series": [series[k] for k in sorted(series, key=lambda k: tuple(map(str, k)))]})
+
+@app.post("/usage/rollups/rebuild")
+def rebuild_rollups(start: Optional[date] = None, end: Optional[date] = None):
+    """由使用記錄重算彙總表（start~end 含當天；未指定則全部），可重複執行"""
+    return rebuild_usage_rollups(start, end)
+
+# ---------- Life Forecast (壽命預估) ----------
+# 每支治具的剩餘壽命與預估更換日：
+#   - count 型：剩餘次數 / 最近 FORECAST_WINDOW_DAYS 天的日均使用次數（由 usage_rollup_daily 取得）
+#   - time 型：used / life_value 以天計，每天消耗 1
+# 一次查詢載入全部治具，以 NumPy 向量運算一次算完（10 萬支約數十毫秒），不逐支查詢使用記錄。
+# 排程每 FORECAST_INTERVAL 秒彙整一封摘要信寄給 SMTP 設定的 alert_to；多個 worker 以 GET_LOCK 與上次寄送時間避免重複寄送。
+FORECAST_ENABLED = os.getenv("FORECAST_ENABLED", "1") == "1"
+FORECAST_WINDOW_DAYS = int(os.getenv("FORECAST_WINDOW_DAYS", "14"))
+FORECAST_ALERT_DAYS = float(os.getenv("FORECAST_ALERT_DAYS", "14"))
+FORECAST_INTERVAL = float(os.getenv("FORECAST_INTERVAL", "86400"))
+FORECAST_CACHE_TTL = float(os.getenv("FORECAST_CACHE_TTL", "60"))
+DIGEST_MAX_LINES = 200
+FORECAST_LOCK = "fixture_suite_forecast_digest"
+FORECAST_COLUMNS = ["id", "name", "status", "life_type", "used", "life_value", "recent_use"]
+
+def load_forecast_frame(today: date) -> "pd.DataFrame":
+    """一次查詢載入全部治具與最近的使用量（不含今天未滿一天的資料）"""
+    import pandas as pd
+
+    conn = get_read_db(); c = conn.cursor(pymysql.cursors.Cursor)  # tuple 列，直接建 DataFrame
+    try:
+        c.execute("""SELECT f.id, f.name, f.status, f.life_type, f.used, f.life_value, COALESCE(u.recent, 0)
+                     FROM fixtures f LEFT JOIN (
+                         SELECT fixture_id, SUM(use_count) AS recent FROM usage_rollup_daily
+                         WHERE bucket >= %s AND bucket < %s GROUP BY fixture_id
+                     ) u ON u.fixture_id = f.name""",
+                  (today - timedelta(days=FORECAST_WINDOW_DAYS), today))
+        rows = c.fetchall() or []
+    finally:
+        conn.close()
+    return pd.DataFrame.from_records(list(rows), columns=FORECAST_COLUMNS)
+
+def compute_forecast(df: "pd.DataFrame", today: date) -> "pd.DataFrame":
+    """
+    向量化計算 remaining、daily_rate、days_left、replace_by、alert：
+    alert 為 overdue（已達壽命）、due_soon（FORECAST_ALERT_DAYS 天內到期）或空字串；
+    只有 active 且有設定壽命的治具會提醒。
+    """
+    import numpy as np
+    import pandas as pd
+
+    used = pd.to_numeric(df["used"], errors="coerce").fillna(0).to_numpy(dtype=float)
+    life = pd.to_numeric(df["life_value"], errors="coerce").fillna(0).to_numpy(dtype=float)
+    recent = pd.to_numeric(df["recent_use"], errors="coerce").fillna(0).to_numpy(dtype=float)
+    is_time = (df["life_type"] == "time").to_numpy()
+    tracked = (df["status"] == "active").to_numpy() & (life > 0)
+
+    remaining = life - used
+    rate = np.where(is_time, 1.0, recent / max(FORECAST_WINDOW_DAYS, 1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        days_left = np.where(life <= 0, np.inf,  # 未設定壽命：不會到期
+                             np.where(remaining <= 0, 0.0, np.where(rate > 0, remaining / rate, np.inf)))
+    finite = np.isfinite(days_left)
+    replace_by = np.full(len(df), np.datetime64("NaT"), dtype="datetime64[D]")
+    replace_by[finite] = np.datetime64(today, "D") + np.ceil(days_left[finite]).astype("timedelta64[D]")
+    alert = np.select([tracked & (remaining <= 0), tracked & (days_left <= FORECAST_ALERT_DAYS)],
+                      ["overdue", "due_soon"], "")
+
+    out = df[["id", "name", "status", "life_type"]].copy()
+    out["used"] = used; out["life_value"] = life; out["remaining"] = remaining
+    out["daily_rate"] = np.round(rate, 3); out["days_left"] = np.round(days_left, 1)
+    out["replace_by"] = replace_by; out["alert"] = alert
+    return out
+
+def forecast_records(df: "pd.DataFrame") -> List[Dict[str, Any]]:
+    import numpy as np
+
+    df = df.replace({np.inf: None})
+    df["replace_by"] = df["replace_by"].astype(str).replace("NaT", None)
+    return df.astype(object).where(df.notna(), None).to_dict("records")
+
+forecast_cache = CachedValue(lambda: compute_forecast(load_forecast_frame(date.today()), date.today()), FORECAST_CACHE_TTL)
+
+def build_digest(alerts: "pd.DataFrame", smtp: Dict[str, str], recipients: List[str], today: date) -> EmailMessage:
+    """一封摘要信：內文列出最急的 DIGEST_MAX_LINES 支，完整清單放在 CSV 附件"""
+    overdue = int((alerts["alert"] == "overdue").sum())
+    msg = EmailMessage()
+    msg["Subject"] = f"[治具壽命] {today}：已到期 {overdue} 支、{int(FORECAST_ALERT_DAYS)} 天內到期 {len(alerts) - overdue} 支"
+    msg["From"] = smtp.get("sender") or smtp.get("user")
+    msg["To"] = ", ".join(recipients)
+    lines = [f"{'治具編號':<20}{'狀態':<10}{'剩餘':>10}{'日均使用':>10}{'預估更換日':>14}"]
+    for r in alerts.head(DIGEST_MAX_LINES).itertuples(index=False):
+        lines.append(f"{str(r.name):<20}{'已到期' if r.alert == 'overdue' else '即將到期':<10}"
+                     f"{r.remaining:>10.0f}{r.daily_rate:>10.1f}{str(r.replace_by):>14}")
+    if len(alerts) > DIGEST_MAX_LINES:
+        lines.append(f"... 其餘 {len(alerts) - DIGEST_MAX_LINES} 支請見附件")
+    msg.set_content("\n".join(lines))
+    buf = io.StringIO()
+    alerts.to_csv(buf, index=False)
+    msg.add_attachment(buf.getvalue().encode("utf-8-sig"), maintype="text", subtype="csv",
+                       filename=f"fixture_life_{today}.csv")
+    return msg
+
+def run_forecast_digest(force: bool = False, dry_run: bool = False) -> Dict[str, Any]:
+    """
+    計算全部治具的壽命預估並寄出一封摘要信。
+    force=False 時距離上次寄送未滿 FORECAST_INTERVAL 就略過（多個 worker 只有一個會寄）。
+    """
+    today = date.today()
+    t0 = time.perf_counter()
+    df = compute_forecast(load_forecast_frame(today), today)
+    forecast_cache.invalidate()
+    alerts = df[df["alert"] != ""].sort_values(["days_left", "name"])
+    result = {"fixtures": len(df), "overdue": int((alerts["alert"] == "overdue").sum()),
+              "due_soon": int((alerts["alert"] == "due_soon").sum()),
+              "compute_ms": round((time.perf_counter() - t0) * 1000, 1), "sent": False}
+    if dry_run or alerts.empty:
+        return result
+    smtp = load_smtp_settings()
+    recipients = [x.strip() for x in re.split(r"[,;\s]+", smtp.get("alert_to") or "") if x.strip()]
+    if not smtp.get("host") or not recipients:
+        return {**result, "skipped": "SMTP 未設定 host 或 alert_to"}
 
-# ---------- Replacement Logs (更換記錄) ----------
-@app.get("/replacement_logs")
-def list_replacement_logs():
     conn = get_db(); c = conn.cursor()
-    c.execute("SELECT * FROM replacement_logs ORDER BY replacement_id DESC")
-    rows = c.fetchall() or []; conn.close(); return rows
+    try:
+        c.execute("SELECT GET_LOCK(%s, 0) AS ok", (FORECAST_LOCK,))
+        if not (c.fetchone() or {}).get("ok"):
+            return {**result, "skipped": "其他程序正在寄送"}
+        try:
+            c.execute("SELECT svalue FROM settings WHERE category='forecast' AND skey='last_digest_at'")
+            row = c.fetchone()
+            if row and not force and time.time() - float(row["svalue"] or 0) < FORECAST_INTERVAL * 0.9:
+                return {**result, "skipped": "本週期已寄送"}
+            send_mail(smtp, build_digest(alerts, smtp, recipients, today))
+            c.execute("""INSERT INTO settings (category, skey, svalue) VALUES ('forecast', 'last_digest_at', %s)
+                         ON DUPLICATE KEY UPDATE svalue=VALUES(svalue)""", (str(time.time()),))
+            conn.commit()
+        finally:
+            c.execute("SELECT RELEASE_LOCK(%s)", (FORECAST_LOCK,))
+    finally:
+        conn.close()
+    return {**result, "sent": True, "recipients": recipients}
+
+forecast_task = PeriodicTask("forecast-digest", FORECAST_INTERVAL, run_forecast_digest)
+
+@app.get("/forecast/life")
+def forecast_life(alert: Optional[str] = Query(None, pattern="^(overdue|due_soon|any)$"),
+                  limit: int = Query(100, ge=1, le=PAGE_LIMIT_MAX)):
+    """剩餘壽命預估，依 days_left 由少到多；alert=any 只列需要提醒的治具"""
+    df = forecast_cache.get()
+    if alert == "any":
+        df = df[df["alert"] != ""]
+    elif alert:
+        df = df[df["alert"] == alert]
+    top = df.nsmallest(limit, "days_left")
+    return FastJSONResponse({"total": len(df), "window_days": FORECAST_WINDOW_DAYS,
+                             "alert_days": FORECAST_ALERT_DAYS, "data": forecast_records(top)})
+
+@app.post("/forecast/digest")
+def send_forecast_digest(dry_run: bool = False):
+    """立即計算並寄出摘要信（不受寄送間隔限制）；dry_run=true 只計算不寄信"""
+    return run_forecast_digest(force=True, dry_run=dry_run)
+
+@app.get("/forecast/digest")
+def forecast_digest_status():
+    return forecast_task.stats()
+
+# ---------- Replacement Logs (更換記錄) ----------
+@app.get("/replacement_logs", response_model=CursorPage)
+def list_replacement_logs(cursor: Optional[str] = None, limit: int = PageLimit, with_total: bool = False, layout: str = Layout):
+    with get_read_db() as conn:
+        page = keyset_page(conn.cursor(), "replacement_logs", "replacement_id", cursor=cursor, limit=limit, with_total=with_total)
+    return FastJSONResponse(shape_page(page, layout))
 
 @app.post("/replacement_logs")
 def add_replacement_log(body: ReplacementLogIn):
     conn = get_db(); c = conn.cursor()
-    c.execute("""INSERT INTO replacement_logs (fixture_id, serial_number, replacement_date, reason, executor, note) 
-                 VALUES (%s,%s,%s,%s,%s,%s)""",
-              (body.fixture_id, body.serial_number, body.replacement_date, body.reason, body.executor, body.note))
-    conn.commit(); conn.close(); return {"ok": True}
+    try:
+        conn.begin()
+        c.execute("""INSERT INTO replacement_logs (fixture_id, serial_number, replacement_date, reason, executor, note)
+                     VALUES (%s,%s,%s,%s,%s,%s)""",
+                  (body.fixture_id, body.serial_number, body.replacement_date, body.reason, body.executor, body.note))
+        rid = c.lastrowid
+        publish_change(c, "replacement_logs", "insert", rid, {"replacement_id": rid, **body.model_dump()})
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    return {"ok": True}
 
 @app.delete("/replacement_logs/{replacement_id}")
 def del_replacement_log(replacement_id: int):
     conn = get_db(); c = conn.cursor()
-    c.execute("DELETE FROM replacement_logs WHERE replacement_id=%s", (replacement_id,))
-    conn.commit(); conn.close(); return {"ok": True}
\ No newline at end of file
+    try:
+        conn.begin()
+        c.execute("DELETE FROM replacement_logs WHERE replacement_id=%s", (replacement_id,))
+        if c.rowcount:
+            publish_change(c, "replacement_logs", "delete", replacement_id)
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    return {"ok": True}
+
+# ---------- Fixture Timeline (治具履歷) ----------
+# GET /fixtures/{fid}/timeline：一支治具的使用、更換、收/退料與操作記錄，依時間由新到舊合併成一個列表：
+#   - 每個來源以 (治具編號, 時間) 索引各取最多 limit+1 筆，heapq.merge 依 (時間, 來源, 主鍵) 合併，
+#     一頁只做每個來源一次範圍查詢，不掃整張表
+#   - cursor 記下最後一筆的位置與當時的累計使用次數，下一頁各來源從該位置之後接著查
+#   - count 型治具每筆附上該事件之後的 used / remaining：由目前的 used 往回扣除較新的使用次數推算；
+#     sources 不含 usage 時頁面上沒有使用記錄可扣，改為每筆以 SUM(use_count) 另算該時間之後的使用次數
+#   - 更換記錄以更換日期（當天 00:00）排序；已歸檔的舊資料不在此列表（見 /history/{kind}）
+TIMELINE_SOURCES = {  # 來源 -> (資料表, 治具欄位, 時間欄位, 主鍵)；順序即同一時間的排序序位
+    "usage": ("usage_logs", "fixture_id", "used_at", "log_id"),
+    "replacement": ("replacement_logs", "fixture_id", "replacement_date", "replacement_id"),
+    "receipt": ("receipts", "fixture_code", "created_at", "id"),
+    "return": ("returns_table", "fixture_code", "created_at", "id"),
+    "log": ("logs", "fixture", "created_at", "id"),
+}
+TIMELINE_RANK = {s: i for i, s in enumerate(TIMELINE_SOURCES)}
+
+def _timeline_cursor(at: datetime, source: str, pk: int, used: Optional[int]) -> str:
+    raw = json.dumps({"at": at.isoformat(), "s": source, "id": pk, "used": used}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def _parse_timeline_cursor(cursor: str) -> Dict[str, Any]:
+    try:
+        d = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return {"at": datetime.fromisoformat(d["at"]), "rank": TIMELINE_RANK[d["s"]], "id": int(d["id"]),
+                "used": None if d.get("used") is None else int(d["used"])}
+    except Exception:
+        raise HTTPException(status_code=400, detail="cursor 格式錯誤")
+
+def _timeline_summary(source: str, r: Dict[str, Any]) -> str:
+    if source == "usage":
+        parts = [f"使用 {r.get('use_count') or 0} 次"]
+        if r.get("station_id") is not None:
+            parts.append(f"站 {r['station_id']}")
+        if r.get("serial_number"):
+            parts.append(f"序號 {r['serial_number']}")
+        if r.get("abnormal_status"):
+            parts.append(f"異常：{r['abnormal_status']}")
+        return "，".join(parts)
+    if source == "replacement":
+        return "更換" + (f"：{r['reason']}" if r.get("reason") else "") + (f"（{r['executor']}）" if r.get("executor") else "")
+    if source in ("receipt", "return"):
+        serials = document_serials(r)
+        text = ("收料" if source == "receipt" else "退料") + (f" {document_quantity(r, serials)} 件" if serials is not None else "")
+        return text + (f"（單號 {r['order_no']}）" if r.get("order_no") else "")
+    return (r.get("type") or "記錄") + (f"：{r['note']}" if r.get("note") else "")
+
+def _timeline_stream(c, source: str, code: str, start: Optional[date], end: Optional[date],
+                     after: Optional[Dict[str, Any]], limit: int):
+    """單一來源在 cursor 之後（依 (時間, 序位, 主鍵) 由新到舊）的前 limit 筆"""
+    table, key, ts, pk = TIMELINE_SOURCES[source]
+    rank = TIMELINE_RANK[source]
+    sql, args = f"SELECT * FROM {table} WHERE {key}=%s", [code]
+    if start:
+        sql += f" AND {ts} >= %s"; args.append(start)
+    if end:
+        sql += f" AND {ts} < %s"; args.append(end + timedelta(days=1))
+    if after:
+        # 同一時間：序位比 cursor 小的整批在後面、大的整批在前面，同來源再比主鍵
+        if rank < after["rank"]:
+            sql += f" AND {ts} <= %s"; args.append(after["at"])
+        elif rank > after["rank"]:
+            sql += f" AND {ts} < %s"; args.append(after["at"])
+        else:
+            sql += f" AND ({ts} < %s OR ({ts} = %s AND {pk} < %s))"; args += [after["at"], after["at"], after["id"]]
+    c.execute(f"{sql} ORDER BY {ts} DESC, {pk} DESC LIMIT %s", args + [limit])
+    for r in c.fetchall() or []:
+        at = r[ts] if isinstance(r[ts], datetime) else datetime.combine(r[ts], datetime.min.time())
+        yield (at, rank, r[pk]), source, r
+
+@app.get("/fixtures/{fid}/timeline")
+def fixture_timeline(fid: int, cursor: Optional[str] = None, limit: int = PageLimit,
+                     start: Optional[date] = None, end: Optional[date] = None,
+                     sources: Optional[str] = Query(None, description="逗號分隔：" + ",".join(TIMELINE_SOURCES))):
+    picked = [s.strip() for s in sources.split(",") if s.strip()] if sources else list(TIMELINE_SOURCES)
+    unknown = [s for s in picked if s not in TIMELINE_SOURCES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"不支援的來源：{', '.join(unknown)}")
+    after = _parse_timeline_cursor(cursor) if cursor else None
+    conn = get_read_db(); c = conn.cursor()
+    try:
+        c.execute("SELECT id, name, status, life_type, used, life_value FROM fixtures WHERE id=%s", (fid,))
+        fixture = c.fetchone()
+        if not fixture:
+            raise HTTPException(status_code=404, detail=f"找不到治具 {fid}")
+        code = fixture["name"]
+        # 各來源先各自查完（同一條連線不能交錯讀多個結果集），再合併
+        streams = [list(_timeline_stream(c, s, code, start, end, after, limit + 1)) for s in picked]
+        events = list(itertools.islice(heapq.merge(*streams, key=lambda e: e[0], reverse=True), limit + 1))
+        has_more = len(events) > limit
+        events = events[:limit]
+        counted = fixture["life_type"] != "time"
+        walk = counted and "usage" in picked
+        used = None
+        used_at_event: Dict[datetime, int] = {}
+        if walk and after is not None:
+            used = after["used"]
+        elif walk:
+            used = int(fixture["used"] or 0)
+            if end:
+                # 只看到 end 為止：先扣掉 end 之後的使用次數
+                c.execute("SELECT COALESCE(SUM(use_count), 0) AS n FROM usage_logs WHERE fixture_id=%s AND used_at >= %s",
+                          (code, end + timedelta(days=1)))
+                used -= int((c.fetchone() or {}).get("n", 0))
+        elif counted and events:
+            # 沒有使用記錄可往回扣：一次掃描算出每個事件時間之後的使用次數
+            # （同一時間的使用記錄排在其他來源之後，視為尚未發生，故用 >）
+            times = sorted({at for (at, _, _), _, _ in events})
+            cols = ", ".join(f"COALESCE(SUM(CASE WHEN used_at > %s THEN use_count END), 0) AS n{i}"
+                             for i in range(len(times)))
+            c.execute(f"SELECT {cols} FROM usage_logs WHERE fixture_id=%s AND used_at > %s", times + [code, times[0]])
+            sums = c.fetchone() or {}
+            now_used = int(fixture["used"] or 0)
+            used_at_event = {t: now_used - int(sums.get(f"n{i}") or 0) for i, t in enumerate(times)}
+    finally:
+        conn.close()
+    life = int(fixture["life_value"] or 0)
+    data = []
+    for (at, _, pk), source, r in events:
+        item = {"at": at, "source": source, "id": pk, "summary": _timeline_summary(source, r),
+                "used": None, "remaining": None, "data": r}
+        if not walk and at in used_at_event:
+            item["used"] = used_at_event[at]
+            item["remaining"] = life - item["used"] if life > 0 else None
+        elif walk and used is not None:
+            item["used"] = used
+            item["remaining"] = life - used if life > 0 else None
+            if source == "usage":
+                used -= int(r.get("use_count") or 0)  # 再往前一筆時，這次的使用還沒發生
+        data.append(item)
+    next_cursor = None
+    if has_more and events:
+        (at, _, pk), source, _ = events[-1]
+        next_cursor = _timeline_cursor(at, source, pk, used if walk else None)
+    return FastJSONResponse({"fixture": fixture, "data": data, "next_cursor": next_cursor, "limit": limit})
+
+
+# ---------- Bulk Writes (批次寫入) ----------
+# 掃描器一次送一整批（例如一整個棧板的治具）：
+#   - 先驗證全部項目；atomic=true（預設）時任一筆有誤整批不寫入，回 422 與每筆的錯誤
+#   - 一個交易內以 multi-row INSERT 寫入，回傳每筆的結果（含新 id）
+#   - 每筆可帶 idempotency_key（或整批帶 Idempotency-Key header，第 i 筆的鍵為 "<header>:<i>"）；
+#     已處理過的鍵直接回傳第一次的結果（replayed=true），掃描器重送不會重複寫入；
+#     同一個鍵帶不同內容回傳該筆錯誤。冪等鍵保留 IDEMPOTENCY_TTL_HOURS 小時。
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "1000"))
+BULK_INSERT_CHUNK = 200
+BULK_TABLES = {"receipts": "id", "returns_table": "id", "fixtures": "id", "replacement_logs": "replacement_id"}  # -> 主鍵
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "72"))
+_idempotency_purged_at = 0.0
+
+def insert_rows(c, table: str, columns: List[str], rows: List[tuple]) -> List[int]:
+    """
+    multi-row INSERT，回傳各列的 AUTO_INCREMENT id（與 rows 同順序）。
+    id 不一定連續（auto_increment_increment > 1、innodb_autoinc_lock_mode=2 時並行寫入交錯取號），
+    因此每列帶同一個 bulk_token，寫完依 token 查回 id：同一連線依序寫入的列 id 遞增，排序後即對應 rows 的順序。
+    查回後清掉 token，列表不會出現。
+    """
+    if not rows:
+        return []
+    pk = BULK_TABLES[table]
+    token = uuid.uuid4().hex
+    cols = columns + ["bulk_token"]
+    row_sql = "(" + ", ".join(["%s"] * len(cols)) + ")"
+    for i in range(0, len(rows), BULK_INSERT_CHUNK):
+        chunk = rows[i:i + BULK_INSERT_CHUNK]
+        c.execute(f"INSERT INTO {table} ({', '.join(cols)}) VALUES {', '.join([row_sql] * len(chunk))}",
+                  [v for r in chunk for v in (*r, token)])
+    c.execute(f"SELECT {pk} FROM {table} WHERE bulk_token=%s ORDER BY {pk}", (token,))
+    ids = [r[pk] for r in c.fetchall() or []]
+    if len(ids) != len(rows):
+        raise RuntimeError(f"{table} 批次寫入查回 {len(ids)} 筆 id，預期 {len(rows)} 筆")
+    c.execute(f"UPDATE {table} SET bulk_token=NULL WHERE bulk_token=%s", (token,))
+    return ids
+
+def _purge_idempotency_keys():
+    global _idempotency_purged_at
+    if time.monotonic() - _idempotency_purged_at < 600:
+        return
+    _idempotency_purged_at = time.monotonic()
+    conn = get_db(); c = conn.cursor()
+    try:
+        c.execute("DELETE FROM idempotency_keys WHERE created_at < NOW() - INTERVAL %s HOUR LIMIT 5000",
+                  (IDEMPOTENCY_TTL_HOURS,))
+    finally:
+        conn.close()
+
+def bulk_write(scope: str, items: List[BaseModel], header_key: Optional[str], atomic: bool,
+               prepare, insert, after_commit=None):
+    """
+    prepare(item) 驗證並回傳寫入需要的資料（錯誤丟 HTTPException / ValueError）；
+    insert(c, [(item, prepared)]) 在交易內寫入並回傳每筆結果 dict；
+    after_commit([(item, result)]) 提交後同步程序內的衍生資料。
+    """
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"一次最多 {BULK_MAX_ITEMS} 筆")
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    prepared: Dict[int, Any] = {}
+    for i, item in enumerate(items):
+        try:
+            prepared[i] = prepare(item)
+        except HTTPException as e:
+            results[i] = {"index": i, "ok": False, "error": e.detail}
+        except ValueError as e:
+            results[i] = {"index": i, "ok": False, "error": str(e)}
+    if atomic and len(prepared) < len(items):
+        return JSONResponse(status_code=422, content={"ok": False, "results": [r or {"index": i, "ok": True, "skipped": True}
+                                                                               for i, r in enumerate(results)]})
+
+    keys: Dict[int, tuple] = {}  # index -> (key, request_hash)
+    for i in prepared:
+        key = items[i].idempotency_key or (f"{header_key}:{i}" if header_key else None)
+        if key:
+            digest = hashlib.sha256(items[i].model_dump_json(exclude={"idempotency_key"}).encode("utf-8")).hexdigest()
+            keys[i] = (key, digest)
+
+    todo: List[int] = []
+    first_of_key: Dict[str, int] = {}
+    conn = get_db(); c = conn.cursor()
+    try:
+        conn.begin()
+        stored: Dict[str, Dict[str, Any]] = {}
+        if keys:
+            uniq = list(dict.fromkeys((k, h) for k, h in keys.values()))
+            # 先佔用鍵：同一個鍵的並行請求會在這裡等前一個交易結束，之後讀到它的結果
+            c.executemany("INSERT IGNORE INTO idempotency_keys (scope, idem_key, request_hash) VALUES (%s,%s,%s)",
+                          [(scope, k, h) for k, h in uniq])
+            names = list(dict.fromkeys(k for k, _ in uniq))
+            c.execute(f"""SELECT idem_key, request_hash, result FROM idempotency_keys
+                          WHERE scope=%s AND idem_key IN ({', '.join(['%s'] * len(names))}) FOR UPDATE""",
+                      [scope] + names)
+            stored = {r["idem_key"]: r for r in c.fetchall() or []}
+        for i in sorted(prepared):
+            if i not in keys:
+                todo.append(i); continue
+            key, digest = keys[i]
+            row = stored.get(key) or {}
+            if row.get("request_hash") not in (None, digest):
+                results[i] = {"index": i, "ok": False, "idempotency_key": key, "error": "idempotency_key 已用於不同的內容"}
+            elif row.get("result"):
+                results[i] = {**json.loads(row["result"]), "index": i, "replayed": True}
+            elif key in first_of_key:
+                continue  # 同一批內重複的鍵，沿用第一筆的結果
+            else:
+                first_of_key[key] = i
+                todo.append(i)
+        if atomic and any(r and not r["ok"] for r in results):
+            conn.rollback()
+            return JSONResponse(status_code=422, content={"ok": False, "results": [r or {"index": i, "ok": True, "skipped": True}
+                                                                                   for i, r in enumerate(results)]})
+        written = insert(c, [(items[i], prepared[i]) for i in todo]) if todo else []
+        for i, res in zip(todo, written):
+            results[i] = {"index": i, "ok": True, **res}
+        saved = [(scope, json.dumps({k: v for k, v in results[i].items() if k != "index"}, default=str), keys[i][0])
+                 for i in todo if i in keys]
+        if saved:
+            c.executemany("UPDATE idempotency_keys SET result=%s WHERE scope=%s AND idem_key=%s",
+                          [(r, sc, k) for sc, r, k in saved])
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    finally:
+        conn.close()
+    for j, (key, _) in keys.items():
+        if results[j] is None:  # 同一批內重複的鍵
+            results[j] = {**results[first_of_key[key]], "index": j, "replayed": True}
+    if after_commit and todo:
+        after_commit([(items[i], results[i]) for i in todo])
+    if keys:
+        _purge_idempotency_keys()
+    return {"ok": all(r["ok"] for r in results), "inserted": len(todo),
+            "replayed": sum(1 for r in results if r.get("replayed")),
+            "failed": sum(1 for r in results if not r["ok"]), "results": results}
+
+def bulk_material(table: str, state: str, request: Request, items: List[BaseModel], atomic: bool):
+    stock: List[Dict[str, Any]] = []
+
+    def insert(c, batch):
+        ids = insert_rows(c, table, MATERIAL_COLUMNS, [tuple(getattr(b, k) for k in MATERIAL_COLUMNS) for b, _ in batch])
+        # 依單據順序寫入序號，同一序號出現在多張單據時以後面的為準（與逐筆新增相同）
+        for (b, serials), doc_id in zip(batch, ids):
+            record_serials(c, state, b.fixture_code, serials, doc_id)
+        publish_changes(c, [(table, "insert", doc_id, {"id": doc_id, **{k: getattr(b, k) for k in MATERIAL_COLUMNS}})
+                            for (b, _), doc_id in zip(batch, ids)])
+        deltas: Dict[str, tuple] = {}
+        for b, serials in batch:
+            deltas[b.fixture_code] = tuple(x + y for x, y in zip(deltas.get(b.fixture_code, (0, 0)),
+                                                                 inventory_delta(state, document_quantity(b, serials))))
+        stock[:] = apply_inventory(c, deltas)
+        return [{"id": doc_id, "serial_count": len(serials), "quantity": document_quantity(b, serials)}
+                for (b, serials), doc_id in zip(batch, ids)]
+    return bulk_write(table, items, request.headers.get("idempotency-key"), atomic, expand_serials, insert,
+                      lambda done: inventory_saved(stock))
+
+@app.post("/receipts/bulk")
+def add_receipts_bulk(request: Request, body: List[ReceiptBulkIn], atomic: bool = True):
+    return bulk_material("receipts", "received", request, body, atomic)
+
+@app.post("/returns/bulk")
+def add_returns_bulk(request: Request, body: List[ReturnBulkIn], atomic: bool = True):
+    return bulk_material("returns_table", "returned", request, body, atomic)
+
+FIXTURE_COLUMNS = ["name", "status", "life_type", "used", "life_value"]
+
+@app.post("/fixtures/bulk")
+def create_fixtures_bulk(request: Request, body: List[FixtureBulkIn], atomic: bool = True):
+    def prepare(b):
+        if not b.name.strip():
+            raise ValueError("name 不可空白")
+        return None
+
+    def insert(c, batch):
+        ids = insert_rows(c, "fixtures", FIXTURE_COLUMNS, [tuple(getattr(b, k) for k in FIXTURE_COLUMNS) for b, _ in batch])
+        touch_tables(c, "fixtures")
+        publish_changes(c, [("fixtures", "insert", fid, {"id": fid, **{k: getattr(b, k) for k in FIXTURE_COLUMNS}})
+                            for (b, _), fid in zip(batch, ids)])
+        return [{"id": fid} for fid in ids]
+
+    def after_commit(done):
+        for b, res in done:
+            fixture_saved(res["id"], b)
+    return bulk_write("fixtures", body, request.headers.get("idempotency-key"), atomic, prepare, insert, after_commit)
+
+REPLACEMENT_COLUMNS = ["fixture_id", "serial_number", "replacement_date", "reason", "executor", "note"]
+
+@app.post("/replacement_logs/bulk")
+def add_replacement_logs_bulk(request: Request, body: List[ReplacementLogBulkIn], atomic: bool = True):
+    def prepare(b):
+        date.fromisoformat(b.replacement_date)  # 格式錯誤丟 ValueError
+        return None
+
+    def insert(c, batch):
+        ids = insert_rows(c, "replacement_logs", REPLACEMENT_COLUMNS,
+                          [tuple(getattr(b, k) for k in REPLACEMENT_COLUMNS) for b, _ in batch])
+        publish_changes(c, [("replacement_logs", "insert", rid, {"replacement_id": rid, **{k: getattr(b, k) for k in REPLACEMENT_COLUMNS}})
+                            for (b, _), rid in zip(batch, ids)])
+        return [{"id": rid} for rid in ids]
+    return bulk_write("replacement_logs", body, request.headers.get("idempotency-key"), atomic, prepare, insert)
+
+
+# ---------- CLI ----------
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fixture Management 管理指令")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_mig = sub.add_parser("migrate", help="升級資料表結構")
+    p_mig.add_argument("--status", action="store_true", help="只顯示目前版本，不套用")
+    p_mig.add_argument("--target", type=int, default=None, help="只升級到指定版本")
+    sub.add_parser("backfill-serials", help="由既有收/退料單重建序號表")
+    p_inv = sub.add_parser("check-inventory", help="比對庫存帳與收退料單")
+    p_inv.add_argument("--repair", action="store_true", help="補正不一致的數量")
+    p_arc = sub.add_parser("archive", help="歸檔超過保存期限的記錄")
+    p_arc.add_argument("--days", type=int, default=None, help="保存天數（預設 RETENTION_DAYS）")
+    p_arc.add_argument("--kind", action="append", choices=RETENTION_KINDS, help="只歸檔指定資料表，可重複")
+    p_roll = sub.add_parser("rebuild-rollups", help="由使用記錄重算使用趨勢彙總表")
+    p_roll.add_argument("--start", type=date.fromisoformat, default=None, help="起日 YYYY-MM-DD（預設最早一筆）")
+    p_roll.add_argument("--end", type=date.fromisoformat, default=None, help="迄日 YYYY-MM-DD（預設最後一筆）")
+    args = parser.parse_args()
+
+    if args.cmd == "migrate":
+        wait_for_db()
+        if args.status:
+            with get_db() as conn:
+                current = current_schema_version(conn.cursor())
+            print(f"schema 版本：{current} / 最新：{latest_schema_version()}")
+            for version, name, _ in MIGRATIONS:
+                print(f"  [{'x' if version <= current else ' '}] {version:04d}_{name}")
+        else:
+            applied = run_migrations(args.target)
+            print(f"✅ 已套用：{applied or '無'}")
+    elif args.cmd == "backfill-serials":
+        wait_for_db()
+        print(f"✅ 序號表重建完成：{backfill_serials()}")
+    elif args.cmd == "check-inventory":
+        wait_for_db()
+        report = check_inventory(args.repair)
+        for m in report["details"]:
+            print(f"  {m['fixture_code']}: 收 {m['received_qty']}→{m['expected_received_qty']}，"
+                  f"退 {m['returned_qty']}→{m['expected_returned_qty']}")
+        print(f"{'✅' if not report['mismatches'] or report['repaired'] else '⚠️'} 庫存檢查："
+              f"{report['checked']} 個治具，{report['mismatches']} 筆不一致{'（已補正）' if report['repaired'] else ''}，"
+              f"略過 {report['skipped_documents']} 張無法展開的單據")
+    elif args.cmd == "rebuild-rollups":
+        wait_for_db()
+        print(f"✅ 使用趨勢彙總重算完成：{rebuild_usage_rollups(args.start, args.end)}")
+    elif args.cmd == "archive":
+        wait_for_db()
+        print(f"✅ 歸檔完成：{run_retention(args.days, args.kind)}")
@@ -0,0 +1,167 @@
+"""
+測試共用設定：以記憶體內的假 MySQL 取代 pymysql.connect，不需要真的資料庫。
+
+- `db` fixture：primary 的 FakeDB；`db.on(正則, 回應)` 設定某類 SQL 的查詢結果，`db.executed(正則)` 取出執行過的 SQL
+- `fake_mysql` fixture：依 host 取得各台 FakeDB（例如讀寫分離測試的 replica）
+- 連線池、快取等模組層級的狀態在每個測試前後清空
+"""
+import os
+import re
+import sys
+
+import pymysql
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeDB:
+    def __init__(self, host: str):
+        self.host = host
+        self.log = []        # (sql, params)；BEGIN / COMMIT / ROLLBACK 也記在這裡
+        self.handlers = []   # (compiled regex, 回應)；後設定的優先
+        self.lastrowid = 0
+        self.down = False    # True 時連線失敗（模擬 DB 掛掉）
+
+    def on(self, pattern: str, response):
+        """
+        response 可以是列的 list、或 callable(sql, params) 回傳 list；
+        回傳 int 表示 rowcount（UPDATE / DELETE），回傳 Exception 會在 execute 時丟出。
+        """
+        self.handlers.insert(0, (re.compile(pattern, re.I | re.S), response))
+
+    def respond(self, sql: str, params):
+        for rx, response in self.handlers:
+            if rx.search(sql):
+                return response(sql, params) if callable(response) else response
+        return []
+
+    def executed(self, pattern: str):
+        rx = re.compile(pattern, re.I | re.S)
+        return [(sql, params) for sql, params in self.log if rx.search(sql)]
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.connection = conn
+        self.rows = []
+        self.rowcount = 0
+        self.lastrowid = None
+        self.description = None
+
+    def execute(self, sql, params=None):
+        db = self.connection.db
+        db.log.append((sql, params))
+        result = db.respond(sql, params)
+        if isinstance(result, Exception):
+            raise result
+        if isinstance(result, int):
+            self.rows, self.rowcount = [], result
+        else:
+            self.rows = list(result)
+            self.rowcount = len(self.rows) if self.rows or sql.lstrip().upper().startswith("SELECT") else 1
+        if sql.lstrip().upper().startswith("INSERT"):
+            db.lastrowid += 1
+            self.lastrowid = db.lastrowid
+        return self.rowcount
+
+    def executemany(self, sql, seq):
+        seq = list(seq)
+        db = self.connection.db
+        db.log.append((sql, seq))
+        result = db.respond(sql, seq)
+        if isinstance(result, Exception):
+            raise result
+        self.rows, self.rowcount = [], result if isinstance(result, int) else len(seq)
+        return self.rowcount
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchmany(self, size=1):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+
+class FakeConnection:
+    def __init__(self, db: FakeDB):
+        self.db = db
+        self.open = True
+        self.server_status = 0
+        self._autocommit = True
+
+    def cursor(self, cursor=None):
+        return FakeCursor(self)
+
+    def begin(self):
+        self.db.log.append(("BEGIN", None))
+
+    def commit(self):
+        self.db.log.append(("COMMIT", None))
+
+    def rollback(self):
+        self.db.log.append(("ROLLBACK", None))
+
+    def ping(self, reconnect=False):
+        if self.db.down:
+            raise pymysql.err.OperationalError(2013, "Lost connection")
+
+    def get_autocommit(self):
+        return self._autocommit
+
+    def autocommit(self, value):
+        self._autocommit = value
+
+    def close(self):
+        self.open = False
+
+
+@pytest.fixture
+def fake_mysql(monkeypatch):
+    servers = {}
+
+    def server(host: str) -> FakeDB:
+        return servers.setdefault(host, FakeDB(host))
+
+    def connect(**kwargs):
+        db = server(kwargs.get("host") or "")
+        if db.down:
+            raise pymysql.err.OperationalError(2003, f"Can't connect to MySQL server on '{db.host}'")
+        return FakeConnection(db)
+
+    monkeypatch.setattr(pymysql, "connect", connect)
+    return server
+
+
+@pytest.fixture
+def main(fake_mysql):
+    import main as m
+
+    m.db_pool.dispose()
+    m.invalidate_table_versions(list(m._table_versions))
+    m.stats_cache.invalidate()
+    m.forecast_cache.invalidate()
+    yield m
+    m.db_pool.dispose()
+
+
+@pytest.fixture
+def db(main, fake_mysql):
+    return fake_mysql(main.DB_HOST)
+
+
+@pytest.fixture
+def client(main):
+    from fastapi.testclient import TestClient
+
+    return TestClient(main.app)  # 不進入 lifespan：背景排程不會啟動，由測試自己呼叫
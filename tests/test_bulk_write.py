@@ -0,0 +1,155 @@
+"""批次寫入：依 bulk_token 查回的 id 與每筆對應、Idempotency-Key 重送、atomic 與逐筆失敗"""
+import re
+
+import pytest
+
+
+class BulkStore:
+    """
+    以記憶體模擬 bulk 寫入會用到的 SQL：資料表的 multi-row INSERT（id 每次跳 step，
+    且每次 INSERT 前先被「其他連線」取走一個號碼，模擬 auto_increment_increment > 1 與交錯取號）、
+    依 bulk_token 查回 id，以及 idempotency_keys。
+    """
+
+    def __init__(self, db, table: str, pk: str = "id", step: int = 2):
+        self.table, self.pk, self.step = table, pk, step
+        self.rows = {}
+        self.keys = {}
+        self.next_id = 1
+        db.on(rf"^INSERT INTO {table} \(", self.insert)
+        db.on(rf"SELECT {pk} FROM {table} WHERE bulk_token=%s", self.select_ids)
+        db.on(rf"UPDATE {table} SET bulk_token=NULL", self.clear_token)
+        db.on(r"INSERT IGNORE INTO idempotency_keys", self.claim_keys)
+        db.on(r"FROM idempotency_keys\s+WHERE scope=%s", self.select_keys)
+        db.on(r"UPDATE idempotency_keys SET result", self.save_results)
+
+    def _take_id(self) -> int:
+        rid, self.next_id = self.next_id, self.next_id + self.step
+        return rid
+
+    def insert(self, sql, params):
+        cols = [c.strip() for c in re.search(r"\((.*?)\) VALUES", sql).group(1).split(",")]
+        self._take_id()  # 其他連線同時寫入，先取走一個號碼
+        for i in range(0, len(params), len(cols)):
+            self.rows[self._take_id()] = dict(zip(cols, params[i:i + len(cols)]))
+        return len(params) // len(cols)
+
+    def select_ids(self, sql, params):
+        return [{self.pk: rid} for rid, r in sorted(self.rows.items()) if r.get("bulk_token") == params[0]]
+
+    def clear_token(self, sql, params):
+        hit = [r for r in self.rows.values() if r.get("bulk_token") == params[0]]
+        for r in hit:
+            r["bulk_token"] = None
+        return len(hit)
+
+    def claim_keys(self, sql, seq):
+        for scope, key, digest in seq:
+            self.keys.setdefault((scope, key), {"idem_key": key, "request_hash": digest, "result": None})
+        return len(seq)
+
+    def select_keys(self, sql, params):
+        scope, names = params[0], params[1:]
+        return [dict(self.keys[(scope, k)]) for k in names if (scope, k) in self.keys]
+
+    def save_results(self, sql, seq):
+        for result, scope, key in seq:
+            self.keys[(scope, key)]["result"] = result
+        return len(seq)
+
+    def by_name(self, column: str = "name"):
+        return {rid: r[column] for rid, r in self.rows.items()}
+
+
+@pytest.fixture
+def fixtures_store(db):
+    return BulkStore(db, "fixtures")
+
+
+def test_ids_follow_rows_when_not_consecutive(main, db, client, fixtures_store):
+    resp = client.post("/fixtures/bulk", json=[{"name": f"FX-{i}"} for i in range(4)])
+
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body["ok"] and body["inserted"] == 4
+    ids = [r["id"] for r in body["results"]]
+    assert ids == [3, 5, 7, 9]  # 不連續：第一個號碼被其他連線取走，之後每次跳 2
+    assert [fixtures_store.by_name()[i] for i in ids] == ["FX-0", "FX-1", "FX-2", "FX-3"]
+    assert all(r["bulk_token"] is None for r in fixtures_store.rows.values())
+
+
+def test_insert_rows_checks_returned_count(main, db, fixtures_store):
+    db.on(r"SELECT id FROM fixtures WHERE bulk_token=%s", [{"id": 1}])  # 查回的筆數與寫入不符
+
+    with main.get_db() as conn:
+        with pytest.raises(RuntimeError, match="預期 2 筆"):
+            main.insert_rows(conn.cursor(), "fixtures", ["name"], [("A",), ("B",)])
+
+
+def test_idempotency_key_replays_previous_result(main, db, client, fixtures_store):
+    items = [{"name": "FX-A"}, {"name": "FX-B"}]
+    first = client.post("/fixtures/bulk", json=items, headers={"Idempotency-Key": "req-1"}).json()
+    inserts = len(db.executed(r"^INSERT INTO fixtures \("))
+
+    again = client.post("/fixtures/bulk", json=items, headers={"Idempotency-Key": "req-1"}).json()
+
+    assert again["inserted"] == 0 and again["replayed"] == 2
+    assert [r["id"] for r in again["results"]] == [r["id"] for r in first["results"]]
+    assert len(db.executed(r"^INSERT INTO fixtures \(")) == inserts
+    assert len(fixtures_store.rows) == 2
+
+
+def test_idempotency_key_reused_with_different_content(main, db, client, fixtures_store):
+    client.post("/fixtures/bulk", json=[{"name": "FX-A", "idempotency_key": "k1"}])
+
+    resp = client.post("/fixtures/bulk", json=[{"name": "FX-OTHER", "idempotency_key": "k1"}])
+
+    assert resp.status_code == 422
+    assert "不同的內容" in resp.json()["results"][0]["error"]
+    assert list(fixtures_store.by_name().values()) == ["FX-A"]
+
+
+def test_duplicate_key_in_same_batch_written_once(main, db, client, fixtures_store):
+    item = {"name": "FX-A", "idempotency_key": "dup"}
+
+    body = client.post("/fixtures/bulk", json=[item, item]).json()
+
+    assert body["inserted"] == 1
+    assert body["results"][1]["replayed"] and body["results"][1]["id"] == body["results"][0]["id"]
+    assert list(fixtures_store.by_name().values()) == ["FX-A"]
+
+
+def test_atomic_batch_rejects_all_on_invalid_item(main, db, client, fixtures_store):
+    resp = client.post("/fixtures/bulk", json=[{"name": "FX-A"}, {"name": "  "}])
+
+    assert resp.status_code == 422
+    results = resp.json()["results"]
+    assert results[0]["skipped"] and not results[1]["ok"]
+    assert fixtures_store.rows == {}
+
+
+def test_non_atomic_batch_writes_valid_items(main, db, client, fixtures_store):
+    body = client.post("/fixtures/bulk?atomic=false", json=[{"name": "FX-A"}, {"name": "  "}, {"name": "FX-B"}]).json()
+
+    assert not body["ok"] and body["inserted"] == 2 and body["failed"] == 1
+    assert [r["ok"] for r in body["results"]] == [True, False, True]
+    assert sorted(fixtures_store.by_name().values()) == ["FX-A", "FX-B"]
+
+
+def test_bulk_receipts_record_serials_and_stock(main, db, client):
+    store = BulkStore(db, "receipts")
+    db.on(r"FROM fixture_inventory\s+WHERE fixture_code IN",
+          [{"fixture_code": "FX-A", "received_qty": 5, "returned_qty": 0, "on_hand": 5}])
+
+    body = client.post("/receipts/bulk", json=[
+        {"fixture_code": "FX-A", "serial_start": "SN08", "serial_end": "SN10"},
+        {"fixture_code": "FX-A", "serial_start": "", "serial_end": "", "quantity": 2},  # 沒有序號：以數量計
+    ]).json()
+
+    assert [(r["serial_count"], r["quantity"]) for r in body["results"]] == [(3, 3), (0, 2)]
+    receipt_id = body["results"][0]["id"]
+    (_, serial_rows), = db.executed(r"INSERT INTO fixture_serials")
+    assert serial_rows == [("FX-A", s, "received", receipt_id) for s in ("SN08", "SN09", "SN10")]
+    (_, stock), = db.executed(r"INSERT INTO fixture_inventory")
+    assert stock == [("FX-A", 5, 0)]
+    assert [r["quantity"] for r in store.rows.values()] == [None, 2]
@@ -0,0 +1,118 @@
+"""壽命預估摘要信：以本機的測試 SMTP 伺服器收信，確認每次只寄一封彙整信、沒有需要提醒的治具時不寄"""
+import email
+import email.policy
+import socketserver
+import threading
+
+import pytest
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """只實作 smtplib 寄信會用到的指令；收到的信存進 server.messages"""
+
+    def reply(self, line: str):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self.reply("220 localhost test smtp")
+        envelope = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.decode("utf-8", "replace").strip()
+            verb = cmd[:4].upper()
+            if verb == "EHLO":
+                self.reply("250-localhost"); self.reply("250 8BITMIME")
+            elif verb == "HELO":
+                self.reply("250 localhost")
+            elif verb == "MAIL":
+                envelope = {"from": cmd.partition(":")[2].strip(), "to": []}
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                envelope["to"].append(cmd.partition(":")[2].strip().strip("<>"))
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                for raw in iter(self.rfile.readline, b""):
+                    if raw in (b".\r\n", b".\n"):
+                        break
+                    data.append(raw[1:] if raw.startswith(b"..") else raw)
+                msg = email.message_from_bytes(b"".join(data), policy=email.policy.default)
+                self.server.messages.append((envelope, msg))
+                self.reply("250 OK queued")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:  # RSET / NOOP
+                self.reply("250 OK")
+
+
+@pytest.fixture
+def smtp_server():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _SMTPHandler)
+    server.daemon_threads = True
+    server.messages = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def forecast_db(db, smtp_server):
+    """三支 count 型治具：一支已到期、一支 14 天內到期、一支還很久；SMTP 指向測試伺服器"""
+    fixtures = [
+        (1, "FX-OVER", "active", "count", 1000, 1000, 700),   # 已達壽命
+        (2, "FX-SOON", "active", "count", 900, 1000, 280),    # 日均 20，剩 100 → 5 天
+        (3, "FX-FINE", "active", "count", 10, 1000, 14),      # 日均 1，剩 990 天
+    ]
+    db.fixtures = fixtures
+    db.on(r"FROM fixtures f LEFT JOIN", lambda sql, params: list(db.fixtures))
+    host, port = smtp_server.server_address
+    db.on(r"WHERE category='smtp'", [{"skey": "host", "svalue": host}, {"skey": "port", "svalue": str(port)},
+                                      {"skey": "sender", "svalue": "fixture@example.com"},
+                                      {"skey": "alert_to", "svalue": "a@example.com, b@example.com"}])
+    db.on(r"GET_LOCK", [{"ok": 1}])
+    db.last_digest = []
+    db.on(r"skey='last_digest_at'", lambda sql, params: list(db.last_digest))
+    return db
+
+
+def test_one_batched_digest_per_run(main, forecast_db, smtp_server):
+    result = main.run_forecast_digest()
+
+    assert result["sent"] is True
+    assert (result["overdue"], result["due_soon"]) == (1, 1)
+    assert len(smtp_server.messages) == 1
+    envelope, msg = smtp_server.messages[0]
+    assert sorted(envelope["to"]) == ["a@example.com", "b@example.com"]
+    assert "已到期 1 支" in msg["Subject"]
+    body = msg.get_body(("plain",)).get_content()
+    assert "FX-OVER" in body and "FX-SOON" in body and "FX-FINE" not in body
+    attachments = [part.get_filename() for part in msg.iter_attachments()]
+    assert attachments == [f"fixture_life_{main.date.today()}.csv"]
+    assert len(forecast_db.executed(r"INSERT INTO settings .*'last_digest_at'")) == 1
+
+
+def test_no_send_when_nothing_crosses_threshold(main, forecast_db, smtp_server):
+    forecast_db.fixtures = [(3, "FX-FINE", "active", "count", 10, 1000, 14),
+                            (4, "FX-IDLE", "inactive", "count", 1000, 1000, 0)]  # 已到期但非 active：不提醒
+
+    result = main.run_forecast_digest()
+
+    assert result["sent"] is False
+    assert (result["overdue"], result["due_soon"]) == (0, 0)
+    assert smtp_server.messages == []
+    assert forecast_db.executed(r"GET_LOCK") == []
+
+
+def test_scheduled_run_skips_when_already_sent_this_period(main, forecast_db, smtp_server):
+    forecast_db.last_digest = [{"svalue": str(main.time.time() - 60)}]
+
+    result = main.run_forecast_digest()
+
+    assert result["sent"] is False and result["skipped"] == "本週期已寄送"
+    assert smtp_server.messages == []
+    assert forecast_db.executed(r"RELEASE_LOCK")
@@ -0,0 +1,244 @@
+"""列表的 keyset 分頁、依資料表版本的 ETag / 304，以及 change feed 的 seq 順序與缺號處理"""
+import re
+
+import pytest
+
+
+class Table:
+    """以記憶體模擬 keyset_page 的 SELECT：主鍵比較、排序、LIMIT 與 COUNT"""
+
+    def __init__(self, db, table: str, pk: str, keys):
+        self.pk = pk
+        self.rows = [{pk: k, "note": f"row {k}"} for k in keys]
+        db.on(rf"SELECT \* FROM {table} WHERE", self.select)
+        db.on(rf"SELECT COUNT\(\*\) AS n FROM {table}", lambda sql, params: [{"n": len(self.rows)}])
+
+    def select(self, sql, params):
+        rows = sorted(self.rows, key=lambda r: r[self.pk], reverse="DESC" in sql)
+        m = re.search(rf"AND {self.pk} ([<>]) %s", sql)
+        if m:
+            after = params[0]
+            rows = [r for r in rows if (r[self.pk] < after if m.group(1) == "<" else r[self.pk] > after)]
+        return rows[:params[-1]]
+
+
+def walk(client, path: str, limit: int):
+    pages, cursor = [], None
+    while True:
+        body = client.get(path, params={"limit": limit, **({"cursor": cursor} if cursor else {})}).json()
+        pages.append([r["id"] for r in body["data"]])
+        cursor = body["next_cursor"]
+        if not cursor:
+            return pages
+
+
+def test_keyset_pages_cover_every_row_once(main, db, client):
+    Table(db, "receipts", "id", [1, 2, 3, 5, 8, 13, 21])  # 主鍵有缺號
+
+    pages = walk(client, "/receipts", limit=3)
+
+    assert pages == [[21, 13, 8], [5, 3, 2], [1]]
+
+
+def test_exact_multiple_of_limit_has_no_empty_last_page(main, db, client):
+    Table(db, "receipts", "id", range(1, 7))
+
+    assert walk(client, "/receipts", limit=3) == [[6, 5, 4], [3, 2, 1]]
+
+
+def test_total_only_when_requested(main, db, client):
+    Table(db, "receipts", "id", range(1, 7))
+
+    assert client.get("/receipts?limit=2").json()["total"] is None
+    assert client.get("/receipts?limit=2&with_total=true").json()["total"] == 6
+    assert len(db.executed(r"COUNT\(\*\)")) == 1
+
+
+def test_columns_layout_keeps_cursor(main, db, client):
+    Table(db, "receipts", "id", range(1, 6))
+
+    body = client.get("/receipts?limit=2&layout=columns").json()
+
+    assert body["columns"] == ["id", "note"]
+    assert body["rows"] == [[5, "row 5"], [4, "row 4"]]
+    assert main.decode_cursor(body["next_cursor"]) == 4
+
+
+def test_string_keys_page_ascending(main, db):
+    Table(db, "users", "username", ["carol", "alice", "bob"])
+
+    with main.get_db() as conn:
+        first = main.keyset_page(conn.cursor(), "users", "username", limit=2, ascending=True)
+        rest = main.keyset_page(conn.cursor(), "users", "username", cursor=first["next_cursor"], limit=2, ascending=True)
+
+    assert [r["username"] for r in first["data"]] == ["alice", "bob"]
+    assert [r["username"] for r in rest["data"]] == ["carol"] and rest["next_cursor"] is None
+
+
+def test_bad_cursor_is_400(main, db, client):
+    assert client.get("/receipts?cursor=not-a-cursor").status_code == 400
+
+
+# ---- ETag / 304 ----
+@pytest.fixture
+def versions(db):
+    state = {"fixtures": 1}
+
+    def read(sql, params):
+        return [{"table_name": t, "version": state[t], "ts": 1767225600.0 + state[t]} for t in params if t in state]
+
+    def bump(sql, seq):
+        for (t,) in seq:
+            state[t] = state.get(t, 0) + 1
+        return len(seq)
+    db.on(r"FROM table_versions", read)
+    db.on(r"INSERT INTO table_versions", bump)
+    Table(db, "fixtures", "id", range(1, 4))
+    return state
+
+
+def test_unchanged_list_returns_304_without_querying_rows(main, db, client, versions):
+    first = client.get("/fixtures")
+    etag = first.headers["ETag"]
+    queries = len(db.executed(r"SELECT \* FROM fixtures"))
+
+    again = client.get("/fixtures", headers={"If-None-Match": etag})
+
+    assert again.status_code == 304 and again.headers["ETag"] == etag
+    assert len(db.executed(r"SELECT \* FROM fixtures")) == queries
+    assert client.get("/fixtures", headers={"If-Modified-Since": first.headers["Last-Modified"]}).status_code == 304
+
+
+def test_etag_depends_on_query_string(main, db, client, versions):
+    etag = client.get("/fixtures?limit=2").headers["ETag"]
+
+    assert client.get("/fixtures?limit=3", headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_write_changes_etag_after_commit(main, db, client, versions):
+    etag = client.get("/fixtures").headers["ETag"]
+
+    assert client.put("/fixtures/1", json={"name": "FX-A", "life_value": 10}).status_code == 200
+    resp = client.get("/fixtures", headers={"If-None-Match": etag})
+
+    assert versions["fixtures"] == 2
+    assert resp.status_code == 200 and resp.headers["ETag"] != etag
+
+
+def test_compressed_etag_suffix_still_matches(main, db, client, versions):
+    etag = client.get("/fixtures").headers["ETag"]
+
+    resp = client.get("/fixtures", headers={"If-None-Match": f'W/{etag[:-1]}-gzip"'})
+
+    assert resp.status_code == 304
+
+
+# ---- Change feed ----
+class ChangeEvents:
+    """change_events 資料表：rows 依 seq 存放；尚未提交的交易以缺號表示"""
+
+    def __init__(self, db):
+        self.rows = {}
+        db.on(r"SELECT COALESCE\(MAX\(seq\), 0\)", lambda sql, params: [{"seq": max(self.rows, default=0)}])
+        db.on(r"FROM change_events\s+WHERE seq > %s ORDER BY seq LIMIT", self.after)
+        db.on(r"SELECT seq, table_name FROM change_events WHERE seq IN", self.lookup)
+        db.on(r"INSERT INTO change_events \(table_name, op, row_id, fields\)\s+SELECT", self.insert_reload)
+
+    def add(self, seq: int, table: str = "fixtures", op: str = "update"):
+        self.rows[seq] = {"seq": seq, "table_name": table, "op": op, "row_id": str(seq), "fields": None,
+                          "created_at": None}
+
+    def after(self, sql, params):
+        since, limit = params
+        return [self.rows[s] for s in sorted(self.rows) if s > since][:limit]
+
+    def lookup(self, sql, params):
+        return [self.rows[s] for s in params if s in self.rows]
+
+    def insert_reload(self, sql, params):
+        table, row_id, fields = params[:3]
+        seq = max(self.rows) + 1
+        self.rows[seq] = {"seq": seq, "table_name": table, "op": "reload", "row_id": row_id, "fields": fields,
+                          "created_at": None}
+        return 1
+
+
+@pytest.fixture
+def feed(main, db, monkeypatch):
+    events = ChangeEvents(db)
+    for seq in (1, 2, 3):
+        events.add(seq)
+    cf = main.ChangeFeed(poll_interval=60, buffer_size=100)
+    cf.poll()  # 第一次只記下目前的最大 seq
+    monkeypatch.setattr(main, "change_feed", cf)
+    cf.table = events
+    return cf
+
+
+def seqs(page):
+    return [e["seq"] for e in page["events"]]
+
+
+def test_feed_starts_at_current_seq(main, feed, client):
+    assert feed.watermark == 3
+    assert client.get("/changes").json() == {"events": [], "last_seq": 3, "reset": False}
+
+
+def test_events_delivered_in_seq_order(main, feed, client):
+    for seq in (4, 5, 6):
+        feed.table.add(seq)
+
+    assert feed.poll() == 3
+
+    body = client.get("/changes?since=3").json()
+    assert seqs(body) == [4, 5, 6] and body["last_seq"] == 6
+    assert seqs(client.get("/changes?since=5").json()) == [6]
+    assert client.get("/changes?since=6").json() == {"events": [], "last_seq": 6, "reset": False}
+
+
+def test_gap_holds_later_events_until_filled(main, feed, monkeypatch):
+    monkeypatch.setattr(main, "CHANGES_GAP_WAIT", 60)
+    feed.table.add(5)  # seq 4 的交易還沒提交
+
+    assert feed.poll() == 0 and feed.watermark == 3
+
+    feed.table.add(4)
+    assert feed.poll() == 2
+    assert seqs(feed.read(3, 10)) == [4, 5]
+
+
+def test_gap_skipped_after_wait_and_late_event_reloads_table(main, feed, monkeypatch):
+    monkeypatch.setattr(main, "CHANGES_GAP_WAIT", 0)
+    feed.table.add(5)  # seq 4 rollback（永久缺號）或提交得很晚
+
+    assert feed.poll() == 1 and feed.watermark == 5 and feed.gaps_skipped == 1
+
+    feed.table.add(4, table="receipts")  # 晚到：用戶端已越過 4，改發 receipts 的 reload
+    feed._rescanned_at = 0
+    feed.poll()
+
+    last = feed.read(5, 10)["events"]
+    assert [(e["table"], e["op"], e["id"]) for e in last] == [("receipts", "reload", "late:4")]
+    assert feed.late_events == 1
+
+
+def test_table_filter_advances_last_seq_past_other_tables(main, feed, client):
+    feed.table.add(4, table="receipts")
+    feed.table.add(5, table="fixtures")
+    feed.table.add(6, table="receipts")
+    feed.poll()
+
+    body = client.get("/changes?since=3&tables=fixtures").json()
+
+    assert seqs(body) == [5] and body["last_seq"] == 6
+
+
+def test_limit_pages_through_events(main, feed, client):
+    for seq in range(4, 9):
+        feed.table.add(seq)
+    feed.poll()
+
+    first = client.get("/changes?since=3&limit=2").json()
+    second = client.get(f"/changes?since={first['last_seq']}&limit=2").json()
+
+    assert seqs(first) == [4, 5] and seqs(second) == [6, 7]
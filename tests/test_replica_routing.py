@@ -0,0 +1,99 @@
+"""讀寫分離：replica 健康檢查、延遲或連不上時改讀 primary、寫入後同一用戶端讀自己的寫入"""
+import pymysql
+import pytest
+
+
+def replica_status(lag, io="Yes", sql="Yes"):
+    return [{"Replica_IO_Running": io, "Replica_SQL_Running": sql, "Seconds_Behind_Source": lag}]
+
+
+@pytest.fixture
+def replica(main, fake_mysql, monkeypatch):
+    db = fake_mysql("replica-host")
+    db.on(r"SHOW REPLICA STATUS", replica_status(0))
+    router = main.ReplicaRouter(main.ConnectionPool(size=2, max_overflow=0, timeout=0.2, recycle=0,
+                                                    ping_interval=60, host="replica-host"))
+    monkeypatch.setattr(main, "read_router", router)
+    yield db
+    router.pool.dispose()
+
+
+def read_host(main) -> str:
+    with main.get_read_db() as conn:
+        return conn._raw.db.host
+
+
+def test_reads_primary_until_first_check(main, db, replica):
+    assert read_host(main) == main.DB_HOST
+    assert main.read_router.primary_reads == 1
+
+
+def test_healthy_replica_serves_reads(main, db, replica, client):
+    assert main.read_router.check()["healthy"] is True
+
+    assert client.get("/receipts").status_code == 200
+
+    assert replica.executed(r"FROM receipts") and not db.executed(r"FROM receipts")
+    assert main.read_router.replica_reads == 1
+
+
+@pytest.mark.parametrize("status, reason", [
+    (replica_status(30), "複寫延遲 30.0 秒"),
+    (replica_status(None), "複寫延遲 未知 秒"),
+    (replica_status(0, sql="No"), "複寫未在執行"),
+    ([], "沒有複寫狀態（不是 replica）"),
+])
+def test_unhealthy_replica_falls_back_to_primary(main, db, replica, status, reason):
+    main.read_router.check()
+    replica.on(r"SHOW REPLICA STATUS", status)
+
+    result = main.read_router.check()
+
+    assert result["healthy"] is False and result["reason"] == reason
+    assert read_host(main) == main.DB_HOST
+
+
+def test_old_mysql_uses_show_slave_status(main, db, replica):
+    replica.on(r"SHOW REPLICA STATUS", pymysql.err.ProgrammingError(1064, "syntax error"))
+    replica.on(r"SHOW SLAVE STATUS", [{"Slave_IO_Running": "Yes", "Slave_SQL_Running": "Yes",
+                                       "Seconds_Behind_Master": 2}])
+
+    assert main.read_router.check() == {"healthy": True, "lag": 2.0, "reason": "ok"}
+
+
+def test_unreachable_replica_falls_back_until_next_check(main, db, replica):
+    main.read_router.check()
+    replica.down = True
+    main.read_router.pool.dispose()  # replica 重開：池裡的連線都斷了，只能重連
+
+    assert read_host(main) == main.DB_HOST
+    assert main.read_router.fallbacks == 1 and main.read_router.healthy is False
+    assert read_host(main) == main.DB_HOST  # 之後不再嘗試連 replica，直到下一次檢查
+    assert main.read_router.fallbacks == 1
+
+    replica.down = False
+    assert main.read_router.check()["healthy"] is True
+    assert read_host(main) == "replica-host"
+
+
+def test_client_reads_own_writes_from_primary(main, db, replica, client):
+    main.read_router.check()
+
+    resp = client.put("/fixtures/7", json={"name": "FX-A", "life_value": 1000})
+    assert main.READ_YOUR_WRITES_COOKIE in resp.cookies
+
+    client.get("/receipts")
+    assert db.executed(r"FROM receipts") and not replica.executed(r"FROM receipts")
+
+    other = type(client)(main.app)  # 沒寫入過的用戶端照常讀 replica
+    other.get("/receipts")
+    assert replica.executed(r"FROM receipts")
+
+
+def test_failed_write_does_not_pin_reads_to_primary(main, db, replica, client):
+    main.read_router.check()
+
+    resp = client.post("/fixtures/bulk", json=[{"name": " "}])
+
+    assert resp.status_code == 422
+    assert main.READ_YOUR_WRITES_COOKIE not in resp.cookies
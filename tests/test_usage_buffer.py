@@ -0,0 +1,106 @@
+"""使用記錄緩衝：批次寫入與 used 累加、緩衝上限、暫時性錯誤重試、資料錯誤的列移到 dead letter"""
+from datetime import datetime
+
+import pymysql
+import pytest
+
+
+@pytest.fixture
+def buffer(main, db, monkeypatch):
+    db.on(r"SELECT NOW\(6\)", lambda sql, params: [{"now": datetime(2026, 1, 1, 12, 0, 0)}])
+    buf = main.UsageBuffer(interval=60, flush_rows=1000, max_rows=5)
+    monkeypatch.setattr(main, "usage_buffer", buf)
+    return buf
+
+
+def usage(fixture_id: str, use_count: int = 1, station_id: int = 1) -> tuple:
+    return (fixture_id, None, station_id, use_count, None, None, "op")
+
+
+def inserted_rows(db):
+    return [row for _, rows in db.executed(r"INSERT INTO usage_logs") for row in rows]
+
+
+def test_flush_writes_batch_and_accumulates_used(main, db, buffer):
+    seen = []
+    buffer.on_flush(seen.append)
+    buffer.add([usage("FX-A", 2), usage("FX-B", 1), usage("FX-A", 3)])
+
+    assert buffer.flush() == 3
+
+    assert [r[0] for r in inserted_rows(db)] == ["FX-A", "FX-B", "FX-A"]
+    (sql, params), = db.executed(r"UPDATE fixtures SET used = used \+ CASE")
+    assert params == ["FX-A", 5, "FX-B", 1, "FX-A", "FX-B"]
+    assert db.log[-1] == ("COMMIT", None)
+    assert seen == [{"FX-A": 5, "FX-B": 1}]
+    assert buffer.stats()["pending"] == 0 and buffer.flushed_rows == 3
+    assert buffer.flush() == 0  # 緩衝已清空，不再寫入
+
+
+def test_full_buffer_rejects_with_503(main, db, buffer, client):
+    buffer.add([usage("FX-A")] * 4)
+
+    resp = client.post("/usage_logs/batch", json=[{"fixture_id": "FX-A"}, {"fixture_id": "FX-B"}])
+
+    assert resp.status_code == 503
+    assert buffer.stats()["pending"] == 4 and buffer.rejected == 2
+    assert inserted_rows(db) == []
+
+
+def test_transient_error_requeues_batch(main, db, buffer):
+    db.on(r"INSERT INTO usage_logs", pymysql.err.OperationalError(2013, "Lost connection"))
+    buffer.add([usage("FX-A"), usage("FX-B")])
+
+    with pytest.raises(pymysql.err.OperationalError):
+        buffer.flush()
+
+    stats = buffer.stats()
+    assert stats["pending"] == 2 and stats["errors"] == 1 and stats["dead_letters"] == 0
+    assert db.executed(r"ROLLBACK")
+
+    db.log.clear()
+    db.on(r"INSERT INTO usage_logs", [])  # DB 恢復：下一次 flush 寫入同一批
+    assert buffer.flush() == 2
+    assert [r[0] for r in inserted_rows(db)] == ["FX-A", "FX-B"]
+
+
+def test_requeue_keeps_newest_rows_within_max(main, db, buffer):
+    buffer.add([usage("OLD-1"), usage("OLD-2"), usage("OLD-3")])
+    batch, buffer._pending = buffer._pending, []  # 模擬 flush 取走這批後，寫入期間又收到新資料
+    buffer.add([usage("NEW-1"), usage("NEW-2"), usage("NEW-3")])
+
+    buffer._requeue(batch, RuntimeError("lost"))
+
+    assert [r[0] for _, r in buffer._pending] == ["OLD-2", "OLD-3", "NEW-1", "NEW-2", "NEW-3"]
+    assert buffer.rejected == 1
+
+
+def test_bad_rows_go_to_dead_letters(main, db, buffer):
+    def insert(sql, rows):
+        if any(r[0] == "FX-BAD" for r in rows):
+            return pymysql.err.DataError(1406, "Data too long for column 'fixture_id'")
+        return []
+    db.on(r"INSERT INTO usage_logs", insert)
+    buffer.add([usage("FX-A"), usage("FX-BAD"), usage("FX-B")])
+
+    assert buffer.flush() == 2
+
+    stats = buffer.stats()
+    assert stats["dead_letters"] == 1 and stats["pending"] == 0
+    assert stats["recent_dead_letters"][0]["row"]["fixture_id"] == "FX-BAD"
+    assert "Data too long" in stats["recent_dead_letters"][0]["error"]
+    written = [r[0] for _, rows in db.executed(r"INSERT INTO usage_logs") for r in rows if len(rows) == 1]
+    assert written == ["FX-A", "FX-BAD", "FX-B"]  # 逐筆重試，只有 FX-BAD 寫不進去
+
+
+def test_fixture_update_keeps_synced_usage(main, db, client):
+    """編輯治具沒帶 used 時不可覆寫緩衝累加到伺服器上的使用次數"""
+    resp = client.put("/fixtures/7", json={"name": "FX-A", "life_value": 1000})
+
+    assert resp.status_code == 200
+    (sql, params), = db.executed(r"UPDATE fixtures SET")
+    assert "used" not in sql
+    assert params == ["FX-A", "active", "count", 1000, 7]
+
+    client.put("/fixtures/7", json={"name": "FX-A", "life_value": 1000, "used": 0})
+    assert "used=%s" in db.executed(r"UPDATE fixtures SET")[-1][0]